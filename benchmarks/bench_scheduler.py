@@ -0,0 +1,210 @@
+"""
+Scheduler benchmarks against a local SMTP sink -- no real mail server needed.
+
+    python benchmarks/bench_scheduler.py                 # 1k, 10k and 100k rows
+    python benchmarks/bench_scheduler.py --rows 5000 --latency-ms 20
+    python benchmarks/bench_scheduler.py --engine asyncio   # needs aiosmtplib
+
+For each size a synthetic scheduler.db is built with rows spread across every
+mode/frequency combination, all due at once, and one scheduler tick sends them
+to an in-process SMTP sink. Each size runs in its own process so peak RSS is
+per size. Reported:
+
+  tick        wall time of check_schedules() sending every row
+  sends/s     messages accepted by the sink per second of tick
+  db          time spent in repository calls during the tick
+  send        time spent in send_email() (message build + SMTP round trips, including
+              waiting for a pooled connection), summed over worker threads / tasks
+  idle tick   check_schedules() when nothing is due
+  next_due    compute_next_due() per row (what the scheduler and the GUI's
+              "Next Send" column both read, precomputed as next_due_at)
+  peak RSS    maximum resident memory of the benchmark process
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from email_scheduler.core import DEFAULT_ENGINE, ENGINES, Scheduler  # noqa: E402
+from email_scheduler.db import Database, SMTPSettingsRepository  # noqa: E402
+
+from smtp_sink import SMTPSink  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# (mode, frequency, interval_seconds, schedule_time) -- every combination the GUI allows
+COMBINATIONS = [
+    ("Time", "Once", None, "09:00"),
+    ("Time", "Daily", None, "09:00"),
+    ("Time", "Weekly", None, "13:30"),
+    ("Time", "Monthly", None, "18:45"),
+    ("Interval", None, 30, None),
+    ("Interval", None, 900, None),
+    ("Interval", None, 3600, None),
+    ("Interval", None, 86400, None),
+]
+
+
+class Stopwatch:
+    """Accumulates time spent in wrapped callables (safe across threads)."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.seconds += elapsed
+                    self.calls += 1
+        return timed
+
+    def wrap_async(self, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.seconds += elapsed
+                    self.calls += 1
+        return timed
+
+
+def build_database(path, rows):
+    """Create a migrated scheduler.db with `rows` emails, all due now."""
+    database = Database(path)
+    database.migrate()
+    # Due now rather than long ago, so nothing counts as a missed run
+    now = int(time.time())
+    with database.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO emails
+                (subject, recipients, body, mode, frequency, interval_seconds,
+                 schedule_time, last_sent, next_due_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)
+        """, (
+            (f"Benchmark report {i}", f"user{i}@example.com", "Synthetic benchmark body.\n" * 20)
+            + COMBINATIONS[i % len(COMBINATIONS)] + (now,)
+            for i in range(rows)
+        ))
+    return database
+
+
+def run_single(rows, latency, engine):
+    """Benchmark one database size; returns a dict of results."""
+    sink = SMTPSink(latency=latency).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        database = build_database(os.path.join(tmp, "scheduler.db"), rows)
+        SMTPSettingsRepository(database).save("127.0.0.1", sink.port, "bench@example.com", "secret", "NONE")
+        scheduler = Scheduler(database, engine=engine)
+
+        db_time = Stopwatch()
+        for repository, names in (
+            (scheduler.emails, ("due_times",)),
+            (scheduler.outbox, ("enqueue_due", "claim_ready", "record_results",
+                                "next_attempt_at")),
+        ):
+            for name in names:
+                setattr(repository, name, db_time.wrap(getattr(repository, name)))
+        send_time = Stopwatch()
+        scheduler.send_email = send_time.wrap(scheduler.send_email)
+        scheduler.send_email_async = send_time.wrap_async(scheduler.send_email_async)
+
+        start = time.perf_counter()
+        scheduler.check_schedules()
+        tick = time.perf_counter() - start
+        sent = sink.stats["messages"]
+
+        start = time.perf_counter()
+        scheduler.check_schedules()
+        idle_tick = time.perf_counter() - start
+
+        emails = scheduler.emails.page(limit=rows)[0]
+        start = time.perf_counter()
+        for email in emails:
+            email.compute_next_due()
+        next_due_per_row = (time.perf_counter() - start) / max(rows, 1)
+
+        scheduler.stop()
+        database.close()
+    sink.stop()
+
+    return {
+        "rows": rows,
+        "tick_s": tick,
+        "sent": sent,
+        "sends_per_s": sent / tick if tick else 0.0,
+        "db_s": db_time.seconds,
+        "send_s": send_time.seconds,
+        "connections": sink.stats["connections"],
+        "idle_tick_ms": idle_tick * 1000,
+        "next_due_us": next_due_per_row * 1e6,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+def print_report(results):
+    header = ("rows", "tick s", "sent", "sends/s", "db s", "send s", "conns",
+              "idle tick ms", "next_due us", "peak RSS MB")
+    print(" | ".join(f"{h:>12}" for h in header))
+    for r in results:
+        print(" | ".join(f"{v:>12}" for v in (
+            r["rows"], f"{r['tick_s']:.3f}", r["sent"], f"{r['sends_per_s']:.0f}",
+            f"{r['db_s']:.3f}", f"{r['send_s']:.3f}", r["connections"],
+            f"{r['idle_tick_ms']:.2f}", f"{r['next_due_us']:.2f}",
+            f"{r['peak_rss_mb']:.1f}"
+        )))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="database sizes to benchmark (default: %(default)s)")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="simulated relay latency per message")
+    parser.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="sending engine to benchmark (default: %(default)s)")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)  # internal: one size, JSON out
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_single(args.single, args.latency_ms / 1000, args.engine)))
+        return
+
+    results = []
+    for rows in args.rows:
+        # A fresh process per size keeps peak RSS comparable
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--single", str(rows),
+             "--latency-ms", str(args.latency_ms), "--engine", args.engine],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
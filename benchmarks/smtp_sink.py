@@ -0,0 +1,105 @@
+"""
+A minimal in-process SMTP server that accepts (and discards, unless asked to
+keep them) everything, for benchmarking and tests without a real mail server. Supports EHLO, AUTH, MAIL/RCPT/DATA,
+RSET, NOOP and QUIT -- enough for smtplib and the connection pool.
+"""
+import socketserver
+import threading
+import time
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count("connections")
+        self.reply("220 sink ESMTP ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip().upper()
+
+            if command.startswith(("EHLO", "HELO")):
+                self.wfile.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE\r\n")
+            elif command.startswith("AUTH"):
+                sink.count("logins")
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith("MAIL"):
+                recipients = []
+                self.reply("250 OK")
+            elif command.startswith("RCPT"):
+                recipients.append(line.decode("ascii", "replace").strip()[8:].strip("<>"))
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                    if sink.messages is not None:
+                        lines.append(data_line[1:] if data_line.startswith(b".") else data_line)
+                if sink.latency:
+                    time.sleep(sink.latency)
+                sink.count("messages")
+                sink.count("recipients", len(recipients))
+                sink.count("bytes", size)
+                if sink.messages is not None:
+                    sink.keep(recipients, b"".join(lines))
+                self.reply("250 OK queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # NOOP, RSET, ...
+                self.reply("250 OK")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    # Room for the asyncio engine opening many sessions at once
+    request_queue_size = 256
+
+
+class SMTPSink:
+    """
+    Run with start(); point SMTP settings at ("127.0.0.1", sink.port) with
+    encryption "NONE". latency (seconds) is slept before acknowledging each
+    message, to simulate a remote relay. With keep_messages, messages holds
+    (envelope recipients, message bytes) of everything received.
+    """
+
+    def __init__(self, latency=0.0, keep_messages=False):
+        self.latency = latency
+        self.messages = [] if keep_messages else None
+        self.stats = {"connections": 0, "logins": 0, "messages": 0, "recipients": 0, "bytes": 0}
+        self._lock = threading.Lock()
+        self._server = _ThreadingServer(("127.0.0.1", 0), _SinkHandler)
+        self._server.sink = self
+        self.port = self._server.server_address[1]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def keep(self, recipients, data):
+        with self._lock:
+            self.messages.append((recipients, data))
+
+    def reset(self):
+        with self._lock:
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
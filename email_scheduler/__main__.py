@@ -0,0 +1,193 @@
+"""
+Headless entry point, for servers without a display:
+
+    python -m email_scheduler daemon [--db scheduler.db] [--engine threads|asyncio]
+                                     [--metrics-port 9464] [--metrics-file metrics.prom]
+                                     [--drain-window 300]
+                                     [--api-port 8025 [--api-token TOKEN] [--api-upload-dir DIR]]
+    python -m email_scheduler import FILE [--format csv|jsonl] [--db scheduler.db]
+    python -m email_scheduler export FILE [--format csv|jsonl] [--db scheduler.db]
+    python -m email_scheduler history [--days 7] [--period hour|day] [--email ID] [--db scheduler.db]
+    python -m email_scheduler compact [--full] [--db scheduler.db]
+
+Does not import tkinter. Stops cleanly on SIGTERM or Ctrl+C.
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+
+from email_scheduler import bulk, retention
+from email_scheduler.api import ApiServer
+from email_scheduler.core import BACKLOG_DRAIN_SECONDS, DEFAULT_ENGINE, ENGINES, Scheduler
+from email_scheduler.db import DB_FILE, AttachmentRepository, Database, EmailRepository, SendLogRepository
+from email_scheduler.metrics import MetricsFileWriter, MetricsServer
+
+logger = logging.getLogger("email_scheduler")
+
+
+def run_daemon(args):
+    database = Database(args.db)
+    database.migrate()
+    scheduler = Scheduler(database, engine=args.engine, drain_window=args.drain_window)
+
+    def handle_signal(signum, frame):
+        logger.info("Received %s, stopping", signal.Signals(signum).name)
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    exporters = []
+    if args.metrics_port is not None:
+        server = MetricsServer(args.metrics_port).start()
+        exporters.append(server)
+        logger.info("Serving metrics on http://127.0.0.1:%d/metrics", server.port)
+    if args.metrics_file:
+        exporters.append(MetricsFileWriter(args.metrics_file, interval=args.metrics_interval).start())
+    api = None
+    if args.api_port is not None:
+        api = ApiServer(scheduler, args.api_port, host=args.api_host, token=args.api_token,
+                        upload_dir=args.api_upload_dir).start()
+        logger.info("Serving the API on http://%s:%d/emails", args.api_host, api.port)
+        if args.api_token is None and args.api_host not in ("127.0.0.1", "localhost", "::1"):
+            logger.warning("The API is reachable from other hosts without a token (see --api-token)")
+
+    logger.info("Scheduler started (database: %s)", args.db)
+    # Run the loop on the main thread so signal handlers fire promptly
+    scheduler.run()
+    if api:
+        api.stop()
+    for exporter in exporters:
+        exporter.stop()
+    database.close()
+    logger.info("Scheduler stopped")
+
+
+def run_import(args):
+    fmt = args.format or bulk.guess_format(args.file)
+    if not fmt:
+        sys.exit("Can't tell the format from the file name; pass --format")
+    database = Database(args.db)
+    database.migrate()
+
+    def report(line_number, message):
+        logger.error("%s:%d: %s", args.file, line_number, message)
+
+    with open(args.file, newline="", encoding="utf-8-sig") as f:
+        imported, rejected = bulk.import_emails(EmailRepository(database), AttachmentRepository(database), f, fmt,
+                                                on_error=report)
+    database.close()
+    logger.info("Imported %d emails, rejected %d rows", imported, rejected)
+    # A running scheduler picks the new emails up on its next timer resync
+    if rejected:
+        sys.exit(1)
+
+
+def run_export(args):
+    fmt = args.format or bulk.guess_format(args.file) or "jsonl"
+    database = Database(args.db)
+    if args.file == "-":
+        exported = bulk.export_emails(EmailRepository(database), sys.stdout, fmt)
+    else:
+        with open(args.file, "w", newline="", encoding="utf-8") as f:
+            exported = bulk.export_emails(EmailRepository(database), f, fmt)
+    database.close()
+    logger.info("Exported %d emails", exported)
+
+
+def run_history(args):
+    database = Database(args.db)
+    database.migrate()
+    send_log = SendLogRepository(database)
+    if args.email is not None:
+        for log in send_log.history(args.email, limit=args.limit):
+            print(f"{datetime.fromtimestamp(log.sent_at):%Y-%m-%d %H:%M:%S}  "
+                  f"{'sent' if log.error is None else 'FAILED'}  relay={log.relay_id}  {log.bytes} B  "
+                  f"{log.latency_ms} ms  {log.error or log.response or ''}")
+    else:
+        print(f"{'period':<17} {'sends':>8} {'failures':>8} {'MB':>9} {'avg ms':>7}")
+        for start, sends, failures, size, latency_ms in send_log.throughput(
+                int(time.time() - args.days * 86400), args.period):
+            average = latency_ms / (sends + failures) if sends + failures else 0
+            print(f"{datetime.fromtimestamp(start):%Y-%m-%d %H:%M} {sends:>8} {failures:>8} "
+                  f"{size / 1e6:>9.2f} {average:>7.0f}")
+    database.close()
+
+
+def run_compact(args):
+    database = Database(args.db)
+    database.migrate()
+    rolled_up = retention.compact(database, full_vacuum=args.full)
+    database.close()
+    logger.info("Rolled up %d send_log rows", rolled_up)
+
+
+def main(argv=None):
+    # Options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", default=DB_FILE, help="SQLite database file (default: %(default)s)")
+
+    parser = argparse.ArgumentParser(prog="python -m email_scheduler")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    daemon = subcommands.add_parser("daemon", parents=[common], help="run the scheduler without the GUI")
+    daemon.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="how emails are sent: smtplib on worker threads, or aiosmtplib "
+                             "on one event loop (default: %(default)s)")
+    daemon.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on 127.0.0.1 at this port")
+    daemon.add_argument("--metrics-file",
+                        help="append a metrics snapshot to this file periodically (rotated at 10 MB)")
+    daemon.add_argument("--metrics-interval", type=float, default=60,
+                        help="seconds between metrics file snapshots (default: %(default)s)")
+    daemon.add_argument("--drain-window", type=float, default=BACKLOG_DRAIN_SECONDS,
+                        help="seconds over which to spread sends of runs missed while the scheduler was "
+                             "down; 0 sends them at once (default: %(default)s)")
+    daemon.add_argument("--api-port", type=int,
+                        help="serve the HTTP/JSON API for managing emails at this port")
+    daemon.add_argument("--api-host", default="127.0.0.1", help="address the API listens on (default: %(default)s)")
+    daemon.add_argument("--api-token", default=os.environ.get("EMAIL_SCHEDULER_API_TOKEN"),
+                        help="require 'Authorization: Bearer TOKEN' on API requests "
+                             "(default: $EMAIL_SCHEDULER_API_TOKEN)")
+    daemon.add_argument("--api-upload-dir",
+                        help="let API requests attach files from this directory (by default they can only "
+                             "reference stored attachments)")
+    daemon.set_defaults(func=run_daemon)
+
+    importer = subcommands.add_parser("import", parents=[common], help="add schedules from a CSV or JSONL file")
+    importer.add_argument("file", help=f"file with the columns {', '.join(bulk.FIELDS)}")
+    importer.add_argument("--format", choices=bulk.FORMATS, help="default: from the file extension")
+    importer.set_defaults(func=run_import)
+
+    exporter = subcommands.add_parser("export", parents=[common], help="write every schedule to CSV or JSONL")
+    exporter.add_argument("file", help="output file, or - for stdout")
+    exporter.add_argument("--format", choices=bulk.FORMATS,
+                          help="default: from the file extension, else jsonl")
+    exporter.set_defaults(func=run_export)
+
+    history = subcommands.add_parser("history", parents=[common],
+                                     help="show sends per hour or day, or one email's send log")
+    history.add_argument("--days", type=float, default=7, help="how far back to go (default: %(default)s)")
+    history.add_argument("--period", choices=("hour", "day"), default="day", help="default: %(default)s")
+    history.add_argument("--email", type=int, help="list this email id's recent sends instead")
+    history.add_argument("--limit", type=int, default=50, help="sends listed with --email (default: %(default)s)")
+    history.set_defaults(func=run_history)
+
+    compactor = subcommands.add_parser("compact", parents=[common],
+                                       help="roll up old send history and vacuum the database now")
+    compactor.add_argument("--full", action="store_true",
+                           help="rewrite the whole file with VACUUM (needed once for databases created "
+                                "before incremental vacuuming; blocks the scheduler while it runs)")
+    compactor.set_defaults(func=run_compact)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
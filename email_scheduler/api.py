@@ -0,0 +1,346 @@
+"""
+Local HTTP/JSON API for managing schedules without the GUI:
+
+    GET    /emails              one page of emails (?limit, cursor, search, mode, frequency, sort, order)
+    POST   /emails              create an email (a JSON object) or several (a list), all or nothing
+    PATCH  /emails              update several: a list of objects, each with the "id" to update
+    GET    /emails/<id>
+    PATCH  /emails/<id>         update the fields given, keeping the rest
+    DELETE /emails/<id>
+    POST   /emails/<id>/send    send now, ignoring the schedule
+
+Emails have the fields of bulk import/export (see bulk.FIELDS) plus the
+read-only id, last_sent, next_due_at and send_count. A page's next_cursor
+is passed back as ?cursor= for the following page. Writes go through the
+repositories and wake the scheduler straight away.
+
+Requests are served on background threads, one per client connection, on
+127.0.0.1 by default. With a token, every request must carry
+"Authorization: Bearer <token>".
+
+Attachments are references to stored contents ("sha256:<digest>/<filename>").
+Clients can't name files on the daemon's machine, except files inside the
+upload directory when one is configured (paths are taken relative to it).
+"""
+import base64
+import binascii
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from email_scheduler import bulk, metrics
+from email_scheduler.db import SORT_KEYS
+
+logger = logging.getLogger(__name__)
+
+# Emails per page of GET /emails unless ?limit= says otherwise, and the most allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Most emails created or updated by one request, and the largest request body
+MAX_BULK_EMAILS = bulk.CHUNK_SIZE
+MAX_BODY_BYTES = 16 * 1024 * 1024
+# Fields in responses that requests can't set
+READ_ONLY_FIELDS = ("id", "last_sent", "next_due_at", "send_count")
+
+API_REQUESTS = metrics.counter("api_requests", "HTTP API requests, by method and response status",
+                               ["method", "status"])
+
+
+class ApiError(Exception):
+    """Ends a request with this HTTP status; error is a message or a list of per-email errors."""
+
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+def email_to_json(email):
+    """The API representation of an Email."""
+    return dict(bulk.email_to_row(email), id=email.id, last_sent=email.last_sent,
+                next_due_at=email.next_due_at, send_count=email.send_count)
+
+
+def json_to_email(item, store, current=None, upload_dir=None):
+    """
+    Validate one request object into an Email, adding attached files from
+    upload_dir (None: none allowed) to the AttachmentRepository `store`; with
+    `current`, fields the object leaves out keep their current values.
+    Raises ValueError.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("each email must be a JSON object")
+    row = bulk.email_to_row(current) if current else {}
+    row.update((field, value) for field, value in item.items() if field not in READ_ONLY_FIELDS)
+    email = bulk.row_to_email(row, store, allow_paths=upload_dir is not None, upload_dir=upload_dir)
+    if current:
+        email.id, email.last_sent, email.send_count = current.id, current.last_sent, current.send_count
+    return email
+
+
+def _encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(cursor)).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(token):
+    if token is None:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, binascii.Error):
+        raise ApiError(400, "invalid cursor") from None
+    if not (isinstance(cursor, list) and len(cursor) == 2):
+        raise ApiError(400, "invalid cursor")
+    return tuple(cursor)
+
+
+def _param(query, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+
+class EmailApi:
+    """
+    The API's operations on the scheduler's emails. Each returns (HTTP
+    status, JSON payload or None) or raises ApiError.
+    """
+
+    def __init__(self, scheduler, upload_dir=None):
+        self.scheduler = scheduler
+        self.emails = scheduler.emails
+        self.attachment_store = scheduler.attachment_store
+        self.upload_dir = upload_dir
+
+    def list(self, query):
+        try:
+            limit = int(_param(query, "limit", DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise ApiError(400, "limit must be a whole number") from None
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ApiError(400, f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        sort = _param(query, "sort", "id")
+        if sort not in SORT_KEYS:
+            raise ApiError(400, f"sort must be one of {', '.join(SORT_KEYS)}")
+        order = _param(query, "order", "asc")
+        if order not in ("asc", "desc"):
+            raise ApiError(400, "order must be asc or desc")
+
+        emails, cursor = self.emails.page(
+            search=_param(query, "search"), mode=_param(query, "mode"), frequency=_param(query, "frequency"),
+            sort=sort, descending=order == "desc", after=_decode_cursor(_param(query, "cursor")), limit=limit
+        )
+        return 200, {"emails": [email_to_json(email) for email in emails], "next_cursor": _encode_cursor(cursor)}
+
+    def get(self, email_id):
+        return 200, email_to_json(self._existing(email_id))
+
+    def create(self, body):
+        """One email from an object, or every email of a list in one transaction."""
+        items = self._items(body)
+        emails = self._validate(items, [None] * len(items))
+        self.emails.add_many(emails)
+        self.scheduler.notify_changed(*(email.id for email in emails))
+        created = [email_to_json(email) for email in emails]
+        return 201, created if isinstance(body, list) else created[0]
+
+    def update(self, email_id, body):
+        current = self._existing(email_id)
+        (email,) = self._validate([body], [current])
+        self.emails.update(email)
+        self.scheduler.notify_changed(email_id)
+        return 200, email_to_json(email)
+
+    def update_many(self, body):
+        """Update every email of a list (objects with an "id") in one transaction."""
+        if not isinstance(body, list):
+            raise ApiError(400, "expected a list of emails, each with an id")
+        items = self._items(body)
+        ids = [item.get("id") if isinstance(item, dict) else None for item in items]
+        current = {email.id: email for email in self.emails.get_many(
+            email_id for email_id in ids if isinstance(email_id, int)
+        )}
+        missing = [
+            {"index": index, "error": "no email with this id" if isinstance(email_id, int) else "id is required"}
+            for index, email_id in enumerate(ids) if email_id not in current
+        ]
+        if missing:
+            raise ApiError(400, missing)
+        emails = self._validate(items, [current[email_id] for email_id in ids])
+        self.emails.update_many(emails)
+        self.scheduler.notify_changed(*ids)
+        return 200, [email_to_json(email) for email in emails]
+
+    def delete(self, email_id):
+        self._existing(email_id)
+        self.emails.delete(email_id)
+        self.scheduler.notify_changed(email_id)
+        return 204, None
+
+    def send(self, email_id):
+        """Send an email now, as the GUI's Send Now button does."""
+        email = self._existing(email_id)
+        try:
+            sent = self.scheduler.send_now(email)
+        except Exception as e:
+            raise ApiError(502, f"sending failed: {type(e).__name__}: {e}") from None
+        if not sent:
+            raise ApiError(409, "the email is already being sent")
+        return 200, email_to_json(self.emails.get(email_id))
+
+    def _existing(self, email_id):
+        email = self.emails.get(email_id)
+        if email is None:
+            raise ApiError(404, f"no email with id {email_id}")
+        return email
+
+    @staticmethod
+    def _items(body):
+        items = body if isinstance(body, list) else [body]
+        if not items:
+            raise ApiError(400, "no emails given")
+        if len(items) > MAX_BULK_EMAILS:
+            raise ApiError(400, f"at most {MAX_BULK_EMAILS} emails per request")
+        return items
+
+    def _validate(self, items, current):
+        """Build the Email for every item, or fail with the error of each invalid one."""
+        emails, errors = [], []
+        store = bulk.IngestOnce(self.attachment_store)
+        for index, (item, email) in enumerate(zip(items, current)):
+            try:
+                emails.append(json_to_email(item, store, email, self.upload_dir))
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
+        if errors:
+            raise ApiError(400, errors if len(items) > 1 else errors[0]["error"])
+        return emails
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so a client's requests share one thread (and its database connection)
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_PUT(self):
+        # Updates are PATCH (fields left out keep their values)
+        self._handle("PUT")
+
+    def _handle(self, method):
+        self._body_read = False
+        try:
+            self._check_token()
+            url = urlsplit(self.path)
+            status, payload = self._route(method, [part for part in url.path.split("/") if part],
+                                          parse_qs(url.query))
+        except ApiError as e:
+            status, payload = e.status, {"errors" if isinstance(e.error, list) else "error": e.error}
+        except Exception:
+            logger.exception("API request %s %s failed", method, self.path)
+            status, payload = 500, {"error": "internal error"}
+        API_REQUESTS.labels(method, str(status)).inc()
+        # An unread body would be taken for the next request, so the connection has to go
+        unread_body = not self._body_read and self.headers.get("Content-Length", "0") != "0"
+        self._respond(status, payload, close=unread_body)
+
+    def _route(self, method, parts, query):
+        api = self.server.api
+        if not parts or parts[0] != "emails" or len(parts) > 3:
+            raise ApiError(404, "not found")
+        if len(parts) == 1:
+            routes = {
+                "GET": lambda: api.list(query),
+                "POST": lambda: api.create(self._read_json()),
+                "PATCH": lambda: api.update_many(self._read_json()),
+            }
+        else:
+            if not parts[1].isdigit():
+                raise ApiError(404, "not found")
+            email_id = int(parts[1])
+            if len(parts) == 2:
+                routes = {
+                    "GET": lambda: api.get(email_id),
+                    "PATCH": lambda: api.update(email_id, self._read_json()),
+                    "DELETE": lambda: api.delete(email_id),
+                }
+            elif parts[2] == "send":
+                routes = {"POST": lambda: api.send(email_id)}
+            else:
+                raise ApiError(404, "not found")
+        if method not in routes:
+            raise ApiError(405, f"{method} is not allowed here")
+        return routes[method]()
+
+    def _check_token(self):
+        token = self.server.token
+        if token is None:
+            return
+        given = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(given.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            raise ApiError(401, "missing or wrong API token")
+
+    def _read_json(self):
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            raise ApiError(411, "Content-Length is required") from None
+        if length > MAX_BODY_BYTES:
+            raise ApiError(413, f"request body is over {MAX_BODY_BYTES} bytes")
+        data = self.rfile.read(length)
+        self._body_read = True
+        try:
+            return json.loads(data)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ApiError(400, f"invalid JSON: {e}") from None
+
+    def _respond(self, status, payload, close=False):
+        body = b"" if payload is None else (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.send_response(status)
+        if close:
+            self.send_header("Connection", "close")
+        if payload is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+class ApiServer:
+    """
+    Serves the API for a Scheduler on background threads (localhost only by
+    default). Attachments may be read from files in upload_dir, if given.
+    """
+
+    def __init__(self, scheduler, port, host="127.0.0.1", token=None, upload_dir=None):
+        self._server = ThreadingHTTPServer((host, port), _ApiHandler)
+        self._server.daemon_threads = True
+        self._server.api = EmailApi(scheduler, upload_dir)
+        self._server.token = token
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="api-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,239 @@
+import asyncio
+import ssl
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from email_scheduler.smtp_pool import SMTP_CONNECTIONS_OPENED, SMTP_SECONDS
+
+try:
+    import aiosmtplib
+except ImportError:  # optional: only the asyncio engine needs it
+    aiosmtplib = None
+
+# Close pooled connections that have not been used for this many seconds
+DEFAULT_IDLE_TIMEOUT = 120
+# Most connections open at once per SMTP settings row; sessions are cheap
+# coroutines here, so this is bounded by what the relay accepts, not by threads
+DEFAULT_MAX_CONNECTIONS_PER_KEY = 100
+# Seconds any single SMTP command (connect, login, send...) may take
+DEFAULT_COMMAND_TIMEOUT = 60
+# Errors meaning a relay couldn't take a message, so another relay may be tried
+RELAY_ERRORS = (aiosmtplib.SMTPException, OSError) if aiosmtplib else (OSError,)
+
+
+def available():
+    """Whether the asyncio engine can be used (aiosmtplib is installed)."""
+    return aiosmtplib is not None
+
+
+def recipients_refused(error):
+    """Whether an SMTP error was every recipient being refused (so another relay wouldn't help)."""
+    return aiosmtplib is not None and isinstance(error, aiosmtplib.SMTPRecipientsRefused)
+
+
+class AsyncSMTPPool:
+    """
+    The asyncio counterpart of SMTPConnectionPool: keeps authenticated
+    aiosmtplib sessions open between sends, keyed by the smtp_settings row.
+    Only used from the engine's event loop.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connections_per_key=DEFAULT_MAX_CONNECTIONS_PER_KEY,
+                 timeout=DEFAULT_COMMAND_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.max_connections_per_key = max_connections_per_key
+        self.timeout = timeout
+        self._idle = {}  # settings key -> list of (smtp, last_used)
+        self._slots = {}  # settings key -> semaphore bounding concurrent connections
+        self._tls_context = None  # loading the CA store is slow, so it's shared
+
+    @asynccontextmanager
+    async def connection(self, settings):
+        """
+        Yield a logged-in SMTP session for the given SMTPSettings. It goes back
+        to the pool afterwards, unless sending raised or was cancelled.
+        """
+        key = settings
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = asyncio.Semaphore(self.max_connections_per_key)
+        async with slot:
+            smtp = await self._acquire(key)
+            try:
+                yield smtp
+            except BaseException:
+                # The session may be half-way through a transaction; don't reuse it
+                self._abort(smtp)
+                raise
+            self._idle.setdefault(key, []).append((smtp, time.monotonic()))
+
+    async def close_idle(self):
+        """Close every pooled session that has been idle past the timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        for key in list(self._idle):
+            keep = []
+            for smtp, last_used in self._idle[key]:
+                (expired if last_used < cutoff else keep).append((smtp, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        for smtp, _ in expired:
+            await self._close(smtp)
+
+    async def close_all(self):
+        """Close every pooled session (e.g. when settings change or on shutdown)."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for smtp, _ in connections:
+                await self._close(smtp)
+
+    # ----------------------- internals -----------------------
+    async def _acquire(self, key):
+        connections = self._idle.get(key)
+        while connections:
+            smtp, _ = connections.pop()
+            if await self._is_alive(smtp):
+                return smtp
+            self._abort(smtp)
+        return await self._open(key)
+
+    async def _open(self, settings):
+        if settings.encryption in ("SSL", "STARTTLS") and self._tls_context is None:
+            self._tls_context = ssl.create_default_context()
+        smtp = aiosmtplib.SMTP(
+            hostname=settings.server,
+            port=int(settings.port),
+            use_tls=settings.encryption == "SSL",
+            start_tls=settings.encryption == "STARTTLS",
+            tls_context=self._tls_context,
+            timeout=self.timeout
+        )
+        SMTP_CONNECTIONS_OPENED.inc()
+        # aiosmtplib's connect() includes the STARTTLS upgrade
+        with SMTP_SECONDS.labels("connect").time():
+            await smtp.connect()
+        try:
+            with SMTP_SECONDS.labels("login").time():
+                await smtp.login(settings.email, settings.password)
+        except BaseException:
+            self._abort(smtp)
+            raise
+        return smtp
+
+    @staticmethod
+    async def _is_alive(smtp):
+        """Check a pooled session with NOOP, and RSET any leftover transaction."""
+        try:
+            return (await smtp.noop()).code == 250 and (await smtp.rset()).code == 250
+        except (aiosmtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    async def _close(smtp):
+        try:
+            await smtp.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            smtp.close()
+
+    @staticmethod
+    def _abort(smtp):
+        smtp.close()
+
+
+class AsyncEngine:
+    """
+    Runs an asyncio event loop on one background thread and sends on it, so
+    hundreds of SMTP sessions can be in progress at once without a thread
+    each. The blocking scheduler code hands coroutines over with run() and
+    run_all() and waits for their results.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connections_per_key=DEFAULT_MAX_CONNECTIONS_PER_KEY,
+                 timeout=DEFAULT_COMMAND_TIMEOUT):
+        if aiosmtplib is None:
+            raise RuntimeError("The asyncio engine needs aiosmtplib (pip install aiosmtplib)")
+        self.smtp_pool = AsyncSMTPPool(idle_timeout, max_connections_per_key, timeout)
+        self.loop = asyncio.new_event_loop()
+        self._sends = set()  # tasks sending right now, cancelled by shutdown()
+        # Once set, nothing new is handed to the loop (it may stop before running it)
+        self._closing = False
+        self._closing_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, name="async-engine", daemon=True)
+        self._thread.start()
+
+    def run(self, coro):
+        """Run a coroutine on the engine's loop and return its result (blocks the caller)."""
+        return asyncio.run_coroutine_threadsafe(self._tracked([coro]), self.loop).result()[0]
+
+    def run_all(self, func, items, on_cancel):
+        """
+        Await func(item) for every item concurrently and return the results in
+        order. An item whose send shutdown() cancelled before it could handle
+        the cancellation, or that came in once shutdown had begun, gets
+        on_cancel(item) instead.
+        """
+        with self._closing_lock:
+            if self._closing:
+                return [on_cancel(item) for item in items]
+            future = asyncio.run_coroutine_threadsafe(
+                self._tracked([func(item) for item in items], return_exceptions=True), self.loop
+            )
+        results = future.result()
+        for index, result in enumerate(results):
+            if isinstance(result, asyncio.CancelledError):
+                results[index] = on_cancel(items[index])
+            elif isinstance(result, BaseException):
+                raise result
+        return results
+
+    def close_connections(self):
+        """Close every pooled SMTP session (e.g. after the settings changed)."""
+        if not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.smtp_pool.close_all(), self.loop)
+
+    def shutdown(self):
+        """Cancel every send in progress, close the sessions and stop the loop."""
+        with self._closing_lock:
+            if self._closing:
+                return
+            self._closing = True
+            future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        future.result()
+        self._thread.join()
+
+    # ----------------------- internals -----------------------
+    async def _tracked(self, coros, return_exceptions=False):
+        tasks = [self.loop.create_task(coro) for coro in coros]
+        self._sends.update(tasks)
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+        finally:
+            self._sends.difference_update(tasks)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        reaper = self.loop.create_task(self._reap_loop())
+        self.loop.run_forever()
+        reaper.cancel()
+        self.loop.run_until_complete(asyncio.gather(reaper, return_exceptions=True))
+        self.loop.close()
+
+    async def _reap_loop(self):
+        """Close idle sessions every so often while the loop runs."""
+        while True:
+            await asyncio.sleep(max(self.smtp_pool.idle_timeout / 2, 1))
+            await self.smtp_pool.close_idle()
+
+    async def _shutdown(self):
+        sends = list(self._sends)
+        for task in sends:
+            task.cancel()
+        # Let the cancelled sends unwind (closing their sessions) before the loop stops
+        await asyncio.gather(*sends, return_exceptions=True)
+        await self.smtp_pool.close_all()
+        self.loop.call_soon(self.loop.stop)
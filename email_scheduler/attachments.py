@@ -0,0 +1,176 @@
+import base64
+import hashlib
+import mimetypes
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from email.message import MIMEPart
+
+from email_scheduler import metrics
+
+# Total size of encoded attachments kept in memory
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# Raw bytes encoded per step; a multiple of 57 so each step yields whole 76-char base64 lines
+CHUNK_SIZE = 57 * 16 * 1024
+# Files at least this big are memory-mapped rather than read
+MMAP_THRESHOLD = 8 * 1024 * 1024
+# Base64 read back from the store per step when streaming a payload into a message (whole lines)
+STREAM_CHUNK_SIZE = 77 * 16 * 1024
+
+ENCODE_SECONDS = metrics.histogram("attachment_encode_seconds", "Time to hash and base64-encode a file on ingest")
+CACHE_LOOKUPS = metrics.counter("attachment_cache_lookups", "Attachment cache lookups", ["result"])
+
+
+class EncodedAttachment:
+    """
+    The headers needed to attach a file, and its base64 payload in wire
+    format (CRLF line endings): bytes, or a function returning it in chunks
+    for payloads streamed from the store on every send.
+    """
+
+    def __init__(self, filename, mime_type, size, payload):
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size = size  # bytes of the wire-format payload
+        self.payload = payload
+        self.streamed = callable(payload)
+
+    def to_mime_part(self):
+        """The MIME part's headers; recipients.split_message() marks where the payload goes."""
+        part = MIMEPart()
+        part["Content-Type"] = self.mime_type
+        part["Content-Disposition"] = "attachment"
+        part.set_param("filename", self.filename, header="Content-Disposition")
+        part["Content-Transfer-Encoding"] = "base64"
+        return part
+
+    def chunks(self):
+        return self.payload() if self.streamed else (self.payload,)
+
+
+def encoded_length(size, line_ending=b"\n"):
+    """Length of the base64 encoding of size bytes in 76-character lines, each ending in line_ending."""
+    full_lines, rest = divmod(size, 57)
+    length = full_lines * (76 + len(line_ending))
+    if rest:
+        length += (rest + 2) // 3 * 4 + len(line_ending)
+    return length
+
+
+def to_crlf(chunks):
+    """Stored base64 chunks ("\n" line endings) in wire format."""
+    for chunk in chunks:
+        yield chunk.replace(b"\n", b"\r\n")
+
+
+@ENCODE_SECONDS.time()
+def encode_file(path, write=None):
+    """
+    Read a file once, hashing it and, with write, passing it to write()
+    base64-encoded, chunk by chunk (in 76-character lines ending in "\n"), so
+    neither the raw bytes nor the encoding is ever held in memory all at once
+    (large files are memory-mapped instead of read). Returns (sha256 hex
+    digest, size). Raises OSError, also if the file changes size meanwhile.
+    """
+    digest = hashlib.sha256()
+    read = 0
+
+    def add(chunk):
+        nonlocal read
+        read += len(chunk)
+        digest.update(chunk)
+        if write is not None:
+            write(base64.encodebytes(chunk))
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start in range(0, size, CHUNK_SIZE):
+                    add(data[start:start + CHUNK_SIZE])
+        else:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                if read + len(chunk) > size:
+                    break
+                add(chunk)
+    if read != size or os.stat(path).st_size != size:
+        raise OSError(f"{path} changed while it was being read")
+    return digest.hexdigest(), size
+
+
+def hash_and_encode(path):
+    """encode_file() collecting the whole payload: (sha256 hex digest, size, base64 text). Raises OSError."""
+    pieces = []
+    digest, size = encode_file(path, lambda encoded: pieces.append(encoded.decode("ascii")))
+    return digest, size, "".join(pieces)
+
+
+def guess_mime_type(filename):
+    """Guess the MIME type from the filename, defaulting to binary."""
+    mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or "application/octet-stream"
+
+
+class AttachmentCache:
+    """
+    LRU cache of encoded attachment payloads keyed by content digest, bounded
+    by their total size. Contents never change under a digest, so entries
+    never go stale, and every email attaching the same file shares one.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # digest -> wire-format base64 payload
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}  # digest -> lock held while that payload is being loaded
+
+    def get(self, digest, load):
+        """The payload for digest, calling load(digest) on a miss; None if load finds nothing."""
+        with self._lock:
+            payload = self._lookup(digest)
+            if payload is not None:
+                CACHE_LOOKUPS.labels("hit").inc()
+                return payload
+            key_lock = self._key_locks.setdefault(digest, threading.Lock())
+
+        # Only one thread loads a given payload; the others wait and reuse it
+        with key_lock:
+            with self._lock:
+                payload = self._lookup(digest)
+            if payload is not None:
+                return payload
+
+            CACHE_LOOKUPS.labels("miss").inc()
+            try:
+                payload = load(digest)
+                if payload is not None:
+                    with self._lock:
+                        self._store(digest, payload)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(digest, None)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    # ----------------------- internals (self._lock held) -----------------------
+    def _lookup(self, digest):
+        payload = self._entries.get(digest)
+        if payload is not None:
+            self._entries.move_to_end(digest)
+        return payload
+
+    def _store(self, digest, payload):
+        size = len(payload)
+        if size > self.max_bytes:
+            return  # too big to cache; the caller still gets it
+        self._entries[digest] = payload
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= len(evicted)
@@ -0,0 +1,299 @@
+"""
+Streaming bulk import and export of the emails table as CSV or JSONL.
+
+Both directions work chunk by chunk (rows are read, validated and inserted
+CHUNK_SIZE at a time, one transaction per chunk; export pages through the
+table with keyset pagination), so memory use doesn't grow with file size.
+
+Attachments are given as file paths, which are copied into the attachment
+store on import, or as references to contents already stored,
+"sha256:<digest>/<filename>", which is what export writes.
+"""
+import csv
+import json
+import os
+
+from email_scheduler.db import Attachment, Email
+from email_scheduler.misfire import MISFIRE_POLICIES
+from email_scheduler.schedule import FREQUENCIES, parse_interval, validate_schedule
+
+FORMATS = ("csv", "jsonl")
+# Rows validated and inserted per transaction (or read per page when exporting)
+CHUNK_SIZE = 5000
+# Columns of an import/export file, in order. interval is "30s", "15m", "2h", "1d",
+# or a whole number of minutes; attachments is a list (JSON) or ";"-separated paths and
+# references; per_recipient is true/false; smtp_profile_id is blank for any profile;
+# misfire_policy and misfire_cap are blank for the defaults; month_day is the day a
+# Monthly email repeats on, blank for the day it is first due; templated (true/false,
+# blank for false) says whether {{ placeholders }} in subject and body are filled in
+FIELDS = ("subject", "recipients", "body", "mode", "frequency", "interval", "schedule_time",
+          "attachments", "per_recipient", "recurrence", "timezone", "template_data", "smtp_profile_id",
+          "misfire_policy", "misfire_cap", "month_day", "templated")
+MODES = ("Time", "Interval")
+TRUE_VALUES = ("1", "true", "yes", "y")
+FALSE_VALUES = ("", "0", "false", "no", "n")
+# Older files had a single attachment_path column; it is read as attachments
+LEGACY_FIELDS = {"attachment_path": "attachments"}
+# Separates the attachments in a CSV cell; entries starting with the prefix are stored contents
+ATTACHMENT_SEPARATOR = ";"
+STORED_ATTACHMENT_PREFIX = "sha256:"
+
+
+class IngestOnce:
+    """
+    Wraps an AttachmentRepository so each file path is read and stored only
+    once, however many rows of an import (or emails of a request) attach it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._ingested = {}  # path -> Attachment
+
+    def ingest(self, path):
+        attachment = self._ingested.get(path)
+        if attachment is None:
+            attachment = self._ingested[path] = self.store.ingest(path)
+        return Attachment(attachment.filename, attachment.digest)
+
+    def stored(self, digests):
+        return self.store.stored(digests)
+
+
+def guess_format(path):
+    """The format implied by a file name's extension, or None."""
+    extension = os.path.splitext(path)[1].lower()
+    return {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(extension)
+
+
+def row_to_email(row, store, allow_paths=True, upload_dir=None):
+    """
+    Validate one import row (a dict of FIELDS) and build its Email, adding
+    attached files to the AttachmentRepository `store` (see
+    parse_attachments() for which files may be read). Raises ValueError.
+    """
+    row = {LEGACY_FIELDS.get(field, field): value for field, value in row.items()}
+    unknown = set(row) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(map(str, unknown)))}")
+    values = {field: _text(row.get(field)) for field in FIELDS if field != "attachments"}
+
+    if not values["subject"]:
+        raise ValueError("subject is required")
+    if not values["recipients"]:
+        raise ValueError("recipients is required")
+    mode = values["mode"]
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+
+    interval_seconds = None
+    if mode == "Interval":
+        try:
+            interval_seconds = parse_interval(values["interval"])
+        except ValueError:
+            raise ValueError("interval must be a whole number of minutes, or e.g. 30s, 15m, 2h") from None
+    elif values["frequency"] not in FREQUENCIES:
+        raise ValueError(f"frequency must be one of {', '.join(FREQUENCIES)}")
+
+    error = validate_schedule(mode, values["frequency"], values["schedule_time"], values["recurrence"],
+                              values["timezone"])
+    if error:
+        raise ValueError(error)
+
+    template_data = values["template_data"]
+    if template_data and not os.path.isfile(template_data):
+        raise ValueError(f"template data file not found: {template_data}")
+
+    per_recipient = values["per_recipient"].lower()
+    if per_recipient not in TRUE_VALUES + FALSE_VALUES:
+        raise ValueError("per_recipient must be true or false")
+    templated = values["templated"].lower()
+    if templated not in TRUE_VALUES + FALSE_VALUES:
+        raise ValueError("templated must be true or false")
+
+    smtp_profile_id = values["smtp_profile_id"]
+    if smtp_profile_id and not smtp_profile_id.isdigit():
+        raise ValueError("smtp_profile_id must be a profile id, or blank for any profile")
+
+    misfire_policy = values["misfire_policy"]
+    if misfire_policy and misfire_policy not in MISFIRE_POLICIES:
+        raise ValueError(f"misfire_policy must be one of {', '.join(MISFIRE_POLICIES)}")
+    misfire_cap = values["misfire_cap"]
+    if misfire_cap and not (misfire_cap.isdigit() and int(misfire_cap) > 0):
+        raise ValueError("misfire_cap must be a positive whole number")
+    month_day = values["month_day"]
+    if month_day and not (month_day.isdigit() and 1 <= int(month_day) <= 31):
+        raise ValueError("month_day must be a day of the month, 1 to 31")
+
+    # Last, so files aren't stored for a row that is rejected anyway
+    attachments = parse_attachments(row.get("attachments"), store, allow_paths, upload_dir)
+
+    return Email(
+        subject=values["subject"],
+        recipients=values["recipients"],
+        body=values["body"],
+        mode=mode,
+        frequency=(values["frequency"] or None) if mode == "Time" else None,
+        interval_seconds=interval_seconds,
+        schedule_time=(values["schedule_time"] or None) if mode == "Time" else None,
+        attachments=attachments,
+        per_recipient=per_recipient in TRUE_VALUES,
+        recurrence=values["recurrence"] or None,
+        timezone=values["timezone"] or None,
+        template_data=template_data or None,
+        smtp_profile_id=int(smtp_profile_id) if smtp_profile_id else None,
+        misfire_policy=misfire_policy or None,
+        misfire_cap=int(misfire_cap) if misfire_cap else None,
+        month_day=int(month_day) if month_day else None,
+        templated=templated in TRUE_VALUES
+    )
+
+
+def email_to_row(email):
+    """The export row (a dict of FIELDS) for an Email; attachments is a list of references."""
+    return {
+        "subject": email.subject,
+        "recipients": email.recipients,
+        "body": email.body,
+        "mode": email.mode,
+        "frequency": email.frequency or "",
+        "interval": f"{email.interval_seconds}s" if email.interval_seconds else "",
+        "schedule_time": email.schedule_time or "",
+        "attachments": [f"{STORED_ATTACHMENT_PREFIX}{attachment.digest}/{attachment.filename}"
+                        for attachment in email.attachments],
+        "per_recipient": "true" if email.per_recipient else "false",
+        "recurrence": email.recurrence or "",
+        "timezone": email.timezone or "",
+        "template_data": email.template_data or "",
+        "smtp_profile_id": "" if email.smtp_profile_id is None else str(email.smtp_profile_id),
+        "misfire_policy": email.misfire_policy or "",
+        "misfire_cap": "" if email.misfire_cap is None else str(email.misfire_cap),
+        "month_day": "" if email.month_day is None else str(email.month_day),
+        "templated": "true" if email.templated else "false",
+    }
+
+
+def parse_attachments(value, store, allow_paths=True, upload_dir=None):
+    """
+    The Attachments for an attachments value: a list, or text separated by
+    ATTACHMENT_SEPARATOR, of file paths (added to the AttachmentRepository
+    `store`) and stored references. Without allow_paths only references are
+    accepted; with an upload_dir, paths are relative to it and must stay
+    inside it. Raises ValueError.
+    """
+    entries = value if isinstance(value, list) else _text(value).split(ATTACHMENT_SEPARATOR)
+    attachments, references = [], []
+    for entry in map(_text, entries):
+        if not entry:
+            continue
+        if entry.startswith(STORED_ATTACHMENT_PREFIX):
+            digest, _, filename = entry[len(STORED_ATTACHMENT_PREFIX):].partition("/")
+            if not filename:
+                raise ValueError(f"attachment reference must be sha256:<digest>/<filename>: {entry}")
+            attachments.append(Attachment(filename, digest))
+            references.append(digest)
+            continue
+        if not allow_paths:
+            raise ValueError(f"attachments must be references to stored contents, "
+                             f"{STORED_ATTACHMENT_PREFIX}<digest>/<filename>: {entry}")
+        path = _upload_path(upload_dir, entry) if upload_dir else entry
+        if not os.path.isfile(path):
+            raise ValueError(f"attachment not found: {entry}")
+        try:
+            attachments.append(store.ingest(path))
+        except OSError as e:
+            raise ValueError(f"attachment can't be read: {entry} ({e.strerror})") from None
+    missing = set(references) - store.stored(references)
+    if missing:
+        raise ValueError(f"attachment not in the store: sha256:{', sha256:'.join(sorted(missing))}")
+    return attachments
+
+
+def _upload_path(upload_dir, path):
+    # Symlinks and ".." are resolved first, so neither can point outside the directory
+    root = os.path.realpath(upload_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"attachment is outside the upload directory: {path}")
+    return resolved
+
+
+def _text(value):
+    # JSON numbers and booleans are accepted where the CSV would have text
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).strip()
+
+
+# ======================= IMPORT =========================
+def read_rows(file, fmt):
+    """Yield (line number, row dict) from an open text file, one row at a time."""
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            # Extra cells beyond the header come back under the None key
+            if None in row:
+                row["(extra cells)"] = row.pop(None)
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, ValueError(f"invalid JSON: {e.msg}")
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError("each line must be a JSON object")
+
+
+def import_emails(emails, store, file, fmt, on_error=None, chunk_size=CHUNK_SIZE):
+    """
+    Import schedules from an open text file in the given format into the
+    EmailRepository `emails`, their attachments into the AttachmentRepository
+    `store`. Valid rows are inserted chunk_size per
+    transaction; each invalid row is reported as on_error(line number,
+    message) and skipped. Returns (imported, rejected) counts.
+    """
+    imported = rejected = 0
+    chunk = []
+    store = IngestOnce(store)
+    for line_number, row in read_rows(file, fmt):
+        try:
+            if isinstance(row, Exception):
+                raise row
+            chunk.append(row_to_email(row, store))
+        except ValueError as e:
+            rejected += 1
+            if on_error:
+                on_error(line_number, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            imported += emails.add_many(chunk)
+            chunk = []
+    if chunk:
+        imported += emails.add_many(chunk)
+    return imported, rejected
+
+
+# ======================= EXPORT =========================
+def export_emails(emails, file, fmt, chunk_size=CHUNK_SIZE):
+    """Write every email to an open text file in the given format, page by page. Returns the count."""
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+    exported = 0
+    cursor = None
+    while True:
+        page, cursor = emails.page(after=cursor, limit=chunk_size)
+        for email in page:
+            row = email_to_row(email)
+            if writer:
+                writer.writerow(dict(row, attachments=ATTACHMENT_SEPARATOR.join(row["attachments"])))
+            else:
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        exported += len(page)
+        if cursor is None:
+            return exported
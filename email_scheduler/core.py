@@ -0,0 +1,750 @@
+import asyncio
+import logging
+import os
+import random
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from email.message import EmailMessage, MIMEPart  # For adding attachments easily
+
+from email_scheduler import async_engine, metrics
+from email_scheduler.async_engine import AsyncEngine
+from email_scheduler.attachments import AttachmentCache, EncodedAttachment, encoded_length, guess_mime_type, to_crlf
+from email_scheduler.db import (
+    AttachmentRepository, EmailRepository, OutboxRepository, RateLimitRepository, SendLogEntry, SendLogRepository,
+    SMTPSettingsRepository
+)
+from email_scheduler.dispatch import DispatchPool
+from email_scheduler.misfire import BacklogDrain
+from email_scheduler.ratelimit import RateLimiter, RateLimitStopped
+from email_scheduler.recipients import (
+    BODY_MARKER, DEFAULT_RCPT_BATCH_SIZE, UNDISCLOSED_RECIPIENTS, encode_body, header_line, is_streamed,
+    message_chunks, message_size, personalize, rcpt_batches, split_at_body, split_message, split_recipients
+)
+from email_scheduler.recurrence import get_zone
+from email_scheduler.retention import RetentionJob
+from email_scheduler.routing import RELAY_FAILOVERS, RelayRouter
+from email_scheduler.schedule import to_epoch
+from email_scheduler.smtp_pool import SMTP_SECONDS, SMTPConnectionPool
+from email_scheduler.templates import DataFileCache, TemplateCache, recipient_variables
+from email_scheduler.timer import DueTimer
+
+logger = logging.getLogger(__name__)
+
+# Longest the scheduler sleeps when nothing is due soon (guards against clock changes)
+MAX_IDLE_SECONDS = 300
+# Rebuild the in-memory timer from the database this often, to pick up
+# schedules changed by other processes sharing the database
+TIMER_RESYNC_SECONDS = 300
+# Failed sends are retried after RETRY_BASE_SECONDS, doubling each time up to
+# RETRY_MAX_SECONDS (with jitter), and given up on after MAX_SEND_ATTEMPTS
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+MAX_SEND_ATTEMPTS = 8
+# Seconds a pooled SMTP connection may sit unused before it is closed
+SMTP_IDLE_TIMEOUT_SECONDS = 120
+# Most simultaneous connections (and therefore sends) per SMTP server
+SMTP_CONNECTIONS_PER_SERVER = 4
+# Seconds an SMTP connect, command or write may block before the send fails
+# (and is retried) rather than holding its worker and lease indefinitely
+SMTP_TIMEOUT_SECONDS = 60
+# Worker threads used to send due emails in parallel
+DISPATCH_WORKERS = 8
+# Sending engines: "threads" (smtplib on the dispatch pool) or "asyncio"
+# (aiosmtplib on one event loop, if installed)
+ENGINES = ("threads", "asyncio")
+DEFAULT_ENGINE = "threads"
+# With the asyncio engine: most simultaneous sessions per SMTP server, and
+# the timeout for each SMTP command
+ASYNC_CONNECTIONS_PER_SERVER = 100
+ASYNC_COMMAND_TIMEOUT_SECONDS = 60
+# Outbox entries sent per batch: one DB transaction and one UI refresh each
+DISPATCH_BATCH_SIZE = 500
+# How long a worker's claim on outbox entries lasts; renewed while it is still sending
+LEASE_SECONDS = 300
+# Memory allowed for cached, already-encoded attachments, and the largest
+# payload cached; bigger ones are streamed from the store on every send
+ATTACHMENT_CACHE_BYTES = 64 * 1024 * 1024
+MAX_CACHED_ATTACHMENT_BYTES = 1024 * 1024
+# Most recipients per SMTP envelope (RCPT TO commands per message)
+RCPT_BATCH_SIZE = DEFAULT_RCPT_BATCH_SIZE
+# Catch-up sends for runs missed while no scheduler was running are spread
+# over this many seconds, so a restart doesn't flood the relay
+BACKLOG_DRAIN_SECONDS = 300
+
+TICK_SECONDS = metrics.histogram("tick_seconds", "Duration of check_schedules()")
+EMAILS_DUE = metrics.counter("emails_due", "Due emails read by check_schedules() (an index range scan, "
+                                           "so every row read was due)")
+EMAILS_TRACKED = metrics.gauge("emails_tracked", "Emails with a future send in the in-memory due timer")
+OUTBOX_CLAIMED = metrics.counter("outbox_claimed", "Outbox entries leased for sending")
+QUEUE_DEPTH = metrics.gauge("queue_depth", "Outbox entries pending, in flight or awaiting a retry")
+SENDS = metrics.counter("sends", "Outbox sends by outcome", ["result"])
+SEND_FAILURES = metrics.counter("send_failures", "Failed sends by exception type", ["exception"])
+SEND_SECONDS = metrics.histogram("send_seconds", "Time to send one email (compose, quota wait and SMTP)")
+COMPOSE_SECONDS = metrics.histogram("compose_seconds", "Time to build and encode one message")
+RATE_LIMIT_WAITING = metrics.gauge("rate_limit_waiting", "Sends currently waiting for quota")
+RATE_LIMIT_THROTTLED = metrics.gauge("rate_limit_throttled", "Sends that have had to wait for quota")
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the given number of failed attempts: exponential, with jitter."""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    # Spread retries out so failures after an outage don't all hit the relay at once
+    return random.uniform(delay / 2, delay)
+
+
+class Scheduler:
+    """
+    The scheduling engine: moves due emails into the outbox, sends what the
+    outbox has ready and records the results. Runs headless (see __main__) or
+    inside the GUI.
+
+    on_sent, if given, is called from a worker thread with the ids of each
+    batch of emails that were sent, e.g. so a UI can refresh those rows.
+
+    engine picks how sends run (see ENGINES). "asyncio" falls back to
+    "threads" when aiosmtplib isn't installed.
+
+    drain_window is the seconds over which the sends that catch up on
+    missed runs are spread (see email_scheduler.misfire); 0 sends them all
+    at once.
+    """
+
+    def __init__(self, database, on_sent=None, engine=DEFAULT_ENGINE, drain_window=BACKLOG_DRAIN_SECONDS):
+        self.emails = EmailRepository(database)
+        self.smtp_settings = SMTPSettingsRepository(database)
+        self.outbox = OutboxRepository(database)
+        self.rate_limits = RateLimitRepository(database)
+        self.send_log = SendLogRepository(database)
+        self.attachment_store = AttachmentRepository(database)
+        self.on_sent = on_sent
+        # Identifies this scheduler's leases among every process using the database
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # Flag to stop the scheduling loop
+        self.stop_scheduling = False
+        # Set whenever a schedule changes so the scheduling loop wakes up early
+        self.schedule_changed = threading.Event()
+        # Upcoming next_due_at of every email, so the loop sleeps until exactly the next one
+        self.due_timer = DueTimer()
+        self.timer_synced_at = None
+        # Reuses logged-in SMTP sessions across sends
+        self.smtp_pool = SMTPConnectionPool(
+            idle_timeout=SMTP_IDLE_TIMEOUT_SECONDS,
+            max_connections_per_key=SMTP_CONNECTIONS_PER_SERVER,
+            timeout=SMTP_TIMEOUT_SECONDS
+        )
+        # Sends due emails in parallel
+        self.dispatch_pool = DispatchPool(max_workers=DISPATCH_WORKERS)
+        # Multiplexes sends on one event loop instead (None with the threads engine)
+        self.async_engine = None
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}; expected one of {', '.join(ENGINES)}")
+        if engine == "asyncio":
+            if async_engine.available():
+                self.async_engine = AsyncEngine(
+                    idle_timeout=SMTP_IDLE_TIMEOUT_SECONDS,
+                    max_connections_per_key=ASYNC_CONNECTIONS_PER_SERVER,
+                    timeout=ASYNC_COMMAND_TIMEOUT_SECONDS
+                )
+            else:
+                logger.warning("aiosmtplib is not installed; using the threads engine")
+        # Encoded attachment payloads from the store, shared by every send of the same contents
+        self.attachment_cache = AttachmentCache(max_bytes=ATTACHMENT_CACHE_BYTES)
+        # Compiled subject/body templates and loaded template data files
+        self.template_cache = TemplateCache()
+        self.data_files = DataFileCache()
+        # Keeps each SMTP account under its per-minute/per-hour quota
+        self.rate_limiter = RateLimiter(self.rate_limits.load())
+        # Cached SMTP profiles, ordered per send by health and load
+        self.relays = RelayRouter(self.smtp_settings.list)
+        # Paces the sends of runs missed while no scheduler was running
+        self.backlog_drain = BacklogDrain(drain_window)
+        # Rolls old send history up into hourly/daily totals while the loop runs
+        self.retention = RetentionJob(database)
+        self.scheduling_thread = None
+
+        # Read at scrape time, so they cost nothing between scrapes
+        QUEUE_DEPTH.set_function(lambda: self.stats()["queue_depth"])
+        EMAILS_TRACKED.set_function(lambda: len(self.due_timer))
+        RATE_LIMIT_WAITING.set_function(lambda: self.rate_limiter.waiting)
+        RATE_LIMIT_THROTTLED.set_function(lambda: self.rate_limiter.throttled)
+
+    # ======================= LIFECYCLE =========================
+    def start(self):
+        """Run the scheduling loop on a background daemon thread."""
+        self.scheduling_thread = threading.Thread(target=self.run, daemon=True)
+        self.scheduling_thread.start()
+
+    def run(self):
+        """Send due emails, then sleep until the next one is due, until stop() is called."""
+        self.retention.start()
+        while not self.stop_scheduling:
+            self.schedule_changed.clear()
+            if self.timer_synced_at is None or time.monotonic() - self.timer_synced_at >= TIMER_RESYNC_SECONDS:
+                self.sync_timer()
+            self.check_schedules()
+            # Wake up early if a schedule is added, edited or deleted
+            self.schedule_changed.wait(self.seconds_until_next_due())
+
+    def stop(self):
+        """Ask the loop to exit after the current batch and release connections."""
+        self.stop_scheduling = True
+        self.schedule_changed.set()
+        self.retention.stop()
+        # Sends waiting on a quota give up (and are retried after a restart)
+        self.rate_limiter.close()
+        self.dispatch_pool.shutdown()
+        if self.async_engine:
+            self.async_engine.shutdown()
+        self.smtp_pool.close_all()
+        self.rate_limits.save(self.rate_limiter.state())
+
+    def notify_changed(self, *email_ids):
+        """
+        Tell the loop these emails were added, edited or deleted (or, with no
+        ids, that anything may have changed), so it re-reads their due times
+        and wakes up if one is now earlier.
+        """
+        if email_ids:
+            self.due_timer.update(self.emails.due_times(email_ids))
+        else:
+            self.sync_timer()
+        self.schedule_changed.set()
+
+    def sync_timer(self):
+        """Rebuild the in-memory timer from every email's next_due_at."""
+        self.due_timer.rebuild(self.emails.due_times())
+        # Also pick up SMTP profiles changed by other processes sharing the database
+        self.relays.invalidate()
+        self.timer_synced_at = time.monotonic()
+
+    def settings_changed(self):
+        """Reload the SMTP profiles and drop connections logged in with the old settings."""
+        self.relays.invalidate()
+        self.smtp_pool.close_all()
+        if self.async_engine:
+            self.async_engine.close_connections()
+
+    def stats(self):
+        """
+        Outbox queue depth and state counts, rate-limit counters (for sizing
+        quotas) and the health of each SMTP profile.
+        """
+        outbox = self.outbox.counts()
+        queue_depth = outbox["pending"] + outbox["in_flight"] + outbox["failed"]
+        return dict(self.rate_limiter.stats(), queue_depth=queue_depth, outbox=outbox, relays=self.relays.stats())
+
+    # ======================= SCHEDULING =========================
+    def seconds_until_next_due(self):
+        """How long the scheduling loop can sleep before an email or a retry is due."""
+        due = [at for at in (self.due_timer.next_due(), self.outbox.next_attempt_at()) if at is not None]
+        if not due:
+            return MAX_IDLE_SECONDS
+        return min(max(min(due) - time.time(), 0), MAX_IDLE_SECONDS)
+
+    @TICK_SECONDS.time()
+    def check_schedules(self):
+        """Queue every email whose next_due_at has passed, then drain the outbox batch by batch."""
+        now = datetime.now()
+        now_epoch = int(now.timestamp())
+        if not self.backlog_drain.active(now_epoch):
+            backlog = self.outbox.count_backlog(now)
+            if backlog:
+                self.backlog_drain.plan(now_epoch, backlog)
+                logger.info("Catching up on %d missed runs over %ds", backlog, self.backlog_drain.window)
+        while True:
+            due_times = self.outbox.enqueue_due(now, DISPATCH_BATCH_SIZE, self.backlog_drain)
+            EMAILS_DUE.inc(len(due_times))
+            self.due_timer.update(due_times)
+            if len(due_times) < DISPATCH_BATCH_SIZE:
+                break
+
+        throttled_before = self.rate_limiter.throttled
+        while not self.stop_scheduling:
+            now_epoch = int(time.time())
+            batch = self.outbox.claim_ready(self.worker_id, now_epoch, now_epoch + LEASE_SECONDS,
+                                            DISPATCH_BATCH_SIZE, self.message_id_domain())
+            if not batch:
+                break
+            OUTBOX_CLAIMED.inc(len(batch))
+            self.send_batch(batch)
+
+        if self.rate_limiter.throttled > throttled_before:
+            stats = self.rate_limiter.stats()
+            logger.info("Rate limited: %d messages waited for quota (%.1fs total so far)",
+                        stats["throttled"] - throttled_before, stats["throttle_seconds"])
+
+    def send_batch(self, batch):
+        """
+        Send a batch of leased outbox entries in parallel, then write every
+        outcome back in one transaction and notify on_sent once.
+        """
+        for entry, _ in batch:
+            if entry.state == "in_flight":
+                logger.warning("Taking over email (ID: %s) from a worker whose lease expired; "
+                               "resending with the same Message-ID", entry.email_id)
+
+        # Send in parallel; the SMTP pool caps how many run against one server
+        with self.leases_renewed([entry.id for entry, _ in batch]):
+            if self.async_engine:
+                results = self.async_engine.run_all(self.send_entry_async, batch, on_cancel=self.interrupted)
+            else:
+                results = self.dispatch_pool.run_all(self.send_entry, batch, on_cancel=self.interrupted)
+
+        sent, failed, interrupted, send_log = [], [], [], []
+        for entry, email, sent_at, error, log in results:
+            if log:
+                send_log.append(log)
+            if sent_at:
+                sent.append((entry, sent_at))
+            elif error is None:
+                interrupted.append(entry.id)
+            else:
+                failed.append((entry, error, self.retry_at(entry, email, error)))
+        SENDS.labels("sent").inc(len(sent))
+        SENDS.labels("failed").inc(len(failed))
+        SENDS.labels("interrupted").inc(len(interrupted))
+        self.outbox.record_results(self.worker_id, sent, failed, send_log)
+        if interrupted:
+            self.outbox.release(self.worker_id, interrupted)
+        self.rate_limits.save(self.rate_limiter.state())
+
+        if sent and self.on_sent:
+            self.on_sent([entry.email_id for entry, _ in sent])
+
+    @contextmanager
+    def leases_renewed(self, entry_ids):
+        """Keep this worker's leases on entry_ids alive while the block runs."""
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(LEASE_SECONDS / 3):
+                self.outbox.renew_leases(self.worker_id, entry_ids, int(time.time()) + LEASE_SECONDS)
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            done.set()
+            renewer.join()
+
+    def retry_at(self, entry, email, error):
+        """When to retry a failed entry (epoch seconds), or None to give up on it."""
+        attempts = entry.attempts + 1
+        if email is None or attempts >= MAX_SEND_ATTEMPTS:
+            logger.error("Giving up on email (ID: %s) after %d attempts: %s", entry.email_id, attempts, error)
+            return None
+        delay = retry_delay(attempts)
+        logger.warning("Send of email (ID: %s) failed (attempt %d), retrying in %.0fs: %s",
+                       entry.email_id, attempts, delay, error)
+        return int(time.time() + delay)
+
+    def send_entry(self, item):
+        """
+        Worker: send one outbox entry. Returns (entry, email, sent_at, error,
+        send log entry): sent_at on success, error text on failure, and
+        neither (nor a log entry) if shutdown interrupted it before anything
+        was sent.
+        """
+        entry, email = item
+        if email is None:
+            SEND_FAILURES.labels("EmailDeleted").inc()
+            return entry, email, None, "Email was deleted", None
+        log = SendLogEntry(entry.email_id)
+        try:
+            with SEND_SECONDS.time():
+                self.send_email(email.subject, email.recipients, email.body, email.attachments,
+                                per_recipient=email.per_recipient, message_id=entry.message_id,
+                                context=self.template_context(email), data_file=email.template_data,
+                                profile_id=email.smtp_profile_id, log=log, templated=email.templated)
+            return entry, email, datetime.now(), None, self.finish_log(log)
+        except RateLimitStopped:
+            return self.interrupted(item)
+        except Exception as e:
+            SEND_FAILURES.labels(type(e).__name__).inc()
+            error = f"{type(e).__name__}: {e}"
+            return entry, email, None, error, self.finish_log(log, error)
+
+    async def send_entry_async(self, item):
+        """send_entry() for the asyncio engine."""
+        entry, email = item
+        if email is None:
+            SEND_FAILURES.labels("EmailDeleted").inc()
+            return entry, email, None, "Email was deleted", None
+        log = SendLogEntry(entry.email_id)
+        try:
+            with SEND_SECONDS.time():
+                await self.send_email_async(email.subject, email.recipients, email.body, email.attachments,
+                                            per_recipient=email.per_recipient, message_id=entry.message_id,
+                                            context=self.template_context(email),
+                                            data_file=email.template_data, profile_id=email.smtp_profile_id,
+                                            log=log, templated=email.templated)
+            return entry, email, datetime.now(), None, self.finish_log(log)
+        except (RateLimitStopped, asyncio.CancelledError):
+            return self.interrupted(item)
+        except Exception as e:
+            SEND_FAILURES.labels(type(e).__name__).inc()
+            error = f"{type(e).__name__}: {e}"
+            return entry, email, None, error, self.finish_log(log, error)
+
+    @staticmethod
+    def interrupted(item):
+        """send_entry()'s result for an entry that shutdown stopped before anything was sent."""
+        entry, email = item
+        return entry, email, None, None, None
+
+    @staticmethod
+    def finish_log(log, error=None):
+        """Stamp a send log entry with the time the attempt ended (and its error)."""
+        log.sent_at = int(time.time())
+        log.error = error
+        return log
+
+    def send_now(self, email):
+        """
+        Send an email immediately, ignoring its schedule, and record it as sent.
+        Returns False if it is already being sent; raises if sending fails.
+        """
+        now_epoch = int(time.time())
+        # Don't race any scheduler: the send is leased like a scheduled one
+        claimed = self.outbox.claim_email(email.id, self.worker_id, now_epoch, now_epoch + LEASE_SECONDS,
+                                          self.message_id_domain())
+        if not claimed:
+            return False
+        entry, created = claimed
+
+        log = SendLogEntry(email.id)
+        try:
+            # A manual send counts against the quota but isn't held back by it
+            self.send_email(email.subject, email.recipients, email.body, email.attachments,
+                            per_recipient=email.per_recipient, throttle=False, message_id=entry.message_id,
+                            context=self.template_context(email), data_file=email.template_data,
+                            profile_id=email.smtp_profile_id, log=log, templated=email.templated)
+        except Exception as e:
+            SEND_FAILURES.labels(type(e).__name__).inc()
+            error = f"{type(e).__name__}: {e}"
+            # A queued send that was pulled forward goes back to its retry schedule
+            retry_at = None if created else self.retry_at(entry, email, error)
+            self.outbox.record_results(self.worker_id, [], [(entry, error, retry_at)],
+                                       [self.finish_log(log, error)])
+            raise
+
+        sent_at = datetime.now()
+        SENDS.labels("sent").inc()
+        # The next due time counts from this send, written with it in one transaction
+        email.last_sent = sent_at.isoformat()
+        email.next_due_at = to_epoch(email.compute_next_due(sent_at))
+        self.outbox.record_results(self.worker_id, [(entry, sent_at)], [], [self.finish_log(log)],
+                                   next_due={email.id: email.next_due_at})
+        self.notify_changed(email.id)
+        return True
+
+    def template_context(self, email=None):
+        """
+        Variables for subject/body templates, besides the per-recipient ones
+        (recipient, recipient_name, data.*): the date and time in the email's
+        time zone, and for an email its id and which send this is.
+        """
+        now = datetime.now(get_zone(email.timezone) if email and email.timezone else None)
+        context = {
+            "date": now.strftime("%Y-%m-%d"),
+            "time": now.strftime("%H:%M"),
+            "weekday": now.strftime("%A"),
+            "month": now.strftime("%B"),
+            "year": now.year,
+        }
+        if email:
+            context.update(email_id=email.id, send_number=email.send_count + 1)
+        return context
+
+    def message_id_domain(self):
+        """Domain for generated Message-IDs: the first SMTP profile's, else this host's."""
+        profiles = self.relays.profiles()
+        settings = profiles[0] if profiles else None
+        domain = settings.email.rpartition("@")[2] if settings and settings.email else ""
+        return domain or socket.gethostname()
+
+    # ======================= ACTUAL EMAIL SENDING LOGIC (WITH ATTACHMENT) =========================
+    def send_email(self, subject, recipients, body, attachments=(), per_recipient=False,
+                   throttle=True, message_id=None, context=None, data_file=None, profile_id=None, log=None,
+                   templated=False):
+        """
+        Sends the email through the SMTP profile profile_id, or the best one
+        of the pool (with any attachments). If a relay fails, the rest of
+        the send fails over to the next candidate (see RelayRouter).
+
+        Shared emails go out in envelopes of at most RCPT_BATCH_SIZE
+        recipients; per_recipient emails send each address its own copy (so
+        nobody sees the other addresses). Everything goes over one pooled
+        connection.
+
+        Each message takes a token from the account's rate limiter; with
+        throttle=True, sending waits (without holding a connection) whenever
+        the quota is used up.
+
+        message_id, if given, is used as the Message-ID header so a resend of
+        the same outbox entry can be recognised as a duplicate.
+
+        With templated=True, subject and body are templates (see
+        email_scheduler.templates), rendered with context (default:
+        template_context()) and the rows of data_file; otherwise they are
+        sent as they are.
+
+        log, a SendLogEntry, if given, is filled in with the relay used, the
+        bytes sent, the SMTP time and the server's last reply.
+
+        With the asyncio engine this hands the send to its event loop and waits.
+        """
+        if self.async_engine:
+            return self.async_engine.run(self.send_email_async(
+                subject, recipients, body, attachments, per_recipient, throttle, message_id,
+                context, data_file, profile_id, log, templated
+            ))
+
+        args = (subject, recipients, body, attachments, per_recipient, message_id, context, data_file, templated)
+        candidates = self.relays.candidates(profile_id)
+        if not candidates:
+            raise ValueError("SMTP settings not configured!")
+        delivered = 0
+        for number, settings in enumerate(candidates, 1):
+            envelopes, render = self.compose(settings, *args)
+            # Envelopes an earlier relay delivered aren't sent again
+            for _ in range(delivered):
+                envelopes.popleft()
+            remaining = len(envelopes)
+            self.relays.begin(settings)
+            try:
+                self._deliver(settings, envelopes, render, subject, throttle, log)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                if isinstance(e, smtplib.SMTPRecipientsRefused) or number == len(candidates):
+                    raise
+                self._fail_over(settings, e)
+            finally:
+                self.relays.finish(settings)
+                delivered += remaining - len(envelopes)
+
+    def _deliver(self, settings, envelopes, render, subject, throttle, log=None):
+        """Send envelopes through one relay, removing each from the deque once it is delivered."""
+        try:
+            while envelopes:
+                # Wait for quota before taking a connection, never while holding one
+                self.rate_limiter.acquire(settings, wait=throttle)
+                # Reuse a pooled, already-authenticated connection for these settings
+                with self.smtp_pool.connection(settings) as smtp:
+                    while True:
+                        envelope, address = envelopes[0]
+                        pieces = render(address)
+                        started = time.perf_counter()
+                        with SMTP_SECONDS.labels("send").time():
+                            refused = smtp.sendmail_chunks(settings.email, envelope, message_chunks(pieces))
+                        elapsed = time.perf_counter() - started
+                        self.relays.record_success(settings, elapsed)
+                        if log:
+                            log.add_message(settings.id, elapsed, message_size(pieces), smtp.data_reply)
+                        envelopes.popleft()
+                        if refused:
+                            logger.warning("Recipients refused for %r: %s", subject, ", ".join(refused))
+                        if not envelopes:
+                            break
+                        if not throttle:
+                            self.rate_limiter.acquire(settings, wait=False)
+                        elif not self.rate_limiter.try_acquire(settings):
+                            break  # out of quota: hand the connection back while waiting
+        except (smtplib.SMTPException, OSError) as e:
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                self.relays.record_failure(settings)
+            if log:
+                log.relay_id = settings.id
+            raise
+
+    async def send_email_async(self, subject, recipients, body, attachments=(), per_recipient=False,
+                               throttle=True, message_id=None, context=None, data_file=None, profile_id=None,
+                               log=None, templated=False):
+        """send_email() on the asyncio engine's loop, over aiosmtplib sessions."""
+        args = (subject, recipients, body, attachments, per_recipient, message_id, context, data_file, templated)
+        candidates = self.relays.candidates(profile_id)
+        if not candidates:
+            raise ValueError("SMTP settings not configured!")
+        delivered = 0
+        for number, settings in enumerate(candidates, 1):
+            if attachments or (templated and data_file):
+                # Loading what the caches haven't seen would stall every other send on the loop
+                envelopes, render = await asyncio.to_thread(self.compose, settings, *args)
+            else:
+                envelopes, render = self.compose(settings, *args)
+            for _ in range(delivered):
+                envelopes.popleft()
+            remaining = len(envelopes)
+            self.relays.begin(settings)
+            try:
+                await self._deliver_async(settings, envelopes, render, subject, throttle, log)
+                return
+            except async_engine.RELAY_ERRORS as e:
+                if async_engine.recipients_refused(e) or number == len(candidates):
+                    raise
+                self._fail_over(settings, e)
+            finally:
+                self.relays.finish(settings)
+                delivered += remaining - len(envelopes)
+
+    async def _deliver_async(self, settings, envelopes, render, subject, throttle, log=None):
+        """_deliver() over the asyncio engine's sessions."""
+        pool = self.async_engine.smtp_pool
+        try:
+            while envelopes:
+                await self.rate_limiter.acquire_async(settings, wait=throttle)
+                async with pool.connection(settings) as smtp:
+                    while True:
+                        envelope, address = envelopes[0]
+                        pieces = render(address)
+                        if is_streamed(pieces):
+                            # aiosmtplib only sends whole messages; read the payloads off the loop
+                            data = await asyncio.to_thread(b"".join, message_chunks(pieces))
+                        else:
+                            data = b"".join(message_chunks(pieces))
+                        started = time.perf_counter()
+                        with SMTP_SECONDS.labels("send").time():
+                            refused, reply = await smtp.sendmail(settings.email, envelope, data)
+                        elapsed = time.perf_counter() - started
+                        self.relays.record_success(settings, elapsed)
+                        if log:
+                            log.add_message(settings.id, elapsed, len(data), reply)
+                        envelopes.popleft()
+                        if refused:
+                            logger.warning("Recipients refused for %r: %s", subject, ", ".join(refused))
+                        if not envelopes:
+                            break
+                        if not throttle:
+                            self.rate_limiter.acquire(settings, wait=False)
+                        elif not self.rate_limiter.try_acquire(settings):
+                            break  # out of quota: hand the session back while waiting
+        except async_engine.RELAY_ERRORS as e:
+            if not async_engine.recipients_refused(e):
+                self.relays.record_failure(settings)
+            if log:
+                log.relay_id = settings.id
+            raise
+
+    @staticmethod
+    def _fail_over(settings, error):
+        RELAY_FAILOVERS.inc()
+        logger.warning("SMTP profile %r failed (%s: %s); failing over to the next one",
+                       settings.name, type(error).__name__, error)
+
+    @COMPOSE_SECONDS.time()
+    def compose(self, settings, subject, recipients, body, attachments=(), per_recipient=False,
+                message_id=None, context=None, data_file=None, templated=False):
+        """
+        Build and encode a message sent from the SMTP profile `settings`, once
+        for every engine. Returns (envelopes, render): a deque of (recipient
+        list, address) envelopes, where address is set for per_recipient
+        copies, and render(address) giving an envelope's message as pieces
+        (see recipients.split_message()).
+
+        With templated, subject and body are rendered here: once for the whole
+        send, or once per recipient if they use recipient variables and the
+        email is per_recipient.
+        """
+        recipient_list = split_recipients(recipients)
+        batches = list(rcpt_batches(recipient_list, RCPT_BATCH_SIZE))
+        if per_recipient:
+            envelopes = deque(([address], address) for address in recipient_list)
+        else:
+            envelopes = deque((batch, None) for batch in batches)
+
+        # Attachments come pre-encoded from the store (small ones from the cache)
+        attachments = [self.encoded_attachment(attachment) for attachment in attachments]
+
+        subject_template = self.template_cache.get(subject) if templated else None
+        body_template = self.template_cache.get(body) if templated else None
+        if subject_template or body_template:
+            context = dict(context if context is not None else self.template_context())
+            data_rows = self.data_files.get(data_file) if data_file else None
+            if per_recipient and any(t and t.per_recipient for t in (subject_template, body_template)):
+                return envelopes, self._per_recipient_renderer(
+                    settings, subject, body, subject_template, body_template, context, data_rows,
+                    attachments, message_id
+                )
+            if len(recipient_list) == 1:
+                # A single recipient can be addressed personally on a shared message too
+                context.update(recipient_variables(recipient_list[0], data_rows))
+            subject = subject_template.render(context) if subject_template else subject
+            body = body_template.render(context) if body_template else body
+
+        # Build an EmailMessage, explicitly specifying UTF-8 text:
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = settings.email
+        if message_id:
+            msg["Message-ID"] = message_id
+        if not per_recipient:
+            # A list too long for one envelope is not spelled out in every copy
+            msg["To"] = recipients if len(batches) <= 1 else UNDISCLOSED_RECIPIENTS
+        # The line below ensures the body is plain text, UTF-8
+        msg.set_content(body, subtype='plain', charset='utf-8')
+
+        if attachments:
+            msg.make_mixed()
+
+        pieces = split_message(msg, attachments)
+        return envelopes, lambda address: personalize(pieces, address) if address else pieces
+
+    def encoded_attachment(self, attachment):
+        """
+        The EncodedAttachment for an email's Attachment: small payloads from
+        the cache, bigger ones streamed from the store whenever they are sent.
+        """
+        digest = attachment.digest
+        size = self.attachment_store.stored_size(digest)
+        if size is None:
+            raise ValueError(f"Attachment {attachment.filename} is missing from the attachment store")
+        wire_size = encoded_length(size, b"\r\n")
+        if wire_size <= MAX_CACHED_ATTACHMENT_BYTES:
+            payload = self.attachment_cache.get(
+                digest, lambda digest: b"".join(to_crlf(self.attachment_store.read_payload(digest)))
+            )
+        else:
+            def payload():
+                return to_crlf(self.attachment_store.read_payload(digest))
+        return EncodedAttachment(attachment.filename, guess_mime_type(attachment.filename), wire_size, payload)
+
+    @staticmethod
+    def _per_recipient_renderer(settings, subject, body, subject_template, body_template, context, data_rows,
+                                attachments, message_id):
+        """
+        render(address) for a per-recipient template. Everything but the To:
+        and Subject: lines and the body is serialized once; each copy only
+        renders its text and base64-encodes its own body.
+        """
+        msg = EmailMessage()
+        msg["From"] = settings.email
+        if message_id:
+            msg["Message-ID"] = message_id
+        text_part = msg
+        if attachments:
+            msg.make_mixed()
+            text_part = MIMEPart()
+        else:
+            msg["MIME-Version"] = "1.0"
+        text_part["Content-Type"] = 'text/plain; charset="utf-8"'
+        text_part["Content-Transfer-Encoding"] = "base64"
+        text_part.set_payload(BODY_MARKER)
+        if attachments:
+            msg.attach(text_part)
+        head, tail = split_at_body(split_message(msg, attachments))
+
+        def render(address):
+            variables = dict(context, **recipient_variables(address, data_rows))
+            rendered_subject = subject_template.render(variables) if subject_template else subject
+            rendered_body = body_template.render(variables) if body_template else body
+            return [header_line("To", address), header_line("Subject", rendered_subject),
+                    *head, encode_body(rendered_body), *tail]
+        return render
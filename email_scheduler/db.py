@@ -0,0 +1,1309 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from email.utils import make_msgid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from email_scheduler import metrics
+from email_scheduler.attachments import STREAM_CHUNK_SIZE, encode_file, encoded_length, hash_and_encode
+from email_scheduler.misfire import DEFAULT_MISFIRE_POLICY, MISFIRE_GRACE_SECONDS, plan_runs
+from email_scheduler.recurrence import get_zone
+from email_scheduler.schedule import anchor_date, compute_next_due, to_epoch
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = "scheduler.db"
+
+# Wait this long for another connection's write lock before "database is locked"
+BUSY_TIMEOUT_MS = 5000
+# Per-connection cache of compiled statements (the SQL below is all constant strings)
+STATEMENT_CACHE_SIZE = 256
+# Stay under SQLite's bound-parameter limit for "id IN (...)" queries
+MAX_IDS_PER_QUERY = 900
+# PRAGMA auto_vacuum value for incremental mode, and pages released per incremental step
+AUTO_VACUUM_INCREMENTAL = 2
+VACUUM_PAGES_PER_STEP = 1000
+
+QUERY_SECONDS = metrics.histogram("db_query_seconds", "Time spent in repository calls, by call", ["query"])
+
+
+@dataclass
+class Attachment:
+    """A file attached to an email: its name and the sha256 of its contents in the attachment store."""
+    filename: str
+    digest: str
+
+
+@dataclass
+class Email:
+    """One row of the emails table."""
+    subject: str
+    recipients: str
+    body: str
+    mode: str                              # "Time" or "Interval"
+    frequency: Optional[str] = None        # "Once", "Daily", "Weekly", "Monthly", "Custom" (Time mode)
+    interval_seconds: Optional[int] = None # Interval mode
+    schedule_time: Optional[str] = None    # "HH:MM" (Time mode)
+    attachments: List[Attachment] = field(default_factory=list)  # in order
+    last_sent: Optional[str] = None        # ISO datetime
+    next_due_at: Optional[int] = None      # epoch seconds, None = never due
+    per_recipient: bool = False            # send each recipient their own copy
+    recurrence: Optional[str] = None       # RRULE or cron rule ("Custom" frequency)
+    timezone: Optional[str] = None         # IANA name for Time mode, None = local time
+    template_data: Optional[str] = None    # CSV/JSONL file with per-recipient {{ data.* }} values
+    send_count: int = 0                    # successful sends so far
+    smtp_profile_id: Optional[int] = None  # send through this SMTP profile only, None = any (pool)
+    misfire_policy: Optional[str] = None   # one of misfire.MISFIRE_POLICIES, None = the default
+    misfire_cap: Optional[int] = None      # most missed runs sent by "fire_all", None = the default
+    month_day: Optional[int] = None        # day a Monthly email repeats on (the last day in shorter months)
+    templated: bool = False                # fill in {{ placeholders }} in the subject and body when sending
+    id: Optional[int] = None
+
+    def compute_next_due(self, now=None, last_sent=None):
+        """
+        Next due time for this email after its current last_sent (or the
+        given one). Weekly keeps repeating on the weekday of the current
+        next_due_at, Monthly on month_day.
+        """
+        return compute_next_due(self.mode, self.frequency, self.interval_seconds, self.schedule_time,
+                                last_sent or self.last_sent, now, self.recurrence, self.timezone,
+                                self.next_due_at, self.month_day)
+
+    def settle_month_day(self):
+        """
+        Fix month_day for a Monthly email that has none (from the day it
+        repeats from now), and clear it for other schedules.
+        """
+        if self.mode != "Time" or self.frequency != "Monthly":
+            self.month_day = None
+        elif self.month_day is None:
+            try:
+                self.month_day = anchor_date(self.last_sent, self.next_due_at, timezone=self.timezone).day
+            except ValueError:
+                # Unknown time zone: never due anyway
+                pass
+
+
+@dataclass
+class OutboxEntry:
+    """One row of the outbox: a single scheduled send and its delivery state."""
+    id: int
+    email_id: int
+    state: str                             # one of OUTBOX_STATES
+    attempts: int                          # failed attempts so far
+    due_at: int                            # epoch seconds the send was scheduled for
+    next_attempt_at: Optional[int]         # epoch seconds, None once sent or dead
+    last_error: Optional[str] = None
+    message_id: Optional[str] = None       # fixed once first claimed, reused by every attempt
+
+
+@dataclass
+class SendLogEntry:
+    """One row of send_log: an attempt to send an email, successful or not."""
+    email_id: int
+    sent_at: int = 0                       # epoch seconds the attempt finished
+    response: Optional[str] = None         # the server's reply to the last message, e.g. "2.0.0 Ok: queued"
+    latency_ms: int = 0                    # time spent in SMTP sends
+    bytes: int = 0                         # message bytes handed to the relay
+    relay_id: Optional[int] = None         # smtp_settings id of the (last) relay used
+    error: Optional[str] = None            # None if the send succeeded
+    id: Optional[int] = None
+
+    def add_message(self, relay_id, seconds, size, response):
+        """Account for one message handed to a relay."""
+        self.relay_id = relay_id
+        self.latency_ms += round(seconds * 1000)
+        self.bytes += size
+        self.response = response
+
+
+@dataclass(frozen=True)
+class SMTPSettings:
+    """One smtp_settings row (an SMTP profile). Frozen so it can key the SMTP connection pool."""
+    id: int
+    server: str
+    port: int
+    email: str
+    password: str
+    encryption: str                        # "SSL", "STARTTLS" or "NONE"
+    max_per_minute: Optional[int] = None   # sending quotas, None = unlimited
+    max_per_hour: Optional[int] = None
+    name: Optional[str] = None             # unique label shown in the GUI
+
+
+# Sort orders for the paginated list: name -> SQL expression (never NULL, so
+# (expression, id) row values can be compared for keyset pagination)
+SORT_KEYS = {
+    "id": "id",
+    "subject": "IFNULL(subject, '')",
+    "next_due": "IFNULL(next_due_at, 9223372036854775807)",  # never due sorts last
+}
+
+# Outbox states: pending -> in_flight -> sent, or -> failed (retried with backoff) -> ... -> dead.
+# "skipped" records a missed run that the email's misfire policy didn't send
+OUTBOX_STATES = ("pending", "in_flight", "sent", "failed", "dead", "skipped")
+# States whose send hasn't finished; an email has one entry in them at most, except
+# for the missed runs of a "fire_all" catch-up
+OUTBOX_OPEN_STATES = "('pending', 'in_flight', 'failed')"
+# States the dispatcher picks up (must match the partial index below)
+OUTBOX_READY_STATES = "('pending', 'failed')"
+# States an entry stays in for good; only the retention job deletes them
+OUTBOX_FINISHED_STATES = "('sent', 'dead', 'skipped')"
+
+# (emails.attachment_path is no longer read: attachments live in email_attachments)
+EMAIL_COLUMNS = """id, subject, recipients, body, mode, frequency, interval_seconds,
+                   schedule_time, last_sent, next_due_at, per_recipient,
+                   recurrence, timezone, template_data, send_count, smtp_profile_id,
+                   misfire_policy, misfire_cap, month_day, templated"""
+
+SEND_LOG_COLUMNS = "email_id, sent_at, response, latency_ms, bytes, relay_id, error"
+
+SMTP_COLUMNS = "id, server, port, email, password, encryption, max_per_minute, max_per_hour, name"
+
+
+def _row_to_email(row):
+    (email_id, subject, recipients, body, mode, frequency, interval_seconds,
+     schedule_time, last_sent, next_due_at, per_recipient,
+     recurrence, timezone, template_data, send_count, smtp_profile_id,
+     misfire_policy, misfire_cap, month_day, templated) = row
+    return Email(subject, recipients, body, mode, frequency, interval_seconds,
+                 schedule_time, [], last_sent, next_due_at,
+                 bool(per_recipient), recurrence, timezone, template_data, send_count,
+                 smtp_profile_id, misfire_policy, misfire_cap, month_day, bool(templated), email_id)
+
+
+def _load_attachments(conn, emails):
+    """Fill in the attachments of these emails (queried in chunks); returns them."""
+    by_id = {}
+    for email in emails:
+        # The same email can appear more than once (several outbox entries)
+        by_id.setdefault(email.id, []).append(email)
+    email_ids = list(by_id)
+    for start in range(0, len(email_ids), MAX_IDS_PER_QUERY):
+        chunk = email_ids[start:start + MAX_IDS_PER_QUERY]
+        placeholders = ",".join("?" * len(chunk))
+        for email_id, filename, digest in conn.execute(f"""
+            SELECT email_id, filename, digest FROM email_attachments
+            WHERE email_id IN ({placeholders}) ORDER BY email_id, position
+        """, chunk):
+            for email in by_id[email_id]:
+                email.attachments.append(Attachment(filename, digest))
+    return emails
+
+
+def _link_attachments(conn, email):
+    # Each reference counts towards its blob's refcount; a blob that isn't
+    # stored (never ingested, or already collected) can't be referenced
+    for attachment in email.attachments:
+        updated = conn.execute("UPDATE attachment_blobs SET refcount = refcount + 1 WHERE digest=?",
+                               (attachment.digest,)).rowcount
+        if not updated:
+            raise ValueError(f"Attachment {attachment.filename} is not in the attachment store")
+    conn.executemany("""
+        INSERT INTO email_attachments (email_id, position, filename, digest) VALUES (?, ?, ?, ?)
+    """, [(email.id, position, attachment.filename, attachment.digest)
+          for position, attachment in enumerate(email.attachments)])
+
+
+def _unlink_attachments(conn, email_id):
+    conn.execute("""
+        UPDATE attachment_blobs SET refcount = refcount -
+            (SELECT COUNT(*) FROM email_attachments a WHERE a.email_id = ? AND a.digest = attachment_blobs.digest)
+        WHERE digest IN (SELECT digest FROM email_attachments WHERE email_id = ?)
+    """, (email_id, email_id))
+    conn.execute("DELETE FROM email_attachments WHERE email_id=?", (email_id,))
+
+
+def _store_blob(conn, digest, size, payload):
+    # Contents already stored are kept as they are (same digest, same bytes); only
+    # stored_at is reset, so an unreferenced blob isn't collected just as it is reused
+    conn.execute("""
+        INSERT INTO attachment_blobs (digest, size, stored_at, payload) VALUES (?, ?, ?, ?)
+        ON CONFLICT(digest) DO UPDATE SET stored_at = excluded.stored_at
+    """, (digest, size, int(time.time()), payload))
+
+
+# ======================= MIGRATIONS =========================
+def _column_names(conn, table):
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _migrate_base_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS smtp_settings (
+            id INTEGER PRIMARY KEY,
+            server TEXT,
+            port INTEGER,
+            email TEXT,
+            password TEXT,
+            encryption TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS emails (
+            id INTEGER PRIMARY KEY,
+            subject TEXT,
+            recipients TEXT,
+            body TEXT,
+            mode TEXT,            -- "Time" or "Interval"
+            frequency TEXT,       -- "Once", "Daily", "Weekly", "Monthly" (for "Time" mode)
+            interval_minutes INTEGER, -- number of minutes for "Interval" mode
+            schedule_time TEXT,   -- "HH:MM" for "Time" mode
+            last_sent TEXT        -- store last sent datetime (ISO format)
+        )
+    """)
+
+
+def _migrate_attachment_path(conn):
+    # Databases from before versioned migrations may already have this column
+    if 'attachment_path' not in _column_names(conn, "emails"):
+        conn.execute("ALTER TABLE emails ADD COLUMN attachment_path TEXT")
+
+
+def _migrate_next_due_at(conn):
+    if 'next_due_at' not in _column_names(conn, "emails"):
+        conn.execute("ALTER TABLE emails ADD COLUMN next_due_at INTEGER")
+    now = datetime.now()
+    rows = conn.execute("""
+        SELECT id, mode, frequency, interval_minutes, schedule_time, last_sent FROM emails
+    """).fetchall()
+    updates = []
+    for email_id, mode, frequency, interval_minutes, schedule_time, last_sent in rows:
+        next_due = _legacy_next_due(mode, frequency, interval_minutes, schedule_time, last_sent, now)
+        updates.append((next_due and int(next_due.timestamp()), email_id))
+    conn.executemany("UPDATE emails SET next_due_at=? WHERE id=?", updates)
+    # Index so the scheduler only touches rows that are actually due
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_next_due_at ON emails(next_due_at)")
+
+
+def _legacy_next_due(mode, frequency, interval_minutes, schedule_time, last_sent, now):
+    # The schedule these rows were written for, counted from last_sent, frozen
+    # here so later changes to compute_next_due() can't move upgraded emails
+    try:
+        last_sent_dt = datetime.fromisoformat(last_sent) if last_sent else None
+    except ValueError:
+        last_sent_dt = None
+    if mode == "Interval":
+        if not interval_minutes or interval_minutes <= 0:
+            return None
+        return last_sent_dt + timedelta(minutes=interval_minutes) if last_sent_dt else now
+    if mode != "Time" or not schedule_time:
+        return None
+    try:
+        hour, minute = map(int, schedule_time.split(":"))
+        scheduled_today = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        return None
+    if not last_sent_dt:
+        return scheduled_today if frequency in ("Once", "Daily", "Weekly", "Monthly") else None
+    if frequency == "Daily":
+        return (last_sent_dt + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if frequency in ("Weekly", "Monthly"):
+        # 7/30 days after the last send, no earlier than the scheduled clock time
+        earliest = last_sent_dt + timedelta(days=7 if frequency == "Weekly" else 30)
+        return max(earliest, earliest.replace(hour=hour, minute=minute, second=0, microsecond=0))
+    return None
+
+
+def _migrate_list_sort_indexes(conn):
+    # Back the keyset-paginated schedule list; expressions must match SORT_KEYS
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_emails_due_order ON emails({SORT_KEYS['next_due']}, id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_emails_subject_order ON emails({SORT_KEYS['subject']}, id)")
+
+
+def _migrate_per_recipient(conn):
+    conn.execute("ALTER TABLE emails ADD COLUMN per_recipient INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_rate_limits(conn):
+    conn.execute("ALTER TABLE smtp_settings ADD COLUMN max_per_minute INTEGER")
+    conn.execute("ALTER TABLE smtp_settings ADD COLUMN max_per_hour INTEGER")
+    # Token-bucket state per sending account, so a restart doesn't reset the budget
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            account TEXT NOT NULL,     -- "<login email>@<server>"
+            window TEXT NOT NULL,      -- "minute" or "hour"
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,  -- epoch seconds
+            PRIMARY KEY (account, window)
+        )
+    """)
+
+
+def _migrate_outbox(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            email_id INTEGER NOT NULL,
+            state TEXT NOT NULL,          -- see OUTBOX_STATES
+            attempts INTEGER NOT NULL DEFAULT 0,
+            due_at INTEGER NOT NULL,      -- epoch seconds the send was scheduled for
+            next_attempt_at INTEGER,      -- epoch seconds; NULL once sent or dead
+            last_error TEXT,
+            sent_at TEXT                  -- ISO datetime
+        )
+    """)
+    # One row per attempt, so every failure's error text is kept
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_attempts (
+            id INTEGER PRIMARY KEY,
+            outbox_id INTEGER NOT NULL,
+            attempted_at TEXT NOT NULL,   -- ISO datetime
+            error TEXT                    -- NULL if the attempt succeeded
+        )
+    """)
+    # The dispatcher's queue, in order; only unfinished rows are indexed
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox(next_attempt_at, id)
+        WHERE state IN {OUTBOX_READY_STATES}
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_email ON outbox(email_id, state)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_attempts ON outbox_attempts(outbox_id)")
+
+
+def _migrate_outbox_leases(conn):
+    # Which worker is sending an in_flight entry, and until when
+    conn.execute("ALTER TABLE outbox ADD COLUMN lease_owner TEXT")
+    conn.execute("ALTER TABLE outbox ADD COLUMN lease_expires_at INTEGER")
+    conn.execute("ALTER TABLE outbox ADD COLUMN message_id TEXT")
+    conn.execute("ALTER TABLE outbox_attempts ADD COLUMN worker TEXT")
+    # Lets workers find in_flight entries whose lease has run out
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_leases ON outbox(lease_expires_at)
+        WHERE state = 'in_flight'
+    """)
+
+
+def _migrate_recurrence(conn):
+    conn.execute("ALTER TABLE emails ADD COLUMN recurrence TEXT")
+    conn.execute("ALTER TABLE emails ADD COLUMN timezone TEXT")
+
+
+def _migrate_interval_seconds(conn):
+    # Intervals are stored in seconds from now on; interval_minutes is no longer read
+    conn.execute("ALTER TABLE emails ADD COLUMN interval_seconds INTEGER")
+    conn.execute("UPDATE emails SET interval_seconds = interval_minutes * 60 WHERE interval_minutes IS NOT NULL")
+
+
+def _migrate_templates(conn):
+    conn.execute("ALTER TABLE emails ADD COLUMN template_data TEXT")
+    conn.execute("ALTER TABLE emails ADD COLUMN send_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        UPDATE emails SET send_count =
+            (SELECT COUNT(*) FROM outbox WHERE outbox.email_id = emails.id AND outbox.state = 'sent')
+    """)
+
+
+def _migrate_smtp_profiles(conn):
+    # smtp_settings held a single row; it becomes the first of any number of named profiles
+    conn.execute("ALTER TABLE smtp_settings ADD COLUMN name TEXT")
+    conn.execute("UPDATE smtp_settings SET name = IFNULL(NULLIF(email, ''), 'Default')")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_smtp_settings_name ON smtp_settings(name)")
+    conn.execute("ALTER TABLE emails ADD COLUMN smtp_profile_id INTEGER")
+
+
+def _migrate_misfire_policy(conn):
+    conn.execute("ALTER TABLE emails ADD COLUMN misfire_policy TEXT")
+    conn.execute("ALTER TABLE emails ADD COLUMN misfire_cap INTEGER")
+
+
+def _migrate_send_log(conn):
+    # Append-only history of every send attempt; integer columns keep rows small
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS send_log (
+            id INTEGER PRIMARY KEY,
+            email_id INTEGER NOT NULL,
+            sent_at INTEGER NOT NULL,     -- epoch seconds
+            response TEXT,
+            latency_ms INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            relay_id INTEGER,             -- smtp_settings.id
+            error TEXT                    -- NULL if the send succeeded
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_send_log_sent_at ON send_log(sent_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_send_log_email ON send_log(email_id, sent_at)")
+    # Old send_log rows rolled up per hour (UTC), and old hours per day; relay_id 0 = unknown
+    for table, period in (("send_stats_hourly", "hour"), ("send_stats_daily", "day")):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {period} INTEGER NOT NULL,  -- epoch seconds at the start of the {period}
+                relay_id INTEGER NOT NULL,
+                sends INTEGER NOT NULL,
+                failures INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                PRIMARY KEY ({period}, relay_id)
+            ) WITHOUT ROWID
+        """)
+
+
+def _migrate_attachment_store(conn):
+    # Attachment contents are stored once each, keyed by sha256 and already
+    # base64-encoded for MIME; emails reference them by digest, in order
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_blobs (
+            digest TEXT PRIMARY KEY,               -- sha256 of the file's bytes, hex
+            size INTEGER NOT NULL,                 -- bytes before encoding
+            refcount INTEGER NOT NULL DEFAULT 0,   -- email_attachments rows pointing here
+            stored_at INTEGER NOT NULL,            -- epoch seconds, last ingested
+            payload TEXT NOT NULL                  -- base64 in 76-character lines
+        )
+    """)
+    # Unreferenced blobs, for the retention job to collect
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_attachment_blobs_unreferenced
+        ON attachment_blobs(stored_at) WHERE refcount = 0
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_attachments (
+            email_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            filename TEXT NOT NULL,                -- the name the recipient sees
+            digest TEXT NOT NULL,                  -- attachment_blobs.digest
+            PRIMARY KEY (email_id, position)
+        ) WITHOUT ROWID
+    """)
+    # Move each attachment_path into the store, reading every distinct file once.
+    # A file that can't be read was being skipped at send time; it stays unattached
+    digests = {}
+    rows = conn.execute("SELECT id, attachment_path FROM emails WHERE attachment_path != ''").fetchall()
+    for email_id, path in rows:
+        if path not in digests:
+            try:
+                digest, size, payload = hash_and_encode(path)
+            except OSError as e:
+                logger.warning("Attachment %s can't be read (%s); emails using it are left without it", path, e)
+                digest = None
+            else:
+                _store_blob(conn, digest, size, payload)
+            digests[path] = digest
+        if digests[path]:
+            attachment = Attachment(os.path.basename(path), digests[path])
+            _link_attachments(conn, Email("", "", "", "", attachments=[attachment], id=email_id))
+            conn.execute("UPDATE emails SET attachment_path=NULL WHERE id=?", (email_id,))
+
+
+def _migrate_month_day(conn):
+    conn.execute("ALTER TABLE emails ADD COLUMN month_day INTEGER")
+    # Monthly emails repeated on the day of their next_due_at (else of last_sent, else
+    # today), where a day past the 28th meant the last day of every month
+    rows = conn.execute("""
+        SELECT id, next_due_at, last_sent, timezone FROM emails WHERE mode='Time' AND frequency='Monthly'
+    """).fetchall()
+    updates = []
+    for email_id, next_due_at, last_sent, timezone in rows:
+        try:
+            zone = get_zone(timezone) if timezone else None
+        except ValueError:
+            zone = None
+        try:
+            if next_due_at is not None:
+                day = datetime.fromtimestamp(next_due_at, zone).day
+            else:
+                day = (datetime.fromisoformat(last_sent) if last_sent else datetime.now()).astimezone(zone).day
+        except ValueError:
+            day = datetime.now().day
+        updates.append((day if day <= 28 else 31, email_id))
+    conn.executemany("UPDATE emails SET month_day=? WHERE id=?", updates)
+
+
+def _migrate_templated(conn):
+    # Placeholders are only filled in for emails that opt in; existing subjects
+    # and bodies were written before templating and are sent exactly as they are
+    conn.execute("ALTER TABLE emails ADD COLUMN templated INTEGER NOT NULL DEFAULT 0")
+
+
+# Applied in order; the database's PRAGMA user_version is the number already applied.
+# Never edit or reorder an entry once released -- append a new one instead.
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_attachment_path,
+    _migrate_next_due_at,
+    _migrate_list_sort_indexes,
+    _migrate_per_recipient,
+    _migrate_rate_limits,
+    _migrate_outbox,
+    _migrate_outbox_leases,
+    _migrate_recurrence,
+    _migrate_interval_seconds,
+    _migrate_templates,
+    _migrate_smtp_profiles,
+    _migrate_misfire_policy,
+    _migrate_send_log,
+    _migrate_attachment_store,
+    _migrate_month_day,
+    _migrate_templated,
+]
+
+
+# ======================= CONNECTIONS =========================
+class Database:
+    """
+    Owns access to scheduler.db: one long-lived connection per thread, in WAL
+    mode so the GUI can read while the scheduler writes, and a process-wide
+    write lock so our own threads never fight over SQLite's write lock.
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+
+    def connection(self):
+        """The calling thread's connection, opened and tuned on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,  # we issue BEGIN/COMMIT ourselves
+                cached_statements=STATEMENT_CACHE_SIZE
+            )
+            # Only takes effect when the file is new (so before journal_mode writes
+            # its header); older databases are converted by vacuum(full=True)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            # Safe with WAL: a power loss can only drop the last commits, never corrupt
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block as one write transaction, committing on success."""
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        """Close the calling thread's connection (others close when their thread ends)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def vacuum(self, full=False):
+        """
+        Give up to VACUUM_PAGES_PER_STEP pages freed by deleted rows back to
+        the filesystem. Returns False if the database predates incremental
+        vacuuming; full=True converts it with VACUUM, which rewrites the
+        whole file and blocks other writers while it runs.
+        """
+        conn = self.connection()
+        with self._write_lock:
+            if full:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                return True
+            (auto_vacuum,) = conn.execute("PRAGMA auto_vacuum").fetchone()
+            if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+                return False
+            # executescript() runs the pragma to completion; execute() would free just one page
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+            return True
+
+    def free_pages(self):
+        """Pages freed by deleted rows but still part of the file."""
+        return self.connection().execute("PRAGMA freelist_count").fetchone()[0]
+
+    def migrate(self):
+        """Bring the schema up to date by applying any migrations not yet run."""
+        with self.transaction() as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(conn)
+                conn.execute(f"PRAGMA user_version={number}")
+
+
+# ======================= REPOSITORIES =========================
+class EmailRepository:
+    """Reads and writes rows of the emails table."""
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    def get(self, email_id: int) -> Optional[Email]:
+        row = self.db.connection().execute(
+            f"SELECT {EMAIL_COLUMNS} FROM emails WHERE id=?", (email_id,)
+        ).fetchone()
+        return _load_attachments(self.db.connection(), [_row_to_email(row)])[0] if row else None
+
+    def get_many(self, email_ids) -> List[Email]:
+        """The emails with these ids (missing ids are skipped); queried in chunks."""
+        email_ids = list(email_ids)
+        emails = []
+        for start in range(0, len(email_ids), MAX_IDS_PER_QUERY):
+            chunk = email_ids[start:start + MAX_IDS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.connection().execute(
+                f"SELECT {EMAIL_COLUMNS} FROM emails WHERE id IN ({placeholders})", chunk
+            ).fetchall()
+            emails.extend(_row_to_email(row) for row in rows)
+        return _load_attachments(self.db.connection(), emails)
+
+    @QUERY_SECONDS.labels("page").time()
+    def page(self, search: Optional[str] = None, mode: Optional[str] = None,
+             frequency: Optional[str] = None, sort: str = "id", descending: bool = False,
+             after: Optional[tuple] = None, limit: int = 200) -> Tuple[List[Email], Optional[tuple]]:
+        """
+        One page of emails, filtered and sorted in SQL using keyset pagination.
+        search matches subject or recipients; after is the cursor returned for
+        the previous page. Returns (emails, cursor for the next page or None).
+        """
+        sort_key = SORT_KEYS[sort]
+        where, params = [], []
+        if search:
+            pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(subject LIKE ? ESCAPE '\\' OR recipients LIKE ? ESCAPE '\\')")
+            params += [pattern, pattern]
+        if mode:
+            where.append("mode = ?")
+            params.append(mode)
+        if frequency:
+            where.append("frequency = ?")
+            params.append(frequency)
+        if after is not None:
+            where.append(f"({sort_key}, id) {'<' if descending else '>'} (?, ?)")
+            params += list(after)
+        direction = "DESC" if descending else "ASC"
+
+        rows = self.db.connection().execute(
+            f"""SELECT {EMAIL_COLUMNS}, {sort_key} FROM emails
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY {sort_key} {direction}, id {direction}
+                LIMIT ?""",
+            params + [limit + 1]
+        ).fetchall()
+
+        # The extra row only tells us whether there is a next page
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = (rows[-1][-1], rows[-1][0])
+        return _load_attachments(self.db.connection(), [_row_to_email(row[:-1]) for row in rows]), cursor
+
+    @QUERY_SECONDS.labels("due_times").time()
+    def due_times(self, email_ids=None) -> Dict[int, Optional[int]]:
+        """
+        {id: next_due_at} for every email, or for just these ids (None for an
+        id that no longer exists). Feeds the scheduler's in-memory timer.
+        """
+        conn = self.db.connection()
+        if email_ids is None:
+            return dict(conn.execute("SELECT id, next_due_at FROM emails WHERE next_due_at IS NOT NULL"))
+        email_ids = list(email_ids)
+        due_times = dict.fromkeys(email_ids)
+        for start in range(0, len(email_ids), MAX_IDS_PER_QUERY):
+            chunk = email_ids[start:start + MAX_IDS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            due_times.update(conn.execute(
+                f"SELECT id, next_due_at FROM emails WHERE id IN ({placeholders})", chunk
+            ))
+        return due_times
+
+    @QUERY_SECONDS.labels("add").time()
+    def add(self, email: Email) -> int:
+        """Insert a new email (computing its next_due_at) and return its id."""
+        email.settle_month_day()
+        email.next_due_at = to_epoch(email.compute_next_due())
+        with self.db.transaction() as conn:
+            cursor = conn.execute("""
+                INSERT INTO emails
+                    (subject, recipients, body, mode, frequency, interval_seconds,
+                     schedule_time, last_sent, next_due_at, per_recipient,
+                     recurrence, timezone, template_data, smtp_profile_id, misfire_policy, misfire_cap,
+                     month_day, templated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                email.subject, email.recipients, email.body, email.mode, email.frequency,
+                email.interval_seconds, email.schedule_time,
+                email.last_sent, email.next_due_at, int(email.per_recipient),
+                email.recurrence, email.timezone, email.template_data, email.smtp_profile_id,
+                email.misfire_policy, email.misfire_cap, email.month_day, int(email.templated)
+            ))
+            email.id = cursor.lastrowid
+            _link_attachments(conn, email)
+        return email.id
+
+    @QUERY_SECONDS.labels("add_many").time()
+    def add_many(self, emails: List[Email]) -> int:
+        """
+        Insert many new emails in one transaction (e.g. a bulk import chunk),
+        setting each one's id; returns how many.
+        """
+        for email in emails:
+            email.settle_month_day()
+            email.next_due_at = to_epoch(email.compute_next_due())
+        with self.db.transaction() as conn:
+            for email in emails:
+                email.id = conn.execute("""
+                    INSERT INTO emails
+                        (subject, recipients, body, mode, frequency, interval_seconds,
+                         schedule_time, last_sent, next_due_at, per_recipient,
+                         recurrence, timezone, template_data, smtp_profile_id, misfire_policy, misfire_cap,
+                         month_day, templated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    email.subject, email.recipients, email.body, email.mode, email.frequency,
+                    email.interval_seconds, email.schedule_time,
+                    email.last_sent, email.next_due_at, int(email.per_recipient),
+                    email.recurrence, email.timezone, email.template_data, email.smtp_profile_id,
+                    email.misfire_policy, email.misfire_cap, email.month_day, int(email.templated)
+                )).lastrowid
+                if email.attachments:
+                    _link_attachments(conn, email)
+        return len(emails)
+
+    @QUERY_SECONDS.labels("update").time()
+    def update(self, email: Email):
+        """Save edited fields (not last_sent) and recompute next_due_at."""
+        with self.db.transaction() as conn:
+            self._update(conn, email)
+
+    @QUERY_SECONDS.labels("update_many").time()
+    def update_many(self, emails: List[Email]) -> int:
+        """Save many edited emails in one transaction, as update() does; returns how many."""
+        with self.db.transaction() as conn:
+            for email in emails:
+                self._update(conn, email)
+        return len(emails)
+
+    @staticmethod
+    def _update(conn, email: Email):
+        # The scheduler may have sent it while it was being edited
+        row = conn.execute("SELECT last_sent FROM emails WHERE id=?", (email.id,)).fetchone()
+        if row:
+            email.last_sent = row[0]
+        email.settle_month_day()
+        email.next_due_at = to_epoch(email.compute_next_due())
+        conn.execute("""
+            UPDATE emails
+            SET subject=?, recipients=?, body=?, mode=?, frequency=?, interval_seconds=?,
+                schedule_time=?, next_due_at=?, per_recipient=?,
+                recurrence=?, timezone=?, template_data=?, smtp_profile_id=?, misfire_policy=?,
+                misfire_cap=?, month_day=?, templated=?
+            WHERE id=?
+        """, (
+            email.subject, email.recipients, email.body, email.mode, email.frequency,
+            email.interval_seconds, email.schedule_time,
+            email.next_due_at, int(email.per_recipient), email.recurrence, email.timezone,
+            email.template_data, email.smtp_profile_id, email.misfire_policy, email.misfire_cap,
+            email.month_day, int(email.templated), email.id
+        ))
+        _unlink_attachments(conn, email.id)
+        _link_attachments(conn, email)
+
+    @QUERY_SECONDS.labels("delete").time()
+    def delete(self, email_id: int):
+        with self.db.transaction() as conn:
+            _unlink_attachments(conn, email_id)
+            conn.execute("DELETE FROM emails WHERE id=?", (email_id,))
+
+class OutboxRepository:
+    """
+    The durable queue of sends. Due emails are moved into it (advancing their
+    schedule) and the dispatcher drains it in order, so a send that fails or
+    is interrupted is retried from here rather than lost or repeated.
+
+    Entries are claimed with a lease: the claiming worker's id and an expiry,
+    written atomically, so several scheduler processes can share a database
+    without sending the same entry twice. A worker that dies loses its leases
+    when they expire and another worker takes the entries over. Each entry's
+    Message-ID is stored when it is first claimed, before anything is sent,
+    so every attempt carries the same one and receivers can drop duplicates.
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    @QUERY_SECONDS.labels("enqueue_due").time()
+    def enqueue_due(self, now: datetime, limit: int, drain=None,
+                    grace: int = MISFIRE_GRACE_SECONDS) -> Dict[int, Optional[int]]:
+        """
+        Queue sends for up to `limit` due emails and advance each one's
+        next_due_at past now, in one transaction. Runs more than `grace`
+        seconds overdue are handled by the email's misfire policy (see
+        email_scheduler.misfire): the ones sent are paced by drain.slot(), if
+        a BacklogDrain is given, and the rest are recorded as skipped. A run
+        is also skipped while the email still has an unfinished send. Returns
+        {id: new next_due_at} for the due emails handled (fewer than limit
+        once none are left).
+        """
+        now_epoch = int(now.timestamp())
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                f"SELECT {EMAIL_COLUMNS} FROM emails WHERE next_due_at <= ? ORDER BY next_due_at LIMIT ?",
+                (now_epoch, limit)
+            ).fetchall()
+            emails = [_row_to_email(row) for row in rows]
+            if not emails:
+                return {}
+            placeholders = ",".join("?" * len(emails))
+            open_ids = {row[0] for row in conn.execute(
+                f"""SELECT email_id FROM outbox
+                    WHERE email_id IN ({placeholders}) AND state IN {OUTBOX_OPEN_STATES}""",
+                [email.id for email in emails]
+            )}
+
+            queued, skipped, due_times = [], [], {}
+            for email in emails:
+                on_time, missed, skip, next_due = plan_runs(email, now, grace)
+                due_times[email.id] = to_epoch(next_due)
+                if email.id in open_ids:
+                    skipped += [(email.id, due_at, "The previous send had not finished")
+                                for due_at in on_time + missed]
+                    continue
+                queued += [(email.id, due_at, now_epoch) for due_at in on_time]
+                queued += [(email.id, due_at, drain.slot(now_epoch) if drain else now_epoch) for due_at in missed]
+                reason = f"Missed run not sent (misfire policy: {email.misfire_policy or DEFAULT_MISFIRE_POLICY})"
+                skipped += [(email.id, due_at, reason) for due_at in skip]
+            conn.executemany("""
+                INSERT INTO outbox (email_id, state, due_at, next_attempt_at)
+                VALUES (?, 'pending', ?, ?)
+            """, queued)
+            conn.executemany("""
+                INSERT INTO outbox (email_id, state, due_at, last_error)
+                VALUES (?, 'skipped', ?, ?)
+            """, skipped)
+            conn.executemany("UPDATE emails SET next_due_at=? WHERE id=?",
+                             [(next_due_at, email_id) for email_id, next_due_at in due_times.items()])
+        return due_times
+
+    @QUERY_SECONDS.labels("count_backlog").time()
+    def count_backlog(self, now: datetime, grace: int = MISFIRE_GRACE_SECONDS) -> int:
+        """
+        How many catch-up sends enqueue_due() would queue now: the missed runs
+        that the misfire policies of overdue emails send (a fire_all email can
+        send several). Sizes the BacklogDrain.
+        """
+        rows = self.db.connection().execute(f"""
+            SELECT {EMAIL_COLUMNS} FROM emails
+            WHERE next_due_at < ? AND NOT EXISTS (
+                SELECT 1 FROM outbox WHERE outbox.email_id = emails.id AND outbox.state IN {OUTBOX_OPEN_STATES}
+            )
+        """, (int(now.timestamp()) - grace,))
+        return sum(len(plan_runs(_row_to_email(row), now, grace, record=False)[1]) for row in rows)
+
+    @QUERY_SECONDS.labels("claim_ready").time()
+    def claim_ready(self, owner: str, now_epoch: int, lease_expires_at: int, limit: int,
+                    message_id_domain: str) -> List[Tuple[OutboxEntry, Optional[Email]]]:
+        """
+        Lease up to `limit` entries to `owner` until lease_expires_at, in queue
+        order: those whose next attempt is due, plus in_flight ones whose lease
+        has expired. An email is only sent by one entry at a time, so entries
+        of an email with a live lease wait, as do all but the first of an
+        email's entries here. Returns them with their email (None if it was
+        deleted).
+        """
+        columns = f"""o.id, o.email_id, o.state, o.attempts, o.due_at, o.next_attempt_at,
+                      o.last_error, o.message_id,
+                      {", ".join("e." + column.strip() for column in EMAIL_COLUMNS.split(","))}"""
+        with self.db.transaction() as conn:
+            not_in_flight = """NOT EXISTS (SELECT 1 FROM outbox b WHERE b.email_id = o.email_id
+                                   AND b.state = 'in_flight' AND b.lease_expires_at > ?)"""
+            rows = conn.execute(f"""
+                SELECT {columns} FROM outbox o LEFT JOIN emails e ON e.id = o.email_id
+                WHERE o.state IN {OUTBOX_READY_STATES} AND o.next_attempt_at <= ? AND {not_in_flight}
+                UNION ALL
+                SELECT {columns} FROM outbox o LEFT JOIN emails e ON e.id = o.email_id
+                WHERE o.state = 'in_flight' AND o.lease_expires_at <= ? AND {not_in_flight}
+                ORDER BY 6, 1  -- next_attempt_at, id
+                LIMIT ?
+            """, (now_epoch, now_epoch, now_epoch, now_epoch, limit)).fetchall()
+            entries, email_ids = [], set()
+            for row in rows:
+                if row[1] not in email_ids:
+                    email_ids.add(row[1])
+                    entries.append((OutboxEntry(*row[:8]), _row_to_email(row[8:]) if row[8] is not None else None))
+            _load_attachments(conn, [email for _, email in entries if email])
+            for entry, _ in entries:
+                entry.message_id = entry.message_id or make_msgid(domain=message_id_domain)
+            conn.executemany("""
+                UPDATE outbox SET state='in_flight', lease_owner=?, lease_expires_at=?, message_id=?
+                WHERE id=?
+            """, [(owner, lease_expires_at, entry.message_id, entry.id) for entry, _ in entries])
+        return entries
+
+    @QUERY_SECONDS.labels("claim_email").time()
+    def claim_email(self, email_id: int, owner: str, now_epoch: int, lease_expires_at: int,
+                    message_id_domain: str) -> Optional[Tuple[OutboxEntry, bool]]:
+        """
+        Lease the outbox entry for sending email_id right away ("Send Now"):
+        its oldest unfinished entry if it has any, otherwise a new one.
+        Returns (entry, created), or None if another worker holds a live
+        lease on any of its entries, i.e. is sending it right now.
+        """
+        with self.db.transaction() as conn:
+            rows = conn.execute(f"""
+                SELECT id, email_id, state, attempts, due_at, next_attempt_at, last_error, message_id,
+                       lease_expires_at
+                FROM outbox WHERE email_id=? AND state IN {OUTBOX_OPEN_STATES}
+                ORDER BY next_attempt_at, id
+            """, (email_id,)).fetchall()
+            if any(row[2] == "in_flight" and row[8] > now_epoch for row in rows):
+                return None
+            row = rows[0] if rows else None
+            if row:
+                entry, created = OutboxEntry(*row[:8]), False
+                entry.message_id = entry.message_id or make_msgid(domain=message_id_domain)
+                conn.execute("""
+                    UPDATE outbox SET state='in_flight', lease_owner=?, lease_expires_at=?, message_id=?
+                    WHERE id=?
+                """, (owner, lease_expires_at, entry.message_id, entry.id))
+            else:
+                entry, created = OutboxEntry(None, email_id, "in_flight", 0, now_epoch, now_epoch,
+                                             message_id=make_msgid(domain=message_id_domain)), True
+                entry.id = conn.execute("""
+                    INSERT INTO outbox
+                        (email_id, state, due_at, next_attempt_at, lease_owner, lease_expires_at, message_id)
+                    VALUES (?, 'in_flight', ?, ?, ?, ?, ?)
+                """, (email_id, now_epoch, now_epoch, owner, lease_expires_at, entry.message_id)).lastrowid
+        return entry, created
+
+    @QUERY_SECONDS.labels("renew_leases").time()
+    def renew_leases(self, owner: str, entry_ids, lease_expires_at: int):
+        """Extend owner's leases on entries it is still sending."""
+        with self.db.transaction() as conn:
+            conn.executemany("""
+                UPDATE outbox SET lease_expires_at=?
+                WHERE id=? AND lease_owner=? AND state='in_flight'
+            """, [(lease_expires_at, entry_id, owner) for entry_id in entry_ids])
+
+    @QUERY_SECONDS.labels("release").time()
+    def release(self, owner: str, entry_ids):
+        """Put owner's leased entries back in the queue without counting an attempt."""
+        with self.db.transaction() as conn:
+            conn.executemany("""
+                UPDATE outbox SET state='pending', lease_owner=NULL, lease_expires_at=NULL
+                WHERE id=? AND lease_owner=? AND state='in_flight'
+            """, [(entry_id, owner) for entry_id in entry_ids])
+
+    @QUERY_SECONDS.labels("record_results").time()
+    def record_results(self, owner: str, sent: List[Tuple[OutboxEntry, datetime]],
+                       failed: List[Tuple[OutboxEntry, str, Optional[int]]],
+                       send_log: List[SendLogEntry] = (), next_due: Optional[Dict[int, Optional[int]]] = None):
+        """
+        Write a batch of owner's attempts in one transaction. sent holds
+        (entry, sent_at); those entries become sent and their email's
+        last_sent is updated (and next_due_at, for emails in next_due: {email
+        id: epoch seconds}, as after a manual send). failed holds (entry,
+        error, retry_at): the entry is retried at retry_at, or becomes dead if
+        retry_at is None. Entries whose lease another worker has since taken
+        over, and their emails, are left to it. send_log rows are appended to
+        the send history.
+        """
+        attempts = [(entry.id, owner, sent_at.isoformat(), None) for entry, sent_at in sent]
+        attempted_at = datetime.now().isoformat()
+        attempts += [(entry.id, owner, attempted_at, error) for entry, error, _ in failed]
+        with self.db.transaction() as conn:
+            conn.executemany("""
+                INSERT INTO outbox_attempts (outbox_id, worker, attempted_at, error) VALUES (?, ?, ?, ?)
+            """, attempts)
+            # Before the outbox update below gives up the leases it checks
+            conn.executemany("""
+                UPDATE emails SET last_sent=?, send_count=send_count + 1
+                WHERE id=? AND EXISTS (SELECT 1 FROM outbox WHERE id=? AND lease_owner=?)
+            """, [(sent_at.isoformat(), entry.email_id, entry.id, owner) for entry, sent_at in sent])
+            conn.executemany("""
+                UPDATE emails SET next_due_at=?
+                WHERE id=? AND EXISTS (SELECT 1 FROM outbox WHERE id=? AND lease_owner=?)
+            """, [(next_due[entry.email_id], entry.email_id, entry.id, owner)
+                  for entry, _ in sent if next_due and entry.email_id in next_due])
+            conn.executemany("""
+                UPDATE outbox SET state='sent', next_attempt_at=NULL, sent_at=?,
+                                  lease_owner=NULL, lease_expires_at=NULL
+                WHERE id=? AND lease_owner=?
+            """, [(sent_at.isoformat(), entry.id, owner) for entry, sent_at in sent])
+            conn.executemany("""
+                UPDATE outbox SET state=?, attempts=attempts + 1, next_attempt_at=?, last_error=?,
+                                  lease_owner=NULL, lease_expires_at=NULL
+                WHERE id=? AND lease_owner=?
+            """, [("failed" if retry_at else "dead", retry_at, error, entry.id, owner)
+                  for entry, error, retry_at in failed])
+            conn.executemany(f"INSERT INTO send_log ({SEND_LOG_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (log.email_id, log.sent_at, log.response, log.latency_ms, log.bytes, log.relay_id, log.error)
+                for log in send_log
+            ])
+
+    @QUERY_SECONDS.labels("next_attempt_at").time()
+    def next_attempt_at(self) -> Optional[int]:
+        """When the earliest queued entry is due, or None if the queue is empty."""
+        (next_attempt_at,) = self.db.connection().execute(
+            f"SELECT MIN(next_attempt_at) FROM outbox WHERE state IN {OUTBOX_READY_STATES}"
+        ).fetchone()
+        return next_attempt_at
+
+    @QUERY_SECONDS.labels("counts").time()
+    def counts(self) -> Dict[str, int]:
+        """Number of entries in each state."""
+        counts = dict.fromkeys(OUTBOX_STATES, 0)
+        counts.update(self.db.connection().execute(
+            "SELECT state, COUNT(*) FROM outbox GROUP BY state"
+        ).fetchall())
+        return counts
+
+    @QUERY_SECONDS.labels("prune_outbox").time()
+    def prune(self, before: int, now_epoch: int, limit: int) -> int:
+        """
+        Delete up to `limit` finished entries due before `before`, and entries
+        of deleted emails that no worker is sending right now, with their
+        attempts, in one transaction. Returns how many entries were deleted
+        (fewer than limit once none are left).
+        """
+        with self.db.transaction() as conn:
+            entry_ids = [row[0] for row in conn.execute(f"""
+                SELECT id FROM outbox
+                WHERE (state IN {OUTBOX_FINISHED_STATES} AND due_at < ?)
+                   OR (email_id NOT IN (SELECT id FROM emails)
+                       AND NOT (state = 'in_flight' AND lease_expires_at > ?))
+                LIMIT ?
+            """, (before, now_epoch, limit))]
+            conn.executemany("DELETE FROM outbox_attempts WHERE outbox_id=?", [(i,) for i in entry_ids])
+            conn.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in entry_ids])
+        return len(entry_ids)
+
+
+class SMTPSettingsRepository:
+    """Reads and writes SMTP profiles (rows of smtp_settings)."""
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    def list(self) -> List[SMTPSettings]:
+        """Every profile, oldest first."""
+        rows = self.db.connection().execute(f"SELECT {SMTP_COLUMNS} FROM smtp_settings ORDER BY id").fetchall()
+        return [SMTPSettings(*row) for row in rows]
+
+    def get(self, profile_id: Optional[int] = None) -> Optional[SMTPSettings]:
+        """The profile with this id, or with no id the first (oldest) profile."""
+        conn = self.db.connection()
+        if profile_id is None:
+            row = conn.execute(f"SELECT {SMTP_COLUMNS} FROM smtp_settings ORDER BY id LIMIT 1").fetchone()
+        else:
+            row = conn.execute(f"SELECT {SMTP_COLUMNS} FROM smtp_settings WHERE id=?", (profile_id,)).fetchone()
+        return SMTPSettings(*row) if row else None
+
+    def save(self, server: str, port, email: str, password: str, encryption: str,
+             max_per_minute: Optional[int] = None, max_per_hour: Optional[int] = None,
+             name: Optional[str] = None, profile_id: Optional[int] = None) -> int:
+        """
+        Update the profile profile_id, or else the one called name (default:
+        the email address), adding it if there is none. Returns its id.
+        """
+        name = name or email
+        values = (server, port, email, password, encryption, max_per_minute, max_per_hour, name)
+        with self.db.transaction() as conn:
+            if profile_id is None:
+                row = conn.execute("SELECT id FROM smtp_settings WHERE name=?", (name,)).fetchone()
+                profile_id = row[0] if row else None
+            if profile_id is None:
+                cursor = conn.execute("""
+                    INSERT INTO smtp_settings
+                        (server, port, email, password, encryption, max_per_minute, max_per_hour, name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, values)
+                return cursor.lastrowid
+            conn.execute("""
+                UPDATE smtp_settings
+                SET server=?, port=?, email=?, password=?, encryption=?, max_per_minute=?, max_per_hour=?,
+                    name=?
+                WHERE id=?
+            """, values + (profile_id,))
+            return profile_id
+
+    def delete(self, profile_id: int):
+        """Remove a profile; emails assigned to it go back to the pool."""
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE emails SET smtp_profile_id=NULL WHERE smtp_profile_id=?", (profile_id,))
+            conn.execute("DELETE FROM smtp_settings WHERE id=?", (profile_id,))
+
+
+class AttachmentRepository:
+    """
+    The attachment store: each distinct file content once, keyed by its
+    sha256 and base64-encoded at ingest so sends never read user files or
+    encode anything. Payloads are written and read back in chunks (SQLite
+    incremental blob I/O), never whole. Blobs no email references are
+    collected by the retention job.
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    @QUERY_SECONDS.labels("ingest_attachment").time()
+    def ingest(self, path: str) -> Attachment:
+        """Store a file's contents (unless already stored) and return an Attachment for it. Raises OSError."""
+        # Hashed before the transaction, so other writers are only held up for new contents
+        digest, size = encode_file(path)
+        with self.db.transaction() as conn:
+            updated = conn.execute("UPDATE attachment_blobs SET stored_at=? WHERE digest=?",
+                                   (int(time.time()), digest)).rowcount
+            if not updated:
+                rowid = conn.execute("""
+                    INSERT INTO attachment_blobs (digest, size, stored_at, payload) VALUES (?, ?, ?, zeroblob(?))
+                """, (digest, size, int(time.time()), encoded_length(size))).lastrowid
+                with conn.blobopen("attachment_blobs", "payload", rowid) as blob:
+                    stored, _ = encode_file(path, blob.write)
+                if stored != digest:
+                    raise OSError(f"{path} changed while it was being stored")
+        return Attachment(os.path.basename(path), digest)
+
+    def stored(self, digests) -> set:
+        """Which of these digests are in the store."""
+        digests = list(digests)
+        found = set()
+        for start in range(0, len(digests), MAX_IDS_PER_QUERY):
+            chunk = digests[start:start + MAX_IDS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(digest for (digest,) in self.db.connection().execute(
+                f"SELECT digest FROM attachment_blobs WHERE digest IN ({placeholders})", chunk
+            ))
+        return found
+
+    @QUERY_SECONDS.labels("attachment_size").time()
+    def stored_size(self, digest: str) -> Optional[int]:
+        """The size in bytes (before encoding) of the contents stored for a digest, or None."""
+        row = self.db.connection().execute(
+            "SELECT size FROM attachment_blobs WHERE digest=?", (digest,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def read_payload(self, digest: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        The base64-encoded contents stored for a digest, chunk_size bytes at a
+        time, read on the calling thread's connection. Raises ValueError if
+        they are missing.
+        """
+        conn = self.db.connection()
+        row = conn.execute("SELECT rowid FROM attachment_blobs WHERE digest=?", (digest,)).fetchone()
+        if row is None:
+            raise ValueError(f"Attachment contents {digest} are missing from the attachment store")
+        with conn.blobopen("attachment_blobs", "payload", row[0], readonly=True) as blob:
+            for chunk in iter(lambda: blob.read(chunk_size), b""):
+                yield chunk
+
+    def collect_garbage(self, before: int) -> int:
+        """Delete blobs that no email references and that were stored before this time; returns how many."""
+        with self.db.transaction() as conn:
+            return conn.execute(
+                "DELETE FROM attachment_blobs WHERE refcount = 0 AND stored_at < ?", (before,)
+            ).rowcount
+
+
+class SendLogRepository:
+    """
+    The send history: raw send_log rows, rolled up into hourly and then daily
+    totals once they are old (see email_scheduler.retention).
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    def history(self, email_id: Optional[int] = None, limit: int = 100) -> List[SendLogEntry]:
+        """The most recent raw rows, newest first, for one email or all of them."""
+        where, params = ("WHERE email_id=?", [email_id]) if email_id is not None else ("", [])
+        rows = self.db.connection().execute(
+            f"SELECT {SEND_LOG_COLUMNS}, id FROM send_log {where} ORDER BY sent_at DESC, id DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        return [SendLogEntry(*row) for row in rows]
+
+    def throughput(self, since: int, period: str = "hour") -> List[Tuple[int, int, int, int, int]]:
+        """
+        (period start, sends, failures, bytes, latency_ms total) per hour or
+        day since the given epoch time, combining raw rows and rollups. Days
+        already rolled up can't be split, so they show up whole in "hour" results.
+        """
+        size = {"hour": 3600, "day": 86400}[period]
+        return self.db.connection().execute(f"""
+            SELECT start, SUM(sends), SUM(failures), SUM(bytes), SUM(latency_ms) FROM (
+                SELECT sent_at - sent_at % {size} AS start, error IS NULL AS sends, error IS NOT NULL AS failures,
+                       bytes, latency_ms
+                FROM send_log WHERE sent_at >= ?
+                UNION ALL
+                SELECT hour - hour % {size}, sends, failures, bytes, latency_ms
+                FROM send_stats_hourly WHERE hour >= ?
+                UNION ALL
+                SELECT day, sends, failures, bytes, latency_ms FROM send_stats_daily WHERE day >= ?
+            ) GROUP BY start ORDER BY start
+        """, (since, since - since % 3600, since - since % 86400)).fetchall()
+
+    @QUERY_SECONDS.labels("roll_up_send_log").time()
+    def roll_up_raw(self, before: int, limit: int) -> int:
+        """
+        Fold up to `limit` of the oldest send_log rows older than `before`
+        into send_stats_hourly and delete them, in one transaction. Returns
+        how many rows were rolled up (fewer than limit once none are left).
+        """
+        with self.db.transaction() as conn:
+            (last_id, count) = conn.execute("""
+                SELECT MAX(id), COUNT(*) FROM
+                    (SELECT id FROM send_log WHERE sent_at < ? ORDER BY id LIMIT ?)
+            """, (before, limit)).fetchone()
+            if not count:
+                return 0
+            # Adding to existing totals, so an hour split across batches still sums up
+            conn.execute("""
+                INSERT INTO send_stats_hourly (hour, relay_id, sends, failures, bytes, latency_ms)
+                SELECT sent_at - sent_at % 3600, IFNULL(relay_id, 0), SUM(error IS NULL), SUM(error IS NOT NULL),
+                       SUM(bytes), SUM(latency_ms)
+                FROM send_log WHERE sent_at < ? AND id <= ?
+                GROUP BY 1, 2
+                ON CONFLICT (hour, relay_id) DO UPDATE SET
+                    sends = sends + excluded.sends, failures = failures + excluded.failures,
+                    bytes = bytes + excluded.bytes, latency_ms = latency_ms + excluded.latency_ms
+            """, (before, last_id))
+            conn.execute("DELETE FROM send_log WHERE sent_at < ? AND id <= ?", (before, last_id))
+        return count
+
+    @QUERY_SECONDS.labels("roll_up_send_stats").time()
+    def roll_up_hours(self, before: int) -> int:
+        """Fold hourly totals older than `before` into send_stats_daily; returns the hours rolled up."""
+        with self.db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO send_stats_daily (day, relay_id, sends, failures, bytes, latency_ms)
+                SELECT hour - hour % 86400, relay_id, SUM(sends), SUM(failures), SUM(bytes), SUM(latency_ms)
+                FROM send_stats_hourly WHERE hour < ?
+                GROUP BY 1, 2
+                ON CONFLICT (day, relay_id) DO UPDATE SET
+                    sends = sends + excluded.sends, failures = failures + excluded.failures,
+                    bytes = bytes + excluded.bytes, latency_ms = latency_ms + excluded.latency_ms
+            """, (before,))
+            return conn.execute("DELETE FROM send_stats_hourly WHERE hour < ?", (before,)).rowcount
+
+
+class RateLimitRepository:
+    """Persists the rate limiter's token buckets."""
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    def load(self) -> Dict[Tuple[str, str], Tuple[float, float]]:
+        """{(account, window): (tokens, updated_at)} for every saved bucket."""
+        rows = self.db.connection().execute(
+            "SELECT account, window, tokens, updated_at FROM rate_limits"
+        ).fetchall()
+        return {(account, window): (tokens, updated_at) for account, window, tokens, updated_at in rows}
+
+    def save(self, state: Dict[Tuple[str, str], Tuple[float, float]]):
+        if not state:
+            return
+        with self.db.transaction() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO rate_limits (account, window, tokens, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, [(account, window, tokens, updated_at)
+                  for (account, window), (tokens, updated_at) in state.items()])
@@ -0,0 +1,40 @@
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+# Number of emails sent in parallel by the scheduler
+DEFAULT_MAX_WORKERS = 8
+
+
+class DispatchPool:
+    """
+    Sends due emails on a bounded pool of worker threads. (Which worker may
+    send what is decided by the outbox leases, not here.)
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dispatch")
+
+    def run_all(self, func, items, on_cancel):
+        """
+        Call func(item) for every item on the worker pool and wait until all
+        are done. An item dropped by shutdown() before it started gets
+        on_cancel(item) as its result instead.
+        """
+        futures = []
+        for item in items:
+            try:
+                futures.append(self._executor.submit(func, item))
+            except RuntimeError:
+                # Already shut down
+                futures.append(None)
+        # Not concurrent.futures.wait(): it never returns for futures cancelled by shutdown()
+        results = []
+        for item, future in zip(items, futures):
+            try:
+                results.append(future.result() if future else on_cancel(item))
+            except CancelledError:
+                results.append(on_cancel(item))
+        return results
+
+    def shutdown(self):
+        """Stop accepting work and drop anything that hasn't started yet."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
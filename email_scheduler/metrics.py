@@ -0,0 +1,306 @@
+"""
+Counters, gauges and histograms for the scheduler's hot paths, rendered in
+the Prometheus text format. Metrics live in a process-wide registry, like
+the prometheus_client default one, so any module can define and update
+them without threading a collector through every call.
+
+The daemon serves them over HTTP (MetricsServer) and/or appends snapshots
+to a rotating file (MetricsFileWriter).
+"""
+import functools
+import logging
+import logging.handlers
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds (Prometheus client defaults, plus 30s and 60s for slow relays)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0)
+# Prefix of every metric name
+NAMESPACE = "email_scheduler"
+
+
+class _Metric:
+    """A named metric with optional labels; each label combination is its own child."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> child
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **labels):
+        """The child for these label values (positional, or by name)."""
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            labels = dict(zip(self.labelnames, values))
+            lines.extend(child.render(self.name, labels))
+        return lines
+
+    def _default(self):
+        # Unlabelled metrics have a single child
+        return self.labels()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}_total{_format_labels(labels)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    """A count that only goes up (rendered with a _total suffix)."""
+    kind = "counter"
+    _new_child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() whenever metrics are rendered."""
+        self.function = function
+
+    def render(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logger.exception("Reading gauge %s failed", name)
+                return []
+        return [f"{name}{_format_labels(labels)} {_format_value(value)}"]
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, or is read from a function at render time."""
+    kind = "gauge"
+    _new_child = _GaugeChild
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager / decorator observing the seconds the block takes."""
+        return _Timer(self)
+
+    def render(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_format_labels(dict(labels, le=le))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total!r}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Observations (usually durations in seconds) counted into cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with _Timer(self.child):
+                return func(*args, **kwargs)
+        return timed
+
+
+class Registry:
+    """Every metric defined in the process, in definition order."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Re-importing a module (or defining a metric twice) reuses the first definition
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# ======================= EXPORTERS =========================
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are routine; don't log each one
+        pass
+
+
+class MetricsServer:
+    """Serves GET /metrics on a background thread (localhost only by default)."""
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsFileWriter:
+    """
+    Appends a timestamped snapshot of every metric to a file every `interval`
+    seconds, rotating it at max_bytes and keeping `backups` old files.
+    """
+
+    def __init__(self, path, interval=60, max_bytes=10 * 1024 * 1024, backups=5, registry=REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self._handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                             encoding="utf-8")
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-file", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Write a final snapshot and close the file."""
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+        self._handler.close()
+
+    def write(self):
+        snapshot = f"# snapshot {time.strftime('%Y-%m-%dT%H:%M:%S')}\n{self.registry.render()}"
+        self._handler.emit(logging.makeLogRecord({"msg": snapshot}))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
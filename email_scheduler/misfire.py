@@ -0,0 +1,132 @@
+"""
+What to do about runs that were missed while no scheduler was running
+(misfires), and pacing the resulting catch-up sends.
+
+Each email has a misfire policy:
+
+    fire_once   send once for everything missed (the latest run)
+    skip        send nothing for missed runs
+    fire_all    send every missed run, up to the email's cap (the latest ones)
+
+A run is missed once it is more than MISFIRE_GRACE_SECONDS overdue; runs
+that are merely a little late are always sent. Runs that aren't sent are
+recorded in the outbox as "skipped", so nothing disappears without a trace.
+"""
+import threading
+from datetime import datetime
+
+from email_scheduler import metrics
+from email_scheduler.recurrence import get_zone, latest_occurrences, parse_rule
+from email_scheduler.schedule import anchor_date, schedule_rules, to_epoch
+
+MISFIRE_POLICIES = ("fire_once", "skip", "fire_all")
+DEFAULT_MISFIRE_POLICY = "fire_once"
+# Missed runs sent at most by fire_all when the email sets no cap
+DEFAULT_MISFIRE_CAP = 10
+# How late a run may be before it counts as missed (a slow tick isn't a misfire)
+MISFIRE_GRACE_SECONDS = 60
+# Most missed runs of one email listed one by one (the latest ones; fire_all
+# lists this many beyond its cap); older runs are only counted, so an
+# every-minute rule down for a day doesn't cost thousands of rule evaluations
+MISFIRE_SCAN_LIMIT = 100
+
+MISSED_RUNS = metrics.counter("missed_runs", "Runs found more than the grace period overdue, by what was done",
+                              ["action"])
+
+
+def due_occurrences(email, now, limit=MISFIRE_SCAN_LIMIT):
+    """
+    The latest `limit` runs of the email from its next_due_at up to now,
+    oldest first, as epoch seconds. Returns (runs, how many there were in
+    all, the next due datetime after them or None). Intervals stay on their
+    original grid.
+    """
+    now_epoch = now.timestamp()
+    due = email.next_due_at
+    if email.mode == "Interval" and email.interval_seconds:
+        step = email.interval_seconds
+        count = max(int((now_epoch - due) // step) + 1, 1)
+        runs = [due + i * step for i in range(max(count - limit, 0), count)]
+        return runs, count, datetime.fromtimestamp(due + count * step)
+
+    if email.mode != "Time" or email.frequency == "Once":
+        return [due], 1, email.compute_next_due(now, last_sent=datetime.fromtimestamp(due).isoformat())
+    try:
+        zone = get_zone(email.timezone) if email.timezone else None
+        rules = [parse_rule(text) for text in schedule_rules(
+            email.frequency, email.schedule_time, email.recurrence,
+            anchor_date(email.last_sent, due, now, email.timezone), email.month_day
+        )]
+    except (ValueError, AttributeError):
+        # Invalid schedule: this run, and no more
+        return [due], 1, None
+    later, count = latest_occurrences(rules, datetime.fromtimestamp(due).astimezone(), now.astimezone(),
+                                      limit, zone)
+    runs = ([due] + [to_epoch(run) for run in later])[-limit:]
+    return runs, count + 1, email.compute_next_due(now, last_sent=datetime.fromtimestamp(runs[-1]).isoformat())
+
+
+def plan_runs(email, now, grace=MISFIRE_GRACE_SECONDS, record=True):
+    """
+    Decide which due runs of an email to send. Returns (on-time runs to
+    send, missed runs to send, runs to skip, next due datetime or None).
+    With record=False the decision isn't counted in the metrics (a dry run).
+    """
+    policy = email.misfire_policy or DEFAULT_MISFIRE_POLICY
+    cap = email.misfire_cap or DEFAULT_MISFIRE_CAP
+    # fire_all has to see its cap of missed runs, besides the few that are on time
+    limit = MISFIRE_SCAN_LIMIT + cap if policy == "fire_all" else MISFIRE_SCAN_LIMIT
+    runs, count, next_due = due_occurrences(email, now, limit)
+    cutoff = now.timestamp() - grace
+    late = sum(1 for at in runs if at < cutoff)
+    missed, on_time = runs[:late], runs[late:]
+    if not missed:
+        return on_time, [], [], next_due
+
+    if policy == "fire_once":
+        # One send (the latest run) stands in for all of them
+        *skipped, latest = runs
+        if on_time:
+            on_time, send_missed = [latest], []
+        else:
+            send_missed = [latest]
+    elif policy == "fire_all":
+        send_missed, skipped = missed[-cap:], missed[:-cap]
+    else:
+        send_missed, skipped = [], missed
+    if record:
+        MISSED_RUNS.labels("queued").inc(len(send_missed))
+        # Runs past the scan limit aren't listed, but they were missed all the same
+        MISSED_RUNS.labels("skipped").inc(len(skipped) + count - len(runs))
+    return on_time, send_missed, skipped, next_due
+
+
+class BacklogDrain:
+    """
+    Paces catch-up sends: after a restart (or any time overdue emails pile
+    up), their sends are spaced evenly over `window` seconds instead of all
+    going to the relay on the first tick.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._spacing = 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def active(self, now_epoch):
+        """Whether a drain is still handing out slots in the future."""
+        return self._next_slot > now_epoch
+
+    def plan(self, now_epoch, backlog):
+        """Start spreading `backlog` catch-up sends over the window from now."""
+        with self._lock:
+            self._spacing = self.window / backlog if backlog and self.window > 0 else 0.0
+            self._next_slot = max(self._next_slot, now_epoch)
+
+    def slot(self, now_epoch):
+        """When the next catch-up send may go (epoch seconds)."""
+        with self._lock:
+            at = max(self._next_slot, now_epoch)
+            self._next_slot = at + self._spacing
+            return int(at)
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import time
+
+# Share of a quota that may be spent in one burst; the rest is spread out evenly
+BURST_FRACTION = 0.1
+
+# Quota windows: name -> (SMTPSettings attribute holding the quota, window seconds)
+WINDOWS = {
+    "minute": ("max_per_minute", 60),
+    "hour": ("max_per_hour", 3600),
+}
+
+
+class RateLimitStopped(Exception):
+    """Raised to threads and tasks waiting for a token when the limiter is closed."""
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at `rate` tokens per second, up
+    to `capacity`. Tokens may go negative: each reservation past zero queues
+    behind the earlier ones and is told how long to wait.
+    """
+
+    def __init__(self, rate, capacity, tokens=None, updated_at=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    def refill(self, now):
+        # Wall-clock time so persisted state still refills across restarts
+        self.tokens = min(self.capacity, self.tokens + max(now - self.updated_at, 0) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, now):
+        """Take one token; return the seconds to wait before using it."""
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """Give back a reserved token that won't be used."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+def _wake(future):
+    # Runs on the future's loop (see RateLimiter.close())
+    if not future.done():
+        future.set_result(None)
+
+
+class RateLimiter:
+    """
+    Per-account message quotas (per minute and/or per hour, from the SMTP
+    settings). acquire() blocks until the account may send another message, so
+    bursts are spread out instead of tripping the relay's limits. Burst size is
+    BURST_FRACTION of the quota.
+
+    Bucket state can be saved and restored (see RateLimitRepository), so a
+    restart doesn't hand out a fresh budget.
+    """
+
+    def __init__(self, saved_state=None):
+        # saved_state: {(account, window): (tokens, updated_at)}
+        self._saved = dict(saved_state or {})
+        self._buckets = {}  # (account, window) -> TokenBucket
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._async_waiters = set()  # (loop, future) of each task in acquire_async(), woken by close()
+        self._pending = {}  # reservation -> buckets its token was taken from (none once refunded), while it waits
+        # Visibility for sizing quotas
+        self.waiting = 0             # threads currently blocked on a quota
+        self.throttled = 0           # messages that had to wait
+        self.throttle_seconds = 0.0  # total time spent waiting
+
+    @staticmethod
+    def account_key(settings):
+        # The relay's quota belongs to the login, not the profile: profiles sharing
+        # an account share its buckets (and their saved state keeps this key)
+        return f"{settings.email}@{settings.server}"
+
+    def acquire(self, settings, wait=True):
+        """
+        Take a token for one message with these settings, blocking until it may
+        be sent. With wait=False the message still counts against the quota
+        (pushing back later sends) but goes out immediately.
+        """
+        delay, reservation = self._reserve(settings, wait)
+        if not delay:
+            return
+        try:
+            if self._closed.wait(delay):
+                raise RateLimitStopped("Scheduler is stopping")
+        finally:
+            self._finish(reservation)
+
+    async def acquire_async(self, settings, wait=True):
+        """acquire() for the asyncio engine: sleeps the task instead of blocking the thread."""
+        delay, reservation = self._reserve(settings, wait)
+        if not delay:
+            return
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._lock:
+            self._async_waiters.add(waiter)
+        try:
+            if not self._closed.is_set():
+                await asyncio.wait((waiter[1],), timeout=delay)
+            if self._closed.is_set():
+                raise RateLimitStopped("Scheduler is stopping")
+        except asyncio.CancelledError:
+            # The send won't happen (the engine is shutting down): its token goes back
+            self._finish(reservation, refund=True)
+            raise
+        finally:
+            with self._lock:
+                self._async_waiters.discard(waiter)
+            self._finish(reservation)
+
+    def try_acquire(self, settings):
+        """Take a token only if one is available right now; returns whether it did."""
+        buckets = self._buckets_for(settings)
+        with self._lock:
+            now = time.time()
+            for bucket in buckets:
+                bucket.refill(now)
+            if any(bucket.tokens < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return True
+
+    def state(self):
+        """Bucket state to persist: {(account, window): (tokens, updated_at)}."""
+        with self._lock:
+            state = dict(self._saved)
+            state.update({key: (bucket.tokens, bucket.updated_at)
+                          for key, bucket in self._buckets.items()})
+        return state
+
+    def stats(self):
+        with self._lock:
+            return {
+                "waiting": self.waiting,
+                "throttled": self.throttled,
+                "throttle_seconds": self.throttle_seconds,
+            }
+
+    def close(self):
+        """
+        Wake every waiting thread and task with RateLimitStopped, giving back
+        the tokens they reserved (before state() is saved).
+        """
+        self._closed.set()
+        with self._lock:
+            for reservation, buckets in self._pending.items():
+                for bucket in buckets:
+                    bucket.refund()
+                self._pending[reservation] = ()
+            waiters = list(self._async_waiters)
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # that loop is closed already
+
+    def _reserve(self, settings, wait):
+        """
+        Take a token; return (the seconds to wait for it, the reservation to
+        pass to _finish()), or (0, None) if the message may go now.
+        """
+        buckets = self._buckets_for(settings)
+        if not buckets:
+            return 0, None
+        with self._lock:
+            now = time.time()
+            delay = max(bucket.reserve(now) for bucket in buckets)
+            if delay <= 0 or not wait:
+                return 0, None
+            self.waiting += 1
+            self.throttled += 1
+            self.throttle_seconds += delay
+            reservation = object()
+            self._pending[reservation] = buckets
+        return delay, reservation
+
+    def _finish(self, reservation, refund=False):
+        """End a wait; with refund, its token goes back unless close() already returned it."""
+        with self._lock:
+            buckets = self._pending.pop(reservation, None)
+            if buckets is None:
+                return
+            self.waiting -= 1
+            if refund:
+                for bucket in buckets:
+                    bucket.refund()
+
+    def _buckets_for(self, settings):
+        """The buckets for each quota set on these settings (none if unlimited)."""
+        account = self.account_key(settings)
+        buckets = []
+        with self._lock:
+            for window, (attribute, seconds) in WINDOWS.items():
+                quota = getattr(settings, attribute)
+                if quota:
+                    buckets.append(self._bucket(account, window, quota, seconds))
+        return buckets
+
+    def _bucket(self, account, window, quota, seconds):
+        # Called with self._lock held
+        rate = quota / seconds
+        capacity = max(1.0, quota * BURST_FRACTION)
+        bucket = self._buckets.get((account, window))
+        if bucket is None:
+            tokens, updated_at = self._saved.pop((account, window), (None, None))
+            bucket = self._buckets[(account, window)] = TokenBucket(rate, capacity, tokens, updated_at)
+        elif bucket.rate != rate:
+            # Quota edited: keep the current balance, apply the new limits
+            bucket.rate, bucket.capacity = rate, capacity
+            bucket.tokens = min(bucket.tokens, capacity)
+        return bucket
@@ -0,0 +1,108 @@
+import base64
+import secrets
+from email import policy
+
+# Most RCPT TO commands per message envelope (relays commonly allow 50-100)
+DEFAULT_RCPT_BATCH_SIZE = 50
+# To: header used when a shared message goes to more than one envelope batch
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+# Stands in for the body in a serialized skeleton message (never valid base64)
+BODY_MARKER = "@@BODY@@"
+# Stands in for each attachment's payload, which is only joined in while sending;
+# filled in with a random token per message (see split_message())
+ATTACHMENT_MARKER = "@@ATTACHMENT-{}@@"
+
+
+def split_recipients(recipients):
+    """Split the stored comma-separated recipients string into addresses."""
+    return [r.strip() for r in recipients.split(",") if r.strip()]
+
+
+def rcpt_batches(addresses, batch_size=DEFAULT_RCPT_BATCH_SIZE):
+    """Yield lists of at most batch_size addresses, one per SMTP envelope."""
+    for start in range(0, len(addresses), batch_size):
+        yield addresses[start:start + batch_size]
+
+
+def serialize(msg):
+    """Encode a message to wire-format bytes once, so it can be sent many times."""
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def header_line(name, value):
+    """One folded, wire-format header line (RFC 2047-encoded if needed)."""
+    if value.isascii() and len(name) + len(value) + 2 <= policy.SMTP.max_line_length and \
+            "\r" not in value and "\n" not in value:
+        # Nothing to encode or fold: skip the (comparatively slow) header parser
+        return f"{name}: {value}\r\n".encode("ascii")
+    return policy.SMTP.fold_binary(name, policy.SMTP.header_store_parse(name, value)[1])
+
+
+def split_message(msg, attachments):
+    """
+    Attach a part for each EncodedAttachment to msg (multipart/mixed if there
+    are any) and serialize it into its pieces: wire-format bytes, with each
+    EncodedAttachment standing where its payload goes, so large payloads are
+    never copied into the message (see message_chunks()). The parts hold a
+    marker that occurs nowhere else in the message, so no subject or body
+    text can be mistaken for one.
+    """
+    if not attachments:
+        return [serialize(msg)]
+    parts = [attachment.to_mime_part() for attachment in attachments]
+    for part in parts:
+        msg.attach(part)
+    while True:
+        marker = ATTACHMENT_MARKER.format(secrets.token_hex(16))
+        for part in parts:
+            part.set_payload(marker + "\n")
+        segments = serialize(msg).split((marker + "\r\n").encode("ascii"))
+        if len(segments) == len(parts) + 1:
+            break
+    pieces = [segments[0]]
+    for attachment, segment in zip(attachments, segments[1:]):
+        pieces += [attachment, segment]
+    return pieces
+
+
+def message_chunks(pieces):
+    """A message's wire-format bytes, a chunk at a time, from its pieces (split_message())."""
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            yield piece
+        else:
+            yield from piece.chunks()
+
+
+def message_size(pieces):
+    """Bytes in a message given as pieces."""
+    return sum(len(piece) if isinstance(piece, bytes) else piece.size for piece in pieces)
+
+
+def is_streamed(pieces):
+    """Whether a message's pieces read attachment payloads from the store as they are sent."""
+    return any(not isinstance(piece, bytes) and piece.streamed for piece in pieces)
+
+
+def personalize(pieces, address):
+    """
+    One recipient's copy of a pre-serialized message that has no To: header:
+    just the folded To: line prepended, so the body is never re-encoded.
+    """
+    return [header_line("To", address)] + pieces
+
+
+def split_at_body(pieces):
+    """
+    Split the pieces of a skeleton message whose text part's payload is
+    BODY_MARKER (with Content-Transfer-Encoding: base64, before any
+    attachment) into the pieces before and after the body, so each copy
+    only has to encode its own body (encode_body()).
+    """
+    head, tail = pieces[0].split(BODY_MARKER.encode("ascii"), 1)
+    return [head], [tail] + pieces[1:]
+
+
+def encode_body(text):
+    """A UTF-8 text body, base64-encoded with CRLF line endings, for split_at_body()."""
+    return base64.encodebytes(text.encode("utf-8")).replace(b"\n", b"\r\n").rstrip(b"\r\n")
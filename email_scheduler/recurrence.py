@@ -0,0 +1,252 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import FrozenSet, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Longest stretch of days searched for the next matching date (covers Feb 29
+# rules and large INTERVALs); rules with no match in it never fire again
+MAX_SEARCH_DAYS = 4 * 366 * 4
+
+WEEKDAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+# Interval counting starts here (a Monday), so "every 2 weeks" is stable
+INTERVAL_ANCHOR = date(1970, 1, 5)
+
+
+@dataclass(frozen=True)
+class Rule:
+    """
+    A parsed recurrence rule: which dates match, and the times of day on
+    them. None for a date field means "any".
+    """
+    freq: str                                   # one of FREQUENCIES
+    interval: int = 1                           # every Nth day/week/month/year
+    months: Optional[FrozenSet[int]] = None     # 1-12
+    month_days: Optional[FrozenSet[int]] = None # 1-31, or -1 = last day, -2 = one before...
+    weekdays: Optional[FrozenSet[int]] = None   # 0 = Monday ... 6 = Sunday
+    day_or: bool = False                        # cron: match month_days OR weekdays
+    times: Tuple[time, ...] = (time(0, 0),)     # sorted times of day
+
+    def matches(self, day):
+        """Whether the rule fires on this date (at any of its times)."""
+        if self.months is not None and day.month not in self.months:
+            return False
+        if self.interval > 1 and self._period_index(day) % self.interval:
+            return False
+
+        by_month_day = self.month_days is None or _month_day_matches(day, self.month_days)
+        by_weekday = self.weekdays is None or day.weekday() in self.weekdays
+        if self.day_or and self.month_days is not None and self.weekdays is not None:
+            return by_month_day or by_weekday
+        return by_month_day and by_weekday
+
+    def _period_index(self, day):
+        if self.freq == "DAILY":
+            return day.toordinal() - INTERVAL_ANCHOR.toordinal()
+        if self.freq == "WEEKLY":
+            return (day.toordinal() - INTERVAL_ANCHOR.toordinal()) // 7
+        if self.freq == "MONTHLY":
+            return (day.year - INTERVAL_ANCHOR.year) * 12 + day.month - 1
+        return day.year - INTERVAL_ANCHOR.year
+
+
+def _month_day_matches(day, month_days):
+    if day.day in month_days:
+        return True
+    # Negative days count back from the end of the month
+    days_in_month = ((day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)).day
+    return day.day - days_in_month - 1 in month_days
+
+
+# ======================= PARSING =========================
+@lru_cache(maxsize=1024)
+def parse_rule(text):
+    """
+    Parse a recurrence rule, either an RRULE (RFC 5545 subset) such as
+    "FREQ=WEEKLY;BYDAY=MO,WE;BYHOUR=9;BYMINUTE=30", or a five-field cron
+    expression such as "30 9 * * 1,3". Raises ValueError if it is invalid.
+    Cached: the same rule text always gives the same (immutable) Rule.
+    """
+    text = (text or "").strip()
+    if text.upper().startswith("RRULE:"):
+        text = text[6:]
+    if "=" in text:
+        return _parse_rrule(text)
+    return _parse_cron(text)
+
+
+def _parse_rrule(text):
+    parts = {}
+    for part in text.split(";"):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        parts[name.strip().upper()] = value.strip().upper()
+
+    freq = parts.pop("FREQ", None)
+    if freq not in FREQUENCIES:
+        raise ValueError(f"FREQ must be one of {', '.join(FREQUENCIES)}")
+    interval = _int_list(parts.pop("INTERVAL", "1"), 1, 1000, "INTERVAL")[0]
+    months = _int_set(parts.pop("BYMONTH", None), 1, 12, "BYMONTH")
+    month_days = _int_set(parts.pop("BYMONTHDAY", None), -31, 31, "BYMONTHDAY")
+    if month_days and 0 in month_days:
+        raise ValueError("BYMONTHDAY can't be 0")
+    weekdays = None
+    if "BYDAY" in parts:
+        try:
+            weekdays = frozenset(WEEKDAYS[day.strip()] for day in parts.pop("BYDAY").split(","))
+        except KeyError:
+            raise ValueError("BYDAY takes MO, TU, WE, TH, FR, SA or SU (no ordinals)") from None
+    hours = _int_list(parts.pop("BYHOUR", "0"), 0, 23, "BYHOUR")
+    minutes = _int_list(parts.pop("BYMINUTE", "0"), 0, 59, "BYMINUTE")
+    seconds = _int_list(parts.pop("BYSECOND", "0"), 0, 59, "BYSECOND")
+    if parts:
+        raise ValueError(f"Unsupported RRULE parts: {', '.join(sorted(parts))}")
+
+    # Without an explicit BY* part, RRULE repeats on the start date's weekday
+    # or day; we have no start date, so ask for it to be spelled out
+    if freq == "WEEKLY" and weekdays is None:
+        raise ValueError("WEEKLY rules need BYDAY")
+    if freq == "MONTHLY" and month_days is None and weekdays is None:
+        raise ValueError("MONTHLY rules need BYMONTHDAY or BYDAY")
+    if freq == "YEARLY" and (months is None or month_days is None):
+        raise ValueError("YEARLY rules need BYMONTH and BYMONTHDAY")
+
+    return Rule(freq, interval, months, month_days, weekdays, False,
+                _times(hours, minutes, seconds))
+
+
+def _parse_cron(text):
+    fields = text.split()
+    if len(fields) != 5:
+        raise ValueError("Expected an RRULE (FREQ=...) or five cron fields: minute hour day month weekday")
+    minute, hour, month_day, month, weekday = fields
+    minutes = _cron_field(minute, 0, 59, "minute")
+    hours = _cron_field(hour, 0, 23, "hour")
+    month_days = _cron_field(month_day, 1, 31, "day of month")
+    months = _cron_field(month, 1, 12, "month")
+    # cron weekdays: 0 or 7 = Sunday
+    weekdays = _cron_field(weekday, 0, 7, "day of week")
+    if weekdays is not None:
+        weekdays = frozenset((day - 1) % 7 for day in weekdays)
+    return Rule("DAILY", 1, months, month_days, weekdays, True,
+                _times(range(24) if hours is None else hours,
+                       range(60) if minutes is None else minutes, [0]))
+
+
+def _cron_field(field, low, high, name):
+    """The set of values a cron field allows, or None for "*"."""
+    if field == "*":
+        return None
+    values = set()
+    for item in field.split(","):
+        spec, _, step = item.partition("/")
+        if spec == "*":
+            start, end = low, high
+        elif "-" in spec:
+            start, end = (_int(value, low, high, name) for value in spec.split("-", 1))
+        else:
+            start = end = _int(spec, low, high, name)
+            if step:
+                end = high
+        values.update(range(start, end + 1, _int(step, 1, high, name) if step else 1))
+    return frozenset(values)
+
+
+def _times(hours, minutes, seconds):
+    return tuple(sorted(time(h, m, s) for h in hours for m in minutes for s in seconds))
+
+
+def _int(value, low, high, name):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name}: {value!r} is not a number") from None
+    if not low <= number <= high:
+        raise ValueError(f"{name}: {number} is outside {low}..{high}")
+    return number
+
+
+def _int_list(value, low, high, name):
+    return sorted({_int(item.strip(), low, high, name) for item in value.split(",")})
+
+
+def _int_set(value, low, high, name):
+    return None if value is None else frozenset(_int_list(value, low, high, name))
+
+
+@lru_cache(maxsize=256)
+def get_zone(name):
+    """The ZoneInfo for an IANA time zone name. Raises ValueError if unknown."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone: {name!r}") from None
+
+
+# ======================= OCCURRENCES =========================
+def next_occurrence(rule, after, zone=None):
+    """
+    The first time the rule fires strictly after `after` (an aware datetime),
+    as an aware datetime, or None if it never fires again. Dates and times
+    of day are evaluated in `zone` (local time if None), so "09:00" stays
+    09:00 across DST changes. A time skipped by a spring-forward gap fires
+    just after the gap; a time repeated by a fall-back fires once.
+    """
+    local_after = after.astimezone(zone)
+    after_ts = after.timestamp()
+    day = local_after.date()
+    # On the first day only times after `after` can match; later days start at the first
+    first = bisect_left(rule.times, local_after.time().replace(microsecond=0, tzinfo=None))
+    for _ in range(MAX_SEARCH_DAYS):
+        if rule.matches(day):
+            for time_of_day in rule.times[first:]:
+                candidate = _localize(datetime.combine(day, time_of_day), zone)
+                if candidate.timestamp() > after_ts:
+                    return candidate
+        day += timedelta(days=1)
+        first = 0
+    return None
+
+
+def latest_occurrences(rules, after, before, limit, zone=None):
+    """
+    The last `limit` times any of the rules fires strictly after `after` and
+    up to `before` (aware datetimes), oldest first, and how many times they
+    fire in that span in all; an instant several rules share counts once.
+    Walks back a day at a time and only looks at individual times on the
+    span's first `limit` occurrences and on days with a UTC offset change,
+    so a long span costs a check per day rather than per occurrence.
+    """
+    after_ts, before_ts = after.timestamp(), before.timestamp()
+    first_day, last_day = after.astimezone(zone).date(), before.astimezone(zone).date()
+    latest, count, day = [], 0, last_day
+    while day >= first_day:
+        times = set().union(*(rule.times for rule in rules if rule.matches(day)))
+        whole_day = first_day < day < last_day and _same_offset_all_day(day, zone)
+        if times and (len(latest) < limit or not whole_day):
+            candidates = {_localize(datetime.combine(day, time_of_day), zone) for time_of_day in times}
+            candidates = sorted((at for at in candidates if after_ts < at.timestamp() <= before_ts),
+                                key=lambda at: at.timestamp(), reverse=True)
+            latest += candidates[:limit - len(latest)]
+            count += len(candidates)
+        else:
+            count += len(times)
+        day -= timedelta(days=1)
+    return latest[::-1], count
+
+
+def _same_offset_all_day(day, zone):
+    start = _localize(datetime.combine(day, time(0, 0)), zone)
+    end = _localize(datetime.combine(day + timedelta(days=1), time(0, 0)), zone)
+    return start.utcoffset() == end.utcoffset()
+
+
+def _localize(naive, zone):
+    if zone is None:
+        return naive.astimezone()  # system local time
+    # fold=0 picks the first of a repeated time; a nonexistent time is read
+    # with the pre-transition offset, i.e. it lands just after the gap
+    return datetime.fromtimestamp(naive.replace(tzinfo=zone).timestamp(), zone)
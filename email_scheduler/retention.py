@@ -0,0 +1,115 @@
+"""
+Keeps the send history from growing without bound: send_log rows older
+than RAW_RETENTION_DAYS are rolled up into hourly totals, hourly totals
+older than HOURLY_RETENTION_DAYS into daily ones. Finished outbox entries
+older than OUTBOX_RETENTION_DAYS, entries of deleted emails and attachment
+contents no email references any more are deleted too, and the freed pages
+are given back with an incremental vacuum. Work is done in small transactions
+so the scheduler's own queries are never held up for long.
+"""
+import logging
+import threading
+import time
+
+from email_scheduler import metrics
+from email_scheduler.db import AttachmentRepository, OutboxRepository, SendLogRepository
+
+logger = logging.getLogger(__name__)
+
+# How often the retention job runs
+RETENTION_INTERVAL_SECONDS = 3600
+# Raw send_log rows are kept this long, hourly totals this long; daily totals forever
+RAW_RETENTION_DAYS = 30
+HOURLY_RETENTION_DAYS = 365
+# Sent, dead and skipped outbox entries (and their attempts) are kept this long after they were due
+OUTBOX_RETENTION_DAYS = 30
+# Unreferenced attachment contents are kept this long after they were last ingested,
+# so a file added in a dialog that is still open isn't collected before it is saved
+UNREFERENCED_ATTACHMENT_SECONDS = 86400
+# send_log rows rolled up per transaction
+ROLLUP_BATCH_ROWS = 5000
+# Outbox entries deleted per transaction
+PRUNE_BATCH_ROWS = 5000
+# Most incremental vacuum steps per run (see Database.vacuum), so a large
+# backlog of free pages is returned over several runs
+MAX_VACUUM_STEPS = 50
+
+ROWS_ROLLED_UP = metrics.counter("send_log_rows_rolled_up", "send_log rows folded into hourly totals")
+OUTBOX_ENTRIES_PRUNED = metrics.counter("outbox_entries_pruned", "Finished or orphaned outbox entries deleted")
+ATTACHMENTS_COLLECTED = metrics.counter("attachments_collected", "Unreferenced attachment contents deleted")
+
+
+def compact(database, now=None, raw_days=RAW_RETENTION_DAYS, hourly_days=HOURLY_RETENTION_DAYS,
+            outbox_days=OUTBOX_RETENTION_DAYS, full_vacuum=False):
+    """
+    Roll up old send history, delete old outbox entries and unreferenced
+    attachment contents and vacuum what that freed (with full_vacuum, by rewriting the whole file,
+    which also converts an older database to incremental vacuuming).
+    Returns the raw rows rolled up.
+    """
+    now = int(now if now is not None else time.time())
+    send_log = SendLogRepository(database)
+    raw_before = now - raw_days * 86400
+    rolled_up = 0
+    while True:
+        count = send_log.roll_up_raw(raw_before, ROLLUP_BATCH_ROWS)
+        rolled_up += count
+        if count < ROLLUP_BATCH_ROWS:
+            break
+    ROWS_ROLLED_UP.inc(rolled_up)
+    # Whole days only, so no day is split between the two tables
+    hourly_before = now - hourly_days * 86400
+    send_log.roll_up_hours(hourly_before - hourly_before % 86400)
+
+    outbox = OutboxRepository(database)
+    pruned = 0
+    while True:
+        count = outbox.prune(now - outbox_days * 86400, now, PRUNE_BATCH_ROWS)
+        pruned += count
+        if count < PRUNE_BATCH_ROWS:
+            break
+    if pruned:
+        OUTBOX_ENTRIES_PRUNED.inc(pruned)
+        logger.info("Deleted %d finished or orphaned outbox entries", pruned)
+
+    collected = AttachmentRepository(database).collect_garbage(now - UNREFERENCED_ATTACHMENT_SECONDS)
+    if collected:
+        ATTACHMENTS_COLLECTED.inc(collected)
+        logger.info("Deleted %d attachments no email uses", collected)
+
+    if full_vacuum:
+        database.vacuum(full=True)
+        return rolled_up
+    for _ in range(MAX_VACUUM_STEPS):
+        if not database.free_pages() or not database.vacuum():
+            break
+    return rolled_up
+
+
+class RetentionJob:
+    """Runs compact() every `interval` seconds on a background thread."""
+
+    def __init__(self, database, interval=RETENTION_INTERVAL_SECONDS):
+        self.database = database
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                rolled_up = compact(self.database)
+                if rolled_up:
+                    logger.info("Rolled up %d old send_log rows", rolled_up)
+            except Exception:
+                # A busy database or full disk shouldn't stop the job for good
+                logger.exception("Send history retention failed")
@@ -0,0 +1,140 @@
+"""
+Picks which SMTP profile (relay) each send goes through.
+
+An email assigned to a profile always uses it. Every other email goes to
+the pool of all profiles, tried healthiest and least loaded first: relays
+are scored on recent latency, error rate and the sends they have in
+progress, and a relay that keeps failing is rested for a while. If a relay
+fails before it has delivered a message, the send fails over to the next.
+
+Profiles are cached in memory and only re-read after invalidate().
+"""
+import threading
+import time
+
+from email_scheduler import metrics
+
+# Weight of the newest observation in the moving averages of latency and error rate
+EWMA_WEIGHT = 0.2
+# Latency assumed for a relay that hasn't sent anything yet (seconds)
+DEFAULT_LATENCY = 0.5
+# How much a relay's score grows with its recent error rate (1.0 errors = this many times slower)
+ERROR_PENALTY = 10
+# Consecutive failures after which a relay is rested; the rest starts at
+# COOLDOWN_BASE_SECONDS and doubles with each further failure up to COOLDOWN_MAX_SECONDS
+FAILURES_BEFORE_COOLDOWN = 3
+COOLDOWN_BASE_SECONDS = 30
+COOLDOWN_MAX_SECONDS = 600
+
+RELAY_SENDS = metrics.counter("relay_sends", "Messages delivered, by SMTP profile", ["profile"])
+RELAY_FAILURES = metrics.counter("relay_failures", "Failed attempts to send through an SMTP profile",
+                                 ["profile"])
+RELAY_FAILOVERS = metrics.counter("relay_failovers", "Sends moved on to another SMTP profile after a failure")
+
+
+class RelayHealth:
+    """Recent behaviour of one relay."""
+
+    def __init__(self):
+        self.latency = None       # moving average of seconds per message
+        self.error_rate = 0.0     # moving average of failures (0 = none, 1 = all)
+        self.in_flight = 0        # sends using the relay right now
+        self.consecutive_failures = 0
+        self.resting_until = 0.0  # time.monotonic() before which the relay is avoided
+
+    def score(self):
+        """Lower is better: expected wait for a send, given the load and errors."""
+        latency = DEFAULT_LATENCY if self.latency is None else self.latency
+        return latency * (self.in_flight + 1) * (1 + ERROR_PENALTY * self.error_rate)
+
+    def snapshot(self):
+        return {
+            "latency": self.latency,
+            "error_rate": round(self.error_rate, 3),
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "resting": self.resting_until > time.monotonic(),
+        }
+
+
+class RelayRouter:
+    """Orders the SMTP profiles for each send and tracks how each one is doing."""
+
+    def __init__(self, load_profiles):
+        self._load_profiles = load_profiles  # returns every SMTPSettings, e.g. SMTPSettingsRepository.list
+        self._profiles = None
+        self._health = {}  # profile id -> RelayHealth (kept across reloads)
+        self._lock = threading.Lock()
+
+    def profiles(self):
+        """Every profile, from the cache (loaded on first use or after invalidate())."""
+        profiles = self._profiles
+        if profiles is None:
+            profiles = self._profiles = self._load_profiles()
+        return profiles
+
+    def invalidate(self):
+        """Re-read the profiles on next use (after they were added, edited or deleted)."""
+        self._profiles = None
+
+    def candidates(self, profile_id=None):
+        """
+        Profiles to try for one send, in order. An assigned profile_id gives
+        just that profile (if it was deleted, the email falls back to the pool);
+        the pool is ordered by score, with resting relays last.
+        """
+        profiles = self.profiles()
+        if profile_id is not None:
+            assigned = [settings for settings in profiles if settings.id == profile_id]
+            if assigned:
+                return assigned
+        now = time.monotonic()
+        with self._lock:
+            health = {settings.id: self._health_of(settings) for settings in profiles}
+            return sorted(profiles, key=lambda settings: (
+                health[settings.id].resting_until > now, health[settings.id].score()
+            ))
+
+    def begin(self, settings):
+        """Count a send as using this relay, until finish()."""
+        with self._lock:
+            self._health_of(settings).in_flight += 1
+
+    def finish(self, settings):
+        with self._lock:
+            self._health_of(settings).in_flight -= 1
+
+    def record_success(self, settings, seconds):
+        """A message went through this relay in the given time."""
+        RELAY_SENDS.labels(settings.name).inc()
+        with self._lock:
+            health = self._health_of(settings)
+            health.latency = seconds if health.latency is None else (
+                EWMA_WEIGHT * seconds + (1 - EWMA_WEIGHT) * health.latency
+            )
+            health.error_rate *= 1 - EWMA_WEIGHT
+            health.consecutive_failures = 0
+            health.resting_until = 0.0
+
+    def record_failure(self, settings):
+        """Sending through this relay failed (connection, login or the server rejected the message)."""
+        RELAY_FAILURES.labels(settings.name).inc()
+        with self._lock:
+            health = self._health_of(settings)
+            health.error_rate = EWMA_WEIGHT + (1 - EWMA_WEIGHT) * health.error_rate
+            health.consecutive_failures += 1
+            extra = health.consecutive_failures - FAILURES_BEFORE_COOLDOWN
+            if extra >= 0:
+                rest = min(COOLDOWN_BASE_SECONDS * 2 ** extra, COOLDOWN_MAX_SECONDS)
+                health.resting_until = time.monotonic() + rest
+
+    def stats(self):
+        """{profile name: health snapshot} for every profile."""
+        with self._lock:
+            return {settings.name: self._health_of(settings).snapshot() for settings in self.profiles()}
+
+    def _health_of(self, settings):
+        health = self._health.get(settings.id)
+        if health is None:
+            health = self._health[settings.id] = RelayHealth()
+        return health
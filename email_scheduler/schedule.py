@@ -0,0 +1,169 @@
+import math
+from datetime import datetime, timedelta
+
+from email_scheduler.recurrence import get_zone, next_occurrence, parse_rule
+
+# Time-mode frequencies the GUI offers; "Custom" takes its rule from the recurrence column
+FREQUENCIES = ("Once", "Daily", "Weekly", "Monthly", "Custom")
+# Interval units accepted by parse_interval(); a bare number means minutes
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# Most days in each month (February has a 29th in leap years)
+MONTH_LENGTHS = {1: 31, 2: 29, 3: 31, 4: 30, 5: 31, 6: 30, 7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
+
+
+def parse_last_sent(last_sent):
+    """Convert a stored ISO last_sent string into a datetime (or None)."""
+    if not last_sent:
+        return None
+    try:
+        return datetime.fromisoformat(last_sent)
+    except ValueError:
+        return None
+
+
+def parse_interval(text):
+    """
+    Parse an interval such as "30s", "15m", "2h" or "1d" into seconds (a
+    bare number is minutes). Raises ValueError unless it is a positive whole number.
+    """
+    text = text.strip().lower()
+    unit = INTERVAL_UNITS.get(text[-1:]) if text[-1:].isalpha() else None
+    number = text[:-1] if unit else text
+    seconds = int(number) * (unit or 60)
+    if seconds <= 0:
+        raise ValueError("Interval must be positive")
+    return seconds
+
+
+def format_interval(seconds):
+    """Display an interval in the largest unit that divides it evenly."""
+    for name, size in (("d", 86400), ("h", 3600), ("min", 60)):
+        if seconds % size == 0:
+            return f"{seconds // size} {name}"
+    return f"{seconds} s"
+
+
+def validate_schedule(mode, frequency, schedule_time, recurrence, timezone):
+    """Return an error message for an invalid Time-mode schedule, or None."""
+    if mode != "Time":
+        return None
+    try:
+        if timezone:
+            get_zone(timezone)
+        if frequency == "Custom":
+            if not recurrence:
+                return "A Custom frequency needs a rule, e.g. FREQ=WEEKLY;BYDAY=MO;BYHOUR=9 or 0 9 * * 1."
+            parse_rule(recurrence)
+            return None
+    except ValueError as e:
+        return f"Invalid schedule: {e}"
+    try:
+        hour, minute = map(int, (schedule_time or "").split(":"))
+        datetime.now().replace(hour=hour, minute=minute)
+    except ValueError:
+        return "Schedule Time must be HH:MM."
+    return None
+
+
+def schedule_rules(frequency, schedule_time, recurrence, anchor, month_day=None):
+    """
+    The recurrence rule texts for a Time-mode schedule, which fires at the
+    earliest next occurrence of any of them. Weekly repeats on the weekday of
+    `anchor` (a date), Monthly on `month_day` (default: the anchor's day). A
+    month too short for month_day fires on its last day instead, and the
+    next month is back on month_day. Raises ValueError for a bad schedule_time.
+    """
+    if frequency == "Custom":
+        return [recurrence]
+    hour, minute = map(int, schedule_time.split(":"))
+    at = f"BYHOUR={hour};BYMINUTE={minute}"
+    if frequency == "Daily":
+        return [f"FREQ=DAILY;{at}"]
+    if frequency == "Weekly":
+        return [f"FREQ=WEEKLY;BYDAY={('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')[anchor.weekday()]};{at}"]
+    if frequency == "Monthly":
+        day = month_day or anchor.day
+        rules = [f"FREQ=MONTHLY;BYMONTHDAY={day};{at}"]
+        short_months = [month for month, length in MONTH_LENGTHS.items() if length < day]
+        if short_months:
+            rules.append(f"FREQ=MONTHLY;BYMONTH={','.join(map(str, short_months))};BYMONTHDAY=-1;{at}")
+        return rules
+    return []
+
+
+def anchor_date(last_sent, anchor=None, now=None, timezone=None):
+    """
+    The date Weekly and Monthly schedules repeat from, in `timezone`: that of
+    `anchor` (the current next_due_at, epoch seconds), else of last_sent, else
+    today. Raises ValueError for an unknown time zone.
+    """
+    zone = get_zone(timezone) if timezone else None
+    if anchor is not None:
+        return datetime.fromtimestamp(anchor, zone).date()
+    last_sent_dt = parse_last_sent(last_sent)
+    if last_sent_dt:
+        return last_sent_dt.astimezone(zone).date()
+    return (now or datetime.now()).astimezone(zone).date()
+
+
+def compute_next_due(mode, frequency, interval_seconds, schedule_time, last_sent, now=None,
+                     recurrence=None, timezone=None, anchor=None, month_day=None):
+    """
+    Return the datetime at which this email becomes due, or None if it will
+    never be sent again (or its schedule is invalid). A due time in the past
+    means "send on the next tick".
+
+    Time-mode schedules are evaluated in `timezone` (an IANA name; local time
+    if None), so they keep their wall-clock time across DST changes. anchor is
+    the current next_due_at (epoch seconds), which fixes the weekday Weekly
+    schedules repeat on; without one, last_sent's date is used (today if
+    never sent). Monthly schedules repeat on month_day, or the anchor's day.
+    """
+    if now is None:
+        now = datetime.now()
+    last_sent_dt = parse_last_sent(last_sent)
+
+    if mode == "Interval":
+        if not interval_seconds or interval_seconds <= 0:
+            return None
+        if not last_sent_dt:
+            return now
+        return last_sent_dt + timedelta(seconds=interval_seconds)
+
+    if mode != "Time" or frequency not in FREQUENCIES:
+        return None
+
+    try:
+        zone = get_zone(timezone) if timezone else None
+        # Stored datetimes are naive local time
+        now = now.astimezone()
+        if frequency == "Once":
+            if last_sent_dt:
+                return None
+            # Never sent: due at today's scheduled time (which may already have passed)
+            hour, minute = map(int, schedule_time.split(":"))
+            local_now = now.astimezone(zone)
+            return local_now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+        rules = [parse_rule(text) for text in schedule_rules(
+            frequency, schedule_time, recurrence, anchor_date(last_sent, anchor, now, timezone), month_day
+        )]
+    except (ValueError, AttributeError):
+        # Invalid schedule_time, rule or time zone
+        return None
+
+    if last_sent_dt:
+        after = last_sent_dt.astimezone()
+    else:
+        # Never sent: the first occurrence from now on
+        after = now.replace(microsecond=0) - timedelta(seconds=1)
+    occurrences = [next_occurrence(rule, after, zone) for rule in rules]
+    return min((occurrence for occurrence in occurrences if occurrence), default=None)
+
+
+def to_epoch(dt):
+    """
+    Convert a datetime to the integer epoch seconds stored in next_due_at,
+    rounding up so an email is never due before its time.
+    """
+    return math.ceil(dt.timestamp()) if dt else None
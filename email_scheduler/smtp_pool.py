@@ -0,0 +1,227 @@
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+
+from email_scheduler import metrics
+
+# Close pooled connections that have not been used for this many seconds
+DEFAULT_IDLE_TIMEOUT = 120
+# Most connections open at once per SMTP settings row (i.e. per server account)
+DEFAULT_MAX_CONNECTIONS_PER_KEY = 4
+# Message bytes collected before each write during DATA: small pieces are joined
+# (separate tiny writes stall on Nagle's algorithm), big payloads aren't
+SEND_BUFFER_BYTES = 64 * 1024
+# Seconds any one socket operation (connect, or a read or write of a command) may block
+DEFAULT_TIMEOUT = 60
+
+SMTP_SECONDS = metrics.histogram("smtp_seconds", "SMTP latency by phase (connect, starttls, login, send)",
+                                 ["phase"])
+SMTP_CONNECTIONS_OPENED = metrics.counter("smtp_connections_opened", "SMTP sessions opened (pool misses)")
+
+
+class _StreamingSMTP:
+    """
+    sendmail_chunks(): sendmail() for a message given in chunks, which are
+    sent as they come instead of being joined first. Also remembers the
+    server's reply to DATA, which smtplib's sendmail() discards.
+    """
+    data_reply = None  # e.g. "2.0.0 Ok: queued as 4FQ2L"
+
+    def sendmail_chunks(self, from_addr, to_addrs, chunks):
+        """
+        Send a message given as an iterable of wire-format (CRLF) byte
+        chunks. Returns the refused recipients and raises as sendmail() does.
+        """
+        self.ehlo_or_helo_if_needed()
+        code, reply = self.mail(from_addr)
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+        refused = {}
+        for address in to_addrs:
+            code, reply = self.rcpt(address)
+            if code not in (250, 251):
+                refused[address] = (code, reply)
+        if len(refused) == len(to_addrs):
+            self._abort(code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, reply = self.docmd("data")
+        if code != 354:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, reply)
+        at_line_start = True
+        buffer, buffered = [], 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            # Dot-stuffing (RFC 5321 4.5.2), also for a line starting a chunk
+            chunk = chunk.replace(b"\n.", b"\n..")
+            if at_line_start and chunk.startswith(b"."):
+                chunk = b"." + chunk
+            at_line_start = chunk.endswith(b"\n")
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= SEND_BUFFER_BYTES:
+                self.send(b"".join(buffer))
+                buffer, buffered = [], 0
+        buffer.append(b".\r\n" if at_line_start else b"\r\n.\r\n")
+        self.send(b"".join(buffer))
+        code, reply = self.getreply()
+        self.data_reply = reply.decode("utf-8", "replace")
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+    def _abort(self, code):
+        # As sendmail(): a 421 reply means the server is closing the connection
+        if code == 421:
+            self.close()
+        else:
+            self._rset()
+
+
+class SMTP(_StreamingSMTP, smtplib.SMTP):
+    pass
+
+
+class SMTP_SSL(_StreamingSMTP, smtplib.SMTP_SSL):
+    pass
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP sessions open between sends, keyed by the
+    smtp_settings row, so consecutive emails skip the connect/TLS/login cost.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connections_per_key=DEFAULT_MAX_CONNECTIONS_PER_KEY, timeout=DEFAULT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.max_connections_per_key = max_connections_per_key
+        self.timeout = timeout
+        self._idle = {}  # settings key -> list of (smtp, last_used)
+        self._slots = {}  # settings key -> semaphore bounding concurrent connections
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    @contextmanager
+    def connection(self, settings):
+        """
+        Yield a logged-in SMTP connection for the given SMTPSettings. The connection goes
+        back to the pool afterwards, unless sending raised. Blocks while the
+        server already has max_connections_per_key connections in use.
+        """
+        key = settings
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_connections_per_key)
+        with slot:
+            smtp = self._acquire(key)
+            try:
+                yield smtp
+            except BaseException:
+                # The session may be half-way through a transaction; don't reuse it
+                self._close(smtp)
+                raise
+            self._release(key, smtp)
+
+    def close_idle(self):
+        """Close every pooled connection that has been idle past the timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._lock:
+            for key in list(self._idle):
+                keep = []
+                for smtp, last_used in self._idle[key]:
+                    if last_used < cutoff:
+                        expired.append(smtp)
+                    else:
+                        keep.append((smtp, last_used))
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for smtp in expired:
+            self._close(smtp)
+
+    def close_all(self):
+        """Close every pooled connection (e.g. when settings change or on shutdown)."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for smtp, _ in connections:
+                self._close(smtp)
+
+    # ----------------------- internals -----------------------
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                if not connections:
+                    break
+                smtp, _ = connections.pop()
+            if self._is_alive(smtp):
+                return smtp
+            self._close(smtp)
+        return self._open(key)
+
+    def _release(self, key, smtp):
+        with self._lock:
+            self._idle.setdefault(key, []).append((smtp, time.monotonic()))
+            self._start_reaper()
+
+    def _open(self, settings):
+        SMTP_CONNECTIONS_OPENED.inc()
+        with SMTP_SECONDS.labels("connect").time():
+            if settings.encryption == "SSL":
+                context = ssl.create_default_context()
+                smtp = SMTP_SSL(settings.server, int(settings.port), context=context, timeout=self.timeout)
+            else:
+                smtp = SMTP(settings.server, int(settings.port), timeout=self.timeout)
+        try:
+            if settings.encryption == "STARTTLS":
+                context = ssl.create_default_context()
+                with SMTP_SECONDS.labels("starttls").time():
+                    smtp.starttls(context=context)
+            with SMTP_SECONDS.labels("login").time():
+                smtp.login(settings.email, settings.password)
+        except BaseException:
+            self._close(smtp)
+            raise
+        return smtp
+
+    @staticmethod
+    def _is_alive(smtp):
+        """Check a pooled connection with NOOP, and RSET any leftover transaction."""
+        try:
+            return smtp.noop()[0] == 250 and smtp.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _start_reaper(self):
+        # Called with self._lock held
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        """Background thread that closes idle connections until the pool is empty."""
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            self.close_idle()
+            with self._lock:
+                if not self._idle:
+                    self._reaper = None
+                    return
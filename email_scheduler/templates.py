@@ -0,0 +1,146 @@
+"""
+Subject and body templates: "Hi {{ recipient_name }}, your report for
+{{ date }}" with values filled in per send (or per recipient).
+
+    {{ name }}               a variable (see Scheduler.template_context)
+    {{ data.column }}        a column of the recipient's row in the email's data file
+    {{ name | fallback }}    fallback text when the value is missing or empty
+
+Templates are compiled once into literal/variable parts and cached by the
+hash of their text, so rendering for each of thousands of recipients is
+just a join.
+"""
+import csv
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.utils import parseaddr
+
+# Compiled templates kept (least recently used are dropped)
+DEFAULT_CACHE_SIZE = 4096
+# Loaded data files kept; a file is reloaded when its mtime or size changes
+DATA_CACHE_SIZE = 16
+# Column (or JSON key) holding the recipient address in a data file
+DATA_KEY = "email"
+# Variables that differ per recipient; a template using none of them renders once per send
+RECIPIENT_VARIABLES = frozenset({"recipient", "recipient_name", "data"})
+
+_PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][\w.]*)\s*(?:\|\s*(.*?)\s*)?\}\}")
+
+
+class Template:
+    """A compiled template: alternating literal text and (path, fallback) placeholders."""
+
+    def __init__(self, text):
+        self.parts = []  # str literals and (path tuple, fallback) tuples
+        position = 0
+        for match in _PLACEHOLDER.finditer(text):
+            if match.start() > position:
+                self.parts.append(text[position:match.start()])
+            self.parts.append((tuple(match.group(1).split(".")), match.group(2) or ""))
+            position = match.end()
+        if position < len(text):
+            self.parts.append(text[position:])
+        self.variables = frozenset(part[0][0] for part in self.parts if isinstance(part, tuple))
+        # Whether rendering gives a different result for each recipient
+        self.per_recipient = bool(self.variables & RECIPIENT_VARIABLES)
+
+    def render(self, context):
+        pieces = []
+        for part in self.parts:
+            if isinstance(part, str):
+                pieces.append(part)
+                continue
+            path, fallback = part
+            value = context
+            for name in path:
+                value = value.get(name) if isinstance(value, dict) else None
+            pieces.append(fallback if value is None or value == "" else str(value))
+        return "".join(pieces)
+
+
+class TemplateCache:
+    """Compiled templates keyed by a hash of their text, least recently used dropped first."""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._templates = OrderedDict()  # text digest -> Template
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        """The compiled template for text, or None if it has no placeholders."""
+        if "{{" not in text:
+            return None  # plain text, the common case: nothing to compile or cache
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+        template = Template(text)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+
+def recipient_variables(address, data):
+    """The per-recipient variables for one address (data: the data file rows by address)."""
+    name, bare = parseaddr(address)
+    bare = bare or address
+    return {
+        "recipient": bare,
+        "recipient_name": name or bare.split("@")[0],
+        "data": data.get(bare.lower(), {}) if data else {},
+    }
+
+
+# ======================= DATA FILES =========================
+def load_data_file(path):
+    """
+    Rows of a CSV (with an "email" column) or JSONL file (objects with an
+    "email" key), keyed by lowercased address. Raises ValueError if invalid.
+    """
+    rows = {}
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = csv.DictReader(f)
+        try:
+            for record in records:
+                address = str(record.get(DATA_KEY) or "").strip().lower()
+                if address:
+                    rows[address] = record
+        except (json.JSONDecodeError, AttributeError, csv.Error) as e:
+            raise ValueError(f"Invalid data file {path}: {e}") from None
+    return rows
+
+
+class DataFileCache:
+    """Loaded data files keyed by (path, mtime, size), so edits to a file are picked up."""
+
+    def __init__(self, max_size=DATA_CACHE_SIZE):
+        self.max_size = max_size
+        self._files = OrderedDict()  # (path, mtime_ns, size) -> rows
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """The rows of a data file (see load_data_file). Raises OSError or ValueError."""
+        file_stat = os.stat(path)
+        key = (os.path.abspath(path), file_stat.st_mtime_ns, file_stat.st_size)
+        with self._lock:
+            rows = self._files.get(key)
+            if rows is not None:
+                self._files.move_to_end(key)
+                return rows
+        rows = load_data_file(path)
+        with self._lock:
+            self._files[key] = rows
+            while len(self._files) > self.max_size:
+                self._files.popitem(last=False)
+        return rows
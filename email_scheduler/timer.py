@@ -0,0 +1,55 @@
+import heapq
+import threading
+
+
+class DueTimer:
+    """
+    In-memory min-heap of upcoming sends, (next_due_at, email_id), so the
+    scheduling loop knows exactly when to wake up without asking the
+    database. Rebuilt from the emails table on startup and kept current as
+    emails are added, edited, deleted and sent.
+
+    Stale heap entries (an email that was rescheduled or deleted) are left
+    in place and skipped lazily; the heap is compacted when they pile up.
+    """
+
+    def __init__(self):
+        self._heap = []  # (next_due_at, email_id), possibly stale
+        self._due = {}   # email_id -> current next_due_at
+        self._lock = threading.Lock()
+
+    def rebuild(self, due_times):
+        """Replace everything with {email_id: next_due_at}."""
+        with self._lock:
+            self._due = {email_id: due for email_id, due in due_times.items() if due is not None}
+            self._compact()
+
+    def update(self, due_times):
+        """Apply {email_id: next_due_at}; None removes an email (never due, or deleted)."""
+        with self._lock:
+            for email_id, due in due_times.items():
+                if due is None:
+                    self._due.pop(email_id, None)
+                elif self._due.get(email_id) != due:
+                    self._due[email_id] = due
+                    heapq.heappush(self._heap, (due, email_id))
+            if len(self._heap) > 2 * len(self._due) + 1024:
+                self._compact()
+
+    def next_due(self):
+        """The earliest next_due_at (epoch seconds), or None if nothing is scheduled."""
+        with self._lock:
+            while self._heap:
+                due, email_id = self._heap[0]
+                if self._due.get(email_id) == due:
+                    return due
+                heapq.heappop(self._heap)
+            return None
+
+    def __len__(self):
+        return len(self._due)
+
+    def _compact(self):
+        # Called with self._lock held
+        self._heap = [(due, email_id) for email_id, due in self._due.items()]
+        heapq.heapify(self._heap)
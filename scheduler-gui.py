@@ -1,72 +1,48 @@
+import os
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import sqlite3
-import smtplib
-import ssl
-import threading
-import time
-from datetime import datetime, timedelta
-import os
-from email.message import EmailMessage  # For adding attachments easily
-
-DB_FILE = "scheduler.db"
-
-def setup_database():
-    """Create (or update) the SQLite database and tables if they don't exist."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Base tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS smtp_settings (
-            id INTEGER PRIMARY KEY,
-            server TEXT,
-            port INTEGER,
-            email TEXT,
-            password TEXT,
-            encryption TEXT
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS emails (
-            id INTEGER PRIMARY KEY,
-            subject TEXT,
-            recipients TEXT,
-            body TEXT,
-            mode TEXT,            -- "Time" or "Interval"
-            frequency TEXT,       -- "Once", "Daily", "Weekly", "Monthly" (for "Time" mode)
-            interval_minutes INTEGER, -- number of minutes for "Interval" mode
-            schedule_time TEXT,   -- "HH:MM" for "Time" mode
-            last_sent TEXT        -- store last sent datetime (ISO format)
-        )
-    """)
-
-    # Ensure the emails table has 'attachment_path' if old DB existed
-    cursor.execute("PRAGMA table_info(emails)")
-    columns_info = cursor.fetchall()
-    existing_cols = [col[1] for col in columns_info]
-    if 'attachment_path' not in existing_cols:
-        cursor.execute("ALTER TABLE emails ADD COLUMN attachment_path TEXT")
-
-    conn.commit()
-    conn.close()
+from datetime import datetime
+
+from email_scheduler.core import Scheduler
+from email_scheduler.db import DB_FILE, Database, Email
+from email_scheduler.recurrence import get_zone
+from email_scheduler.schedule import FREQUENCIES, format_interval, parse_interval, validate_schedule
+# Rows loaded into the schedule list at a time
+PAGE_SIZE = 200
+# "Sort by" choices in the schedule list -> EmailRepository.page() sort names
+SORT_CHOICES = {"ID": "id", "Subject": "subject", "Next Send": "next_due"}
+# "SMTP profile" choice for an email that can go through any profile (the pool)
+ANY_PROFILE = "(any)"
+# "If runs are missed" choices -> misfire policies (see email_scheduler.misfire)
+MISFIRE_CHOICES = {"Send once": "fire_once", "Skip them": "skip", "Send each (up to max)": "fire_all"}
 
 class EmailSchedulerGUI:
-    def __init__(self, root):
+    def __init__(self, root, database):
         self.root = root
         self.root.title("Email Scheduler")
 
-        # Flag to stop the scheduling thread when the app closes
-        self.stop_scheduling = False
+        # The scheduling engine; refresh rows it sends (from its worker thread, via after())
+        self.scheduler = Scheduler(
+            database,
+            on_sent=lambda email_ids: self.root.after(0, self.refresh_emails, email_ids)
+        )
+        self.emails = self.scheduler.emails
+        self.smtp_settings = self.scheduler.smtp_settings
+        self.attachment_store = self.scheduler.attachment_store
+        # SMTP profile name -> SMTPSettings, as listed in the profile dropdown
+        self.smtp_profiles = {}
+        # Email id -> Treeview item, so rows can be updated in place
+        self.email_items = {}
+        # Keyset cursors for the start of each page visited (last = current page)
+        self.page_cursors = [None]
+        self.next_page_cursor = None
 
         self.setup_ui()
         self.load_smtp_settings()
         self.load_scheduled_emails()
 
         # Start the background scheduling thread
-        self.scheduling_thread = threading.Thread(target=self.scheduling_loop, daemon=True)
-        self.scheduling_thread.start()
+        self.scheduler.start()
 
         # Clean up on close
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -77,6 +53,15 @@ class EmailSchedulerGUI:
         self.smtp_frame = ttk.LabelFrame(self.root, text="SMTP Settings")
         self.smtp_frame.pack(fill="x", padx=10, pady=5)
 
+        # Pick a profile to edit, or type a new name to add one
+        ttk.Label(self.smtp_frame, text="Profile:").pack(side="left", padx=5, pady=5)
+        self.profile_var = tk.StringVar()
+        self.profile_dropdown = ttk.Combobox(self.smtp_frame, textvariable=self.profile_var, width=15)
+        self.profile_dropdown.pack(side="left", padx=5, pady=5)
+        self.profile_dropdown.bind(
+            "<<ComboboxSelected>>", lambda event: self.load_smtp_settings(self.profile_var.get())
+        )
+
         ttk.Label(self.smtp_frame, text="SMTP Server:").pack(side="left", padx=5, pady=5)
         self.server_entry = ttk.Entry(self.smtp_frame)
         self.server_entry.pack(side="left", padx=5, pady=5)
@@ -103,16 +88,83 @@ class EmailSchedulerGUI:
         )
         self.encryption_dropdown.pack(side="left", padx=5, pady=5)
 
+        # Sending quotas for this account; blank means unlimited
+        ttk.Label(self.smtp_frame, text="Max/min:").pack(side="left", padx=5, pady=5)
+        self.max_per_minute_entry = ttk.Entry(self.smtp_frame, width=6)
+        self.max_per_minute_entry.pack(side="left", padx=5, pady=5)
+
+        ttk.Label(self.smtp_frame, text="Max/hour:").pack(side="left", padx=5, pady=5)
+        self.max_per_hour_entry = ttk.Entry(self.smtp_frame, width=6)
+        self.max_per_hour_entry.pack(side="left", padx=5, pady=5)
+
         ttk.Button(
             self.smtp_frame,
             text="Save SMTP Settings",
             command=self.save_smtp_settings
-        ).pack(pady=5, padx=5)
+        ).pack(side="left", pady=5, padx=5)
+
+        ttk.Button(
+            self.smtp_frame,
+            text="Delete Profile",
+            command=self.delete_smtp_profile
+        ).pack(side="left", pady=5, padx=5)
 
         # ----------------- Scheduled Emails Frame ------------------
         self.emails_frame = ttk.LabelFrame(self.root, text="Scheduled Emails")
         self.emails_frame.pack(fill="both", expand=True, padx=10, pady=5)
 
+        # Filter / sort bar (applied in SQL, so it stays fast on huge tables)
+        filter_frame = ttk.Frame(self.emails_frame)
+        filter_frame.pack(fill="x", padx=5, pady=5)
+
+        ttk.Label(filter_frame, text="Search:").pack(side="left", padx=5)
+        self.search_entry = ttk.Entry(filter_frame)
+        self.search_entry.pack(side="left", padx=5)
+        self.search_entry.bind("<Return>", lambda event: self.apply_list_filters())
+
+        ttk.Label(filter_frame, text="Mode:").pack(side="left", padx=5)
+        self.filter_mode_var = tk.StringVar(value="All")
+        ttk.Combobox(
+            filter_frame,
+            textvariable=self.filter_mode_var,
+            values=["All", "Time", "Interval"],
+            state="readonly",
+            width=8
+        ).pack(side="left", padx=5)
+
+        ttk.Label(filter_frame, text="Frequency:").pack(side="left", padx=5)
+        self.filter_frequency_var = tk.StringVar(value="All")
+        ttk.Combobox(
+            filter_frame,
+            textvariable=self.filter_frequency_var,
+            values=["All", *FREQUENCIES],
+            state="readonly",
+            width=8
+        ).pack(side="left", padx=5)
+
+        ttk.Label(filter_frame, text="Sort by:").pack(side="left", padx=5)
+        self.sort_var = tk.StringVar(value="ID")
+        ttk.Combobox(
+            filter_frame,
+            textvariable=self.sort_var,
+            values=list(SORT_CHOICES),
+            state="readonly",
+            width=10
+        ).pack(side="left", padx=5)
+
+        self.sort_descending_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            filter_frame,
+            text="Descending",
+            variable=self.sort_descending_var
+        ).pack(side="left", padx=5)
+
+        ttk.Button(
+            filter_frame,
+            text="Apply",
+            command=self.apply_list_filters
+        ).pack(side="left", padx=5)
+
         columns = (
             "ID",
             "Subject",
@@ -133,6 +185,24 @@ class EmailSchedulerGUI:
         button_frame = ttk.Frame(self.emails_frame)
         button_frame.pack(fill="x", padx=5, pady=5)
 
+        # Paging (right-hand side)
+        self.next_page_button = ttk.Button(
+            button_frame,
+            text="Next >",
+            command=self.next_page
+        )
+        self.next_page_button.pack(side="right", padx=5, pady=5)
+
+        self.page_label = ttk.Label(button_frame, text="Page 1")
+        self.page_label.pack(side="right", padx=5, pady=5)
+
+        self.prev_page_button = ttk.Button(
+            button_frame,
+            text="< Prev",
+            command=self.prev_page
+        )
+        self.prev_page_button.pack(side="right", padx=5, pady=5)
+
         self.add_email_button = ttk.Button(
             button_frame,
             text="Add New Email",
@@ -199,13 +269,13 @@ class EmailSchedulerGUI:
         frequency_combobox = ttk.Combobox(
             add_email_win,
             textvariable=frequency_var,
-            values=["Once", "Daily", "Weekly", "Monthly"],
+            values=list(FREQUENCIES),
             state="readonly"
         )
         frequency_combobox.grid(row=4, column=1, padx=5, pady=5, sticky="w")
 
         # Interval (minutes) if mode=Interval
-        ttk.Label(add_email_win, text="Interval (minutes):").grid(row=5, column=0, padx=5, pady=5, sticky="e")
+        ttk.Label(add_email_win, text="Interval (e.g. 15, 30s, 2h):").grid(row=5, column=0, padx=5, pady=5, sticky="e")
         interval_entry = ttk.Entry(add_email_win)
         interval_entry.grid(row=5, column=1, padx=5, pady=5, sticky="w")
 
@@ -214,20 +284,75 @@ class EmailSchedulerGUI:
         schedule_time_entry = ttk.Entry(add_email_win)
         schedule_time_entry.grid(row=6, column=1, padx=5, pady=5, sticky="w")
 
-        # Attachment
-        ttk.Label(add_email_win, text="Attachment (optional):").grid(row=7, column=0, padx=5, pady=5, sticky="e")
-        attachment_entry = ttk.Entry(add_email_win, width=35)
-        attachment_entry.grid(row=7, column=1, padx=5, pady=5, sticky="w")
+        # Attachments
+        collect_attachments = self.attachment_picker(add_email_win, row=7)
 
-        def browse_file():
-            """Open file dialog to pick one attachment."""
-            path = filedialog.askopenfilename()
+        # Per-recipient delivery
+        per_recipient_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            add_email_win,
+            text="Send each recipient their own copy",
+            variable=per_recipient_var
+        ).grid(row=8, column=1, padx=5, pady=5, sticky="w")
+
+        # Templating is opt-in, so braces in existing texts are sent as written
+        templated_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            add_email_win,
+            text="Fill in {{ placeholders }}",
+            variable=templated_var
+        ).grid(row=8, column=2, padx=5, pady=5, sticky="w")
+
+        # Custom recurrence rule (Frequency = Custom)
+        ttk.Label(add_email_win, text="Rule (RRULE or cron):").grid(row=9, column=0, padx=5, pady=5, sticky="e")
+        recurrence_entry = ttk.Entry(add_email_win, width=35)
+        recurrence_entry.grid(row=9, column=1, padx=5, pady=5, sticky="w")
+
+        # Time zone for Time mode (blank = this computer's)
+        ttk.Label(add_email_win, text="Time zone (e.g. Europe/Berlin):").grid(row=10, column=0, padx=5, pady=5, sticky="e")
+        timezone_entry = ttk.Entry(add_email_win)
+        timezone_entry.grid(row=10, column=1, padx=5, pady=5, sticky="w")
+
+        # Data file for {{ data.column }} template values
+        ttk.Label(add_email_win, text="Template data (CSV/JSONL):").grid(row=11, column=0, padx=5, pady=5, sticky="e")
+        template_data_entry = ttk.Entry(add_email_win, width=35)
+        template_data_entry.grid(row=11, column=1, padx=5, pady=5, sticky="w")
+
+        def browse_data_file():
+            path = filedialog.askopenfilename(filetypes=[("Data files", "*.csv *.jsonl"), ("All files", "*")])
             if path:
-                attachment_entry.delete(0, tk.END)
-                attachment_entry.insert(0, path)
+                template_data_entry.delete(0, tk.END)
+                template_data_entry.insert(0, path)
 
-        browse_btn = ttk.Button(add_email_win, text="Browse", command=browse_file)
-        browse_btn.grid(row=7, column=2, padx=5, pady=5, sticky="w")
+        ttk.Button(add_email_win, text="Browse", command=browse_data_file).grid(
+            row=11, column=2, padx=5, pady=5, sticky="w"
+        )
+
+        # SMTP profile to send through (any = the healthiest, least loaded one)
+        profile_ids = self.profile_choices()
+        ttk.Label(add_email_win, text="SMTP profile:").grid(row=12, column=0, padx=5, pady=5, sticky="e")
+        profile_var = tk.StringVar(value=ANY_PROFILE)
+        ttk.Combobox(
+            add_email_win,
+            textvariable=profile_var,
+            values=list(profile_ids),
+            state="readonly"
+        ).grid(row=12, column=1, padx=5, pady=5, sticky="w")
+
+        # What to do about runs missed while the scheduler wasn't running
+        ttk.Label(add_email_win, text="If runs are missed:").grid(row=13, column=0, padx=5, pady=5, sticky="e")
+        misfire_var = tk.StringVar(value=next(iter(MISFIRE_CHOICES)))
+        ttk.Combobox(
+            add_email_win,
+            textvariable=misfire_var,
+            values=list(MISFIRE_CHOICES),
+            state="readonly"
+        ).grid(row=13, column=1, padx=5, pady=5, sticky="w")
+        misfire_cap_frame = ttk.Frame(add_email_win)
+        misfire_cap_frame.grid(row=13, column=2, padx=5, pady=5, sticky="w")
+        ttk.Label(misfire_cap_frame, text="Max:").pack(side="left")
+        misfire_cap_entry = ttk.Entry(misfire_cap_frame, width=6)
+        misfire_cap_entry.pack(side="left", padx=5)
 
         def save_new_email():
             subject = subject_entry.get().strip()
@@ -235,9 +360,12 @@ class EmailSchedulerGUI:
             body = body_text.get("1.0", "end").strip()
             mode = mode_var.get()
             frequency = frequency_var.get()
-            interval_minutes = interval_entry.get().strip()
+            interval_text = interval_entry.get().strip()
             schedule_time = schedule_time_entry.get().strip()
-            attachment_path = attachment_entry.get().strip() or None
+            recurrence = recurrence_entry.get().strip() or None
+            timezone = timezone_entry.get().strip() or None
+            template_data = template_data_entry.get().strip() or None
+            misfire_cap_text = misfire_cap_entry.get().strip()
 
             if not subject:
                 messagebox.showwarning("Warning", "Subject is required.")
@@ -246,42 +374,60 @@ class EmailSchedulerGUI:
                 messagebox.showwarning("Warning", "Recipients are required.")
                 return
 
-            # Convert interval_minutes to integer if possible
+            # Convert the interval to seconds if possible
             interval_val = None
-            if interval_minutes:
+            if interval_text:
                 try:
-                    interval_val = int(interval_minutes)
+                    interval_val = parse_interval(interval_text)
                 except ValueError:
-                    messagebox.showerror("Error", "Interval must be an integer (minutes).")
+                    messagebox.showerror("Error", "Interval must be a whole number of minutes, or e.g. 30s, 15m, 2h.")
                     return
 
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO emails
-                    (subject, recipients, body, mode, frequency,
-                     interval_minutes, schedule_time, last_sent, attachment_path)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                subject,
-                recipients,
-                body,
-                mode,
-                frequency,
-                interval_val,
-                schedule_time if schedule_time else None,
-                None,  # last_sent is null initially
-                attachment_path
+            if template_data and not os.path.isfile(template_data):
+                messagebox.showerror("Error", "Template data file not found.")
+                return
+
+            if misfire_cap_text and not (misfire_cap_text.isdigit() and int(misfire_cap_text) > 0):
+                messagebox.showerror("Error", "The most missed runs to send must be a positive whole number.")
+                return
+
+            error = validate_schedule(mode, frequency, schedule_time, recurrence, timezone)
+            if error:
+                messagebox.showerror("Error", error)
+                return
+
+            try:
+                attachments = collect_attachments()
+            except OSError as e:
+                messagebox.showerror("Error", f"Can't read the attachment: {e}")
+                return
+
+            email_id = self.emails.add(Email(
+                subject=subject,
+                recipients=recipients,
+                body=body,
+                mode=mode,
+                frequency=frequency,
+                interval_seconds=interval_val,
+                schedule_time=schedule_time if schedule_time else None,
+                attachments=attachments,
+                per_recipient=per_recipient_var.get(),
+                templated=templated_var.get(),
+                recurrence=recurrence,
+                timezone=timezone,
+                template_data=template_data,
+                smtp_profile_id=profile_ids[profile_var.get()],
+                misfire_policy=MISFIRE_CHOICES[misfire_var.get()],
+                misfire_cap=int(misfire_cap_text) if misfire_cap_text else None
             ))
-            conn.commit()
-            conn.close()
 
-            self.load_scheduled_emails()
+            self.scheduler.notify_changed(email_id)
+            self.load_scheduled_emails()  # Reload the current page so the new row can appear
             messagebox.showinfo("Success", "New email scheduled!")
             add_email_win.destroy()
 
         ttk.Button(add_email_win, text="Save", command=save_new_email).grid(
-            row=8, column=0, columnspan=3, padx=5, pady=10
+            row=14, column=0, columnspan=3, padx=5, pady=10
         )
 
     # ======================= EDIT SELECTED EMAIL =========================
@@ -296,45 +442,36 @@ class EmailSchedulerGUI:
         email_id = item["values"][0]
 
         # Load the row fully from DB
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""SELECT subject, recipients, body, mode, frequency,
-                                 interval_minutes, schedule_time, attachment_path
-                          FROM emails WHERE id=?""", (email_id,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if not row:
+        email = self.emails.get(email_id)
+
+        if not email:
             messagebox.showerror("Error", "Failed to retrieve email details.")
             return
 
-        (old_subject, old_recipients, old_body, old_mode,
-         old_frequency, old_interval, old_schedule_time, old_attachment) = row
-
         edit_win = tk.Toplevel(self.root)
         edit_win.title("Edit Scheduled Email")
 
         # Subject
         ttk.Label(edit_win, text="Subject:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
         subject_entry = ttk.Entry(edit_win)
-        subject_entry.insert(0, old_subject)
+        subject_entry.insert(0, email.subject)
         subject_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
 
         # Recipients
         ttk.Label(edit_win, text="Recipients:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
         recipients_entry = ttk.Entry(edit_win)
-        recipients_entry.insert(0, old_recipients)
+        recipients_entry.insert(0, email.recipients)
         recipients_entry.grid(row=1, column=1, padx=5, pady=5, sticky="w")
 
         # Body
         ttk.Label(edit_win, text="Body:").grid(row=2, column=0, padx=5, pady=5, sticky="ne")
         body_text = tk.Text(edit_win, width=40, height=5)
-        body_text.insert("1.0", old_body)
+        body_text.insert("1.0", email.body)
         body_text.grid(row=2, column=1, padx=5, pady=5, sticky="w")
 
         # Mode
         ttk.Label(edit_win, text="Mode:").grid(row=3, column=0, padx=5, pady=5, sticky="e")
-        mode_var = tk.StringVar(value=old_mode)
+        mode_var = tk.StringVar(value=email.mode)
         mode_combobox = ttk.Combobox(
             edit_win,
             textvariable=mode_var,
@@ -345,42 +482,102 @@ class EmailSchedulerGUI:
 
         # Frequency
         ttk.Label(edit_win, text="Frequency:").grid(row=4, column=0, padx=5, pady=5, sticky="e")
-        frequency_var = tk.StringVar(value=old_frequency)
+        frequency_var = tk.StringVar(value=email.frequency)
         frequency_combobox = ttk.Combobox(
             edit_win,
             textvariable=frequency_var,
-            values=["Once", "Daily", "Weekly", "Monthly"],
+            values=list(FREQUENCIES),
             state="readonly"
         )
         frequency_combobox.grid(row=4, column=1, padx=5, pady=5, sticky="w")
 
         # Interval
-        ttk.Label(edit_win, text="Interval (minutes):").grid(row=5, column=0, padx=5, pady=5, sticky="e")
+        ttk.Label(edit_win, text="Interval (e.g. 15, 30s, 2h):").grid(row=5, column=0, padx=5, pady=5, sticky="e")
         interval_entry = ttk.Entry(edit_win)
-        interval_entry.insert(0, "" if old_interval is None else str(old_interval))
+        interval_entry.insert(0, "" if email.interval_seconds is None else f"{email.interval_seconds}s")
         interval_entry.grid(row=5, column=1, padx=5, pady=5, sticky="w")
 
         # Schedule Time
         ttk.Label(edit_win, text="Schedule Time (HH:MM):").grid(row=6, column=0, padx=5, pady=5, sticky="e")
         schedule_time_entry = ttk.Entry(edit_win)
-        schedule_time_entry.insert(0, "" if old_schedule_time is None else old_schedule_time)
+        schedule_time_entry.insert(0, "" if email.schedule_time is None else email.schedule_time)
         schedule_time_entry.grid(row=6, column=1, padx=5, pady=5, sticky="w")
 
-        # Attachment
-        ttk.Label(edit_win, text="Attachment (optional):").grid(row=7, column=0, padx=5, pady=5, sticky="e")
-        attachment_entry = ttk.Entry(edit_win, width=35)
-        if old_attachment:
-            attachment_entry.insert(0, old_attachment)
-        attachment_entry.grid(row=7, column=1, padx=5, pady=5, sticky="w")
+        # Attachments
+        collect_attachments = self.attachment_picker(edit_win, row=7, attachments=email.attachments)
 
-        def browse_file_edit():
-            path = filedialog.askopenfilename()
+        # Per-recipient delivery
+        per_recipient_var = tk.BooleanVar(value=email.per_recipient)
+        ttk.Checkbutton(
+            edit_win,
+            text="Send each recipient their own copy",
+            variable=per_recipient_var
+        ).grid(row=8, column=1, padx=5, pady=5, sticky="w")
+
+        # Templating is opt-in, so braces in existing texts are sent as written
+        templated_var = tk.BooleanVar(value=email.templated)
+        ttk.Checkbutton(
+            edit_win,
+            text="Fill in {{ placeholders }}",
+            variable=templated_var
+        ).grid(row=8, column=2, padx=5, pady=5, sticky="w")
+
+        # Custom recurrence rule
+        ttk.Label(edit_win, text="Rule (RRULE or cron):").grid(row=9, column=0, padx=5, pady=5, sticky="e")
+        recurrence_entry = ttk.Entry(edit_win, width=35)
+        recurrence_entry.insert(0, email.recurrence or "")
+        recurrence_entry.grid(row=9, column=1, padx=5, pady=5, sticky="w")
+
+        # Time zone
+        ttk.Label(edit_win, text="Time zone (e.g. Europe/Berlin):").grid(row=10, column=0, padx=5, pady=5, sticky="e")
+        timezone_entry = ttk.Entry(edit_win)
+        timezone_entry.insert(0, email.timezone or "")
+        timezone_entry.grid(row=10, column=1, padx=5, pady=5, sticky="w")
+
+        # Data file for {{ data.column }} template values
+        ttk.Label(edit_win, text="Template data (CSV/JSONL):").grid(row=11, column=0, padx=5, pady=5, sticky="e")
+        template_data_entry = ttk.Entry(edit_win, width=35)
+        template_data_entry.insert(0, email.template_data or "")
+        template_data_entry.grid(row=11, column=1, padx=5, pady=5, sticky="w")
+
+        def browse_data_file_edit():
+            path = filedialog.askopenfilename(filetypes=[("Data files", "*.csv *.jsonl"), ("All files", "*")])
             if path:
-                attachment_entry.delete(0, tk.END)
-                attachment_entry.insert(0, path)
+                template_data_entry.delete(0, tk.END)
+                template_data_entry.insert(0, path)
 
-        browse_btn = ttk.Button(edit_win, text="Browse", command=browse_file_edit)
-        browse_btn.grid(row=7, column=2, padx=5, pady=5, sticky="w")
+        ttk.Button(edit_win, text="Browse", command=browse_data_file_edit).grid(
+            row=11, column=2, padx=5, pady=5, sticky="w"
+        )
+
+        # SMTP profile to send through
+        profile_ids = self.profile_choices()
+        profile_names = {profile_id: name for name, profile_id in profile_ids.items()}
+        ttk.Label(edit_win, text="SMTP profile:").grid(row=12, column=0, padx=5, pady=5, sticky="e")
+        profile_var = tk.StringVar(value=profile_names.get(email.smtp_profile_id, ANY_PROFILE))
+        ttk.Combobox(
+            edit_win,
+            textvariable=profile_var,
+            values=list(profile_ids),
+            state="readonly"
+        ).grid(row=12, column=1, padx=5, pady=5, sticky="w")
+
+        # What to do about runs missed while the scheduler wasn't running
+        misfire_names = {policy: name for name, policy in MISFIRE_CHOICES.items()}
+        ttk.Label(edit_win, text="If runs are missed:").grid(row=13, column=0, padx=5, pady=5, sticky="e")
+        misfire_var = tk.StringVar(value=misfire_names.get(email.misfire_policy, next(iter(MISFIRE_CHOICES))))
+        ttk.Combobox(
+            edit_win,
+            textvariable=misfire_var,
+            values=list(MISFIRE_CHOICES),
+            state="readonly"
+        ).grid(row=13, column=1, padx=5, pady=5, sticky="w")
+        misfire_cap_frame = ttk.Frame(edit_win)
+        misfire_cap_frame.grid(row=13, column=2, padx=5, pady=5, sticky="w")
+        ttk.Label(misfire_cap_frame, text="Max:").pack(side="left")
+        misfire_cap_entry = ttk.Entry(misfire_cap_frame, width=6)
+        misfire_cap_entry.insert(0, "" if email.misfire_cap is None else email.misfire_cap)
+        misfire_cap_entry.pack(side="left", padx=5)
 
         def save_changes():
             """Update the email entry in the database."""
@@ -391,7 +588,10 @@ class EmailSchedulerGUI:
             new_frequency = frequency_var.get()
             new_interval_str = interval_entry.get().strip()
             new_schedule_time = schedule_time_entry.get().strip() or None
-            new_attachment = attachment_entry.get().strip() or None
+            new_recurrence = recurrence_entry.get().strip() or None
+            new_timezone = timezone_entry.get().strip() or None
+            new_template_data = template_data_entry.get().strip() or None
+            new_misfire_cap = misfire_cap_entry.get().strip()
 
             if not new_subject:
                 messagebox.showwarning("Warning", "Subject is required.")
@@ -404,46 +604,92 @@ class EmailSchedulerGUI:
             new_interval = None
             if new_interval_str:
                 try:
-                    new_interval = int(new_interval_str)
+                    new_interval = parse_interval(new_interval_str)
                 except ValueError:
-                    messagebox.showerror("Error", "Interval must be an integer.")
+                    messagebox.showerror("Error", "Interval must be a whole number of minutes, or e.g. 30s, 15m, 2h.")
                     return
 
-            conn2 = sqlite3.connect(DB_FILE)
-            cursor2 = conn2.cursor()
-            cursor2.execute("""
-                UPDATE emails
-                SET subject=?,
-                    recipients=?,
-                    body=?,
-                    mode=?,
-                    frequency=?,
-                    interval_minutes=?,
-                    schedule_time=?,
-                    attachment_path=?
-                WHERE id=?
-            """, (
-                new_subject,
-                new_recipients,
-                new_body,
-                new_mode,
-                new_frequency,
-                new_interval,
-                new_schedule_time,
-                new_attachment,
-                email_id
-            ))
-            conn2.commit()
-            conn2.close()
+            if new_template_data and not os.path.isfile(new_template_data):
+                messagebox.showerror("Error", "Template data file not found.")
+                return
 
-            self.load_scheduled_emails()
+            if new_misfire_cap and not (new_misfire_cap.isdigit() and int(new_misfire_cap) > 0):
+                messagebox.showerror("Error", "The most missed runs to send must be a positive whole number.")
+                return
+
+            error = validate_schedule(new_mode, new_frequency, new_schedule_time, new_recurrence, new_timezone)
+            if error:
+                messagebox.showerror("Error", error)
+                return
+
+            try:
+                new_attachments = collect_attachments()
+            except OSError as e:
+                messagebox.showerror("Error", f"Can't read the attachment: {e}")
+                return
+
+            email.subject = new_subject
+            email.recipients = new_recipients
+            email.body = new_body
+            email.mode = new_mode
+            email.frequency = new_frequency
+            email.interval_seconds = new_interval
+            email.schedule_time = new_schedule_time
+            email.attachments = new_attachments
+            email.per_recipient = per_recipient_var.get()
+            email.templated = templated_var.get()
+            email.recurrence = new_recurrence
+            email.timezone = new_timezone
+            email.template_data = new_template_data
+            email.smtp_profile_id = profile_ids[profile_var.get()]
+            email.misfire_policy = MISFIRE_CHOICES[misfire_var.get()]
+            email.misfire_cap = int(new_misfire_cap) if new_misfire_cap else None
+            self.emails.update(email)
+
+            self.scheduler.notify_changed(email_id)
+            self.refresh_emails([email_id])
             messagebox.showinfo("Success", "Email updated successfully!")
             edit_win.destroy()
 
         ttk.Button(edit_win, text="Save Changes", command=save_changes).grid(
-            row=8, column=0, columnspan=3, padx=5, pady=10
+            row=14, column=0, columnspan=3, padx=5, pady=10
         )
 
+    # ======================= ATTACHMENTS =========================
+    def attachment_picker(self, window, row, attachments=()):
+        """
+        Attachment list with Add/Remove buttons on the given row of an add or
+        edit window. Returns a function giving the chosen Attachments, which
+        first copies newly added files into the attachment store (raising
+        OSError if one can't be read).
+        """
+        ttk.Label(window, text="Attachments (optional):").grid(row=row, column=0, padx=5, pady=5, sticky="ne")
+        # Attachments already stored, or paths of files added in this window
+        items = list(attachments)
+        listbox = tk.Listbox(window, width=35, height=3, selectmode=tk.EXTENDED)
+        listbox.grid(row=row, column=1, padx=5, pady=5, sticky="w")
+        for attachment in items:
+            listbox.insert(tk.END, attachment.filename)
+
+        def add_files():
+            for path in filedialog.askopenfilenames():
+                items.append(path)
+                listbox.insert(tk.END, os.path.basename(path))
+
+        def remove_selected():
+            for index in reversed(listbox.curselection()):
+                listbox.delete(index)
+                del items[index]
+
+        buttons = ttk.Frame(window)
+        buttons.grid(row=row, column=2, padx=5, pady=5, sticky="nw")
+        ttk.Button(buttons, text="Add...", command=add_files).pack(fill="x")
+        ttk.Button(buttons, text="Remove", command=remove_selected).pack(fill="x", pady=(5, 0))
+
+        def collect():
+            return [self.attachment_store.ingest(item) if isinstance(item, str) else item for item in items]
+        return collect
+
     # ======================= DELETE SELECTED EMAIL =========================
     def delete_selected_email(self):
         selected_item = self.email_list.selection()
@@ -457,13 +703,10 @@ class EmailSchedulerGUI:
         if not messagebox.askyesno("Confirm", "Are you sure you want to delete this email?"):
             return
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM emails WHERE id=?", (email_id,))
-        conn.commit()
-        conn.close()
+        self.emails.delete(email_id)
+        self.scheduler.notify_changed(email_id)
 
-        self.load_scheduled_emails()
+        self.refresh_emails([email_id])
         messagebox.showinfo("Success", "Email deleted successfully!")
 
     # ======================= SEND NOW (MANUAL) =========================
@@ -478,366 +721,209 @@ class EmailSchedulerGUI:
         email_id = item["values"][0]
 
         # Fetch email details
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""SELECT subject, recipients, body, attachment_path
-                          FROM emails WHERE id=?""", (email_id,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if not row:
+        email = self.emails.get(email_id)
+
+        if not email:
             messagebox.showerror("Error", "Unable to fetch selected email from database.")
             return
 
-        subject, recipients, body, attachment_path = row
         try:
-            self.send_email(subject, recipients, body, attachment_path)
-            # Update last_sent since we manually sent
-            conn2 = sqlite3.connect(DB_FILE)
-            c2 = conn2.cursor()
-            c2.execute("UPDATE emails SET last_sent=? WHERE id=?", (datetime.now().isoformat(), email_id))
-            conn2.commit()
-            conn2.close()
-
-            self.load_scheduled_emails()  # Refresh so 'Last Sent' updates
-            messagebox.showinfo("Success", "Email sent successfully!")
+            sent = self.scheduler.send_now(email)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send email: {e}")
+            return
 
-    # ======================= ACTUAL EMAIL SENDING LOGIC (WITH ATTACHMENT) =========================
-    def send_email(self, subject, recipients, body, attachment_path=None):
-        """Sends the email using the currently stored SMTP settings (with optional attachment)."""
-        # Load SMTP settings from DB
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT server, port, email, password, encryption FROM smtp_settings")
-        settings = cursor.fetchone()
-        conn.close()
+        if not sent:
+            messagebox.showwarning("Warning", "This email is already being sent.")
+            return
 
-        if not settings:
-            raise ValueError("SMTP settings not configured!")
-
-        server, port, sender_email, password, encryption = settings
-
-        # Build an EmailMessage, explicitly specifying UTF-8 text:
-        msg = EmailMessage()
-        msg["Subject"] = subject
-        msg["From"] = sender_email
-        msg["To"] = recipients
-        # The line below ensures the body is plain text, UTF-8
-        msg.set_content(body, subtype='plain', charset='utf-8')
-
-        # If there's an attachment, add it
-        if attachment_path and os.path.isfile(attachment_path):
-            with open(attachment_path, "rb") as f:
-                file_data = f.read()
-                file_name = os.path.basename(attachment_path)
-            # Attempt to guess the MIME type based on the filename
-            import mimetypes
-            mime_type, _ = mimetypes.guess_type(file_name)
-            if not mime_type:
-                mime_type = "application/octet-stream"
-            maintype, subtype = mime_type.split("/", 1)
-
-            msg.add_attachment(
-                file_data,
-                maintype=maintype,
-                subtype=subtype,
-                filename=file_name
-            )
-
-        recipient_list = [r.strip() for r in recipients.split(",") if r.strip()]
-
-        if encryption == "SSL":
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(server, int(port), context=context) as smtp:
-                smtp.login(sender_email, password)
-                smtp.send_message(msg, from_addr=sender_email, to_addrs=recipient_list)
-        elif encryption == "STARTTLS":
-            context = ssl.create_default_context()
-            with smtplib.SMTP(server, int(port)) as smtp:
-                smtp.starttls(context=context)
-                smtp.login(sender_email, password)
-                smtp.send_message(msg, from_addr=sender_email, to_addrs=recipient_list)
-        else:
-            # No encryption
-            with smtplib.SMTP(server, int(port)) as smtp:
-                smtp.login(sender_email, password)
-                smtp.send_message(msg, from_addr=sender_email, to_addrs=recipient_list)
-
-    # ======================= SCHEDULING LOGIC (BACKGROUND) =========================
-    def scheduling_loop(self):
-        """Background thread that periodically checks if any email should be sent."""
-        while not self.stop_scheduling:
-            self.check_schedules()
-            time.sleep(60)  # Check every 60 seconds
-
-    def check_schedules(self):
-        """Fetch all emails from DB, determine if they should be sent, and send them."""
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, subject, recipients, body, mode, frequency,
-                   interval_minutes, schedule_time, last_sent, attachment_path
-            FROM emails
-        """)
-        emails = cursor.fetchall()
-        conn.close()
-
-        now = datetime.now()
-        for (
-            email_id, subject, recipients, body, mode, frequency,
-            interval_minutes, schedule_time, last_sent, attachment_path
-        ) in emails:
-            # Convert last_sent from string to datetime (or None)
-            last_sent_dt = None
-            if last_sent:
-                try:
-                    last_sent_dt = datetime.fromisoformat(last_sent)
-                except ValueError:
-                    last_sent_dt = None
-
-            # Decide if it’s time to send
-            need_to_send = False
-
-            if mode == "Interval":
-                if interval_minutes and interval_minutes > 0:
-                    if not last_sent_dt:
-                        # Never sent
-                        need_to_send = True
-                    else:
-                        delta = now - last_sent_dt
-                        if delta.total_seconds() >= interval_minutes * 60:
-                            need_to_send = True
-
-            elif mode == "Time":
-                if schedule_time:
-                    try:
-                        sched_hour, sched_min = map(int, schedule_time.split(":"))
-                    except:
-                        # Invalid schedule_time format
-                        continue
-                    scheduled_today = now.replace(hour=sched_hour, minute=sched_min, second=0, microsecond=0)
-
-                    if frequency == "Once":
-                        if not last_sent_dt and now >= scheduled_today:
-                            need_to_send = True
-                    elif frequency == "Daily":
-                        if now >= scheduled_today:
-                            if not last_sent_dt or last_sent_dt.date() < now.date():
-                                need_to_send = True
-                    elif frequency == "Weekly":
-                        # Simplistic approach: 7-day intervals
-                        if now >= scheduled_today:
-                            if not last_sent_dt or (now - last_sent_dt) >= timedelta(days=7):
-                                need_to_send = True
-                    elif frequency == "Monthly":
-                        # Simplistic approach: 30-day intervals
-                        if now >= scheduled_today:
-                            if not last_sent_dt or (now - last_sent_dt) >= timedelta(days=30):
-                                need_to_send = True
-
-            if need_to_send:
-                try:
-                    self.send_email(subject, recipients, body, attachment_path)
-                    # Update last_sent in DB
-                    conn2 = sqlite3.connect(DB_FILE)
-                    cursor2 = conn2.cursor()
-                    cursor2.execute("""
-                        UPDATE emails SET last_sent=? WHERE id=?
-                    """, (datetime.now().isoformat(), email_id))
-                    conn2.commit()
-                    conn2.close()
-
-                    # Refresh the UI so "Last Sent" updates immediately
-                    self.root.after(0, self.load_scheduled_emails)
-
-                except Exception as e:
-                    print(f"Error sending scheduled email (ID: {email_id}): {e}")
+        self.refresh_emails([email_id])  # Refresh so 'Last Sent' updates
+        messagebox.showinfo("Success", "Email sent successfully!")
 
     # ======================= SMTP SETTINGS =========================
     def save_smtp_settings(self):
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM smtp_settings")
-        cursor.execute("""
-            INSERT INTO smtp_settings (server, port, email, password, encryption)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
+        """Save the fields as the profile named in the dropdown (a new name adds a profile)."""
+        try:
+            quotas = [int(entry.get()) if entry.get().strip() else None
+                      for entry in (self.max_per_minute_entry, self.max_per_hour_entry)]
+        except ValueError:
+            messagebox.showerror("Error", "Sending limits must be whole numbers (or blank for no limit).")
+            return
+        if any(quota is not None and quota <= 0 for quota in quotas):
+            messagebox.showerror("Error", "Sending limits must be greater than zero.")
+            return
+
+        name = self.profile_var.get().strip() or self.email_entry.get().strip()
+        if not name:
+            messagebox.showwarning("Warning", "Enter a profile name or email address.")
+            return
+        self.smtp_settings.save(
             self.server_entry.get(),
             self.port_entry.get(),
             self.email_entry.get(),
             self.password_entry.get(),
-            self.encryption_var.get()
-        ))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Success", "SMTP settings saved!")
-
-    def load_smtp_settings(self):
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT server, port, email, password, encryption FROM smtp_settings")
-        settings = cursor.fetchone()
-        conn.close()
-
-        if settings:
-            self.server_entry.delete(0, tk.END)
-            self.server_entry.insert(0, settings[0])
-            self.port_entry.delete(0, tk.END)
-            self.port_entry.insert(0, settings[1])
-            self.email_entry.delete(0, tk.END)
-            self.email_entry.insert(0, settings[2])
-            self.password_entry.delete(0, tk.END)
-            self.password_entry.insert(0, settings[3])
-            self.encryption_var.set(settings[4])
+            self.encryption_var.get(),
+            *quotas,
+            name=name
+        )
+        # Reload the profiles; connections logged in with the old settings are no longer wanted
+        self.scheduler.settings_changed()
+        self.load_smtp_settings(name)
+        messagebox.showinfo("Success", f"SMTP profile {name!r} saved!")
+
+    def delete_smtp_profile(self):
+        settings = self.smtp_profiles.get(self.profile_var.get())
+        if not settings:
+            messagebox.showwarning("Warning", "Please select a saved profile to delete.")
+            return
+        if not messagebox.askyesno("Confirm", f"Delete SMTP profile {settings.name!r}? "
+                                              "Emails assigned to it will use any profile."):
+            return
+
+        self.smtp_settings.delete(settings.id)
+        self.scheduler.settings_changed()
+        self.load_smtp_settings()
+
+    def load_smtp_settings(self, name=None):
+        """Refresh the profile dropdown and show the named profile (default: the first)."""
+        self.smtp_profiles = {settings.name: settings for settings in self.smtp_settings.list()}
+        self.profile_dropdown["values"] = list(self.smtp_profiles)
+        settings = self.smtp_profiles.get(name) or next(iter(self.smtp_profiles.values()), None)
+
+        self.profile_var.set(settings.name if settings else "")
+        for entry, value in (
+            (self.server_entry, settings.server if settings else ""),
+            (self.port_entry, settings.port if settings else ""),
+            (self.email_entry, settings.email if settings else ""),
+            (self.password_entry, settings.password if settings else ""),
+            (self.max_per_minute_entry, (settings.max_per_minute or "") if settings else ""),
+            (self.max_per_hour_entry, (settings.max_per_hour or "") if settings else ""),
+        ):
+            entry.delete(0, tk.END)
+            entry.insert(0, value)
+        self.encryption_var.set(settings.encryption if settings else "SSL")
+
+    def profile_choices(self):
+        """Choices for an email's SMTP profile: name -> profile id (None = any)."""
+        choices = {ANY_PROFILE: None}
+        choices.update((settings.name, settings.id) for settings in self.smtp_settings.list())
+        return choices
 
     # ======================= LOAD SCHEDULED EMAILS =========================
     def load_scheduled_emails(self):
-        """Loads scheduled emails from DB into the Treeview, including last/next send."""
+        """Loads the current page of scheduled emails from DB into the Treeview."""
+        emails, self.next_page_cursor = self.emails.page(
+            search=self.search_entry.get().strip() or None,
+            mode=None if self.filter_mode_var.get() == "All" else self.filter_mode_var.get(),
+            frequency=None if self.filter_frequency_var.get() == "All" else self.filter_frequency_var.get(),
+            sort=SORT_CHOICES[self.sort_var.get()],
+            descending=self.sort_descending_var.get(),
+            after=self.page_cursors[-1],
+            limit=PAGE_SIZE
+        )
+
         self.email_list.delete(*self.email_list.get_children())
+        self.email_items = {}
+        for email in emails:
+            values = self.format_email_row(email)
+            self.email_items[email.id] = self.email_list.insert("", "end", values=values)
+
+        self.page_label.config(text=f"Page {len(self.page_cursors)}")
+        self.prev_page_button.state(["!disabled" if len(self.page_cursors) > 1 else "disabled"])
+        self.next_page_button.state(["!disabled" if self.next_page_cursor else "disabled"])
+
+    def apply_list_filters(self):
+        """Re-run the list query with the current filters, from the first page."""
+        self.page_cursors = [None]
+        self.load_scheduled_emails()
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT
-                id, subject, recipients, mode, frequency, interval_minutes,
-                schedule_time, last_sent
-            FROM emails
-        """)
-        rows = cursor.fetchall()
-        conn.close()
-
-        for row in rows:
-            (
-                email_id, subject, recipients, mode,
-                frequency, interval_minutes, schedule_time, last_sent
-            ) = row
-
-            # Convert last_sent to a display string
-            if last_sent:
-                try:
-                    last_sent_dt = datetime.fromisoformat(last_sent)
-                    last_sent_str = last_sent_dt.strftime("%Y-%m-%d %H:%M")
-                except ValueError:
-                    last_sent_str = "Invalid"
-            else:
-                last_sent_str = ""
-
-            # Build freq_or_int column
-            if mode == "Interval":
-                freq_or_int = f"Every {interval_minutes} min" if interval_minutes else "N/A"
-            else:
-                freq_or_int = frequency
-
-            # Compute an estimated next send time
-            next_send_str = self.get_next_send_time(
-                mode, frequency, interval_minutes, schedule_time, last_sent
-            )
-
-            display_time = schedule_time if schedule_time else ""
-
-            self.email_list.insert(
-                "",
-                "end",
-                values=(
-                    email_id,
-                    subject,
-                    recipients,
-                    mode,
-                    freq_or_int,
-                    display_time,
-                    last_sent_str,
-                    next_send_str
-                )
-            )
+    def next_page(self):
+        if self.next_page_cursor:
+            self.page_cursors.append(self.next_page_cursor)
+            self.load_scheduled_emails()
+
+    def prev_page(self):
+        if len(self.page_cursors) > 1:
+            self.page_cursors.pop()
+            self.load_scheduled_emails()
 
-    def get_next_send_time(self, mode, frequency, interval_minutes, schedule_time, last_sent):
+    def refresh_emails(self, email_ids):
         """
-        Estimate the next time this email will be sent, based on simplified scheduling logic.
+        Update the Treeview rows for these email ids in place. Ids not on the
+        current page are ignored; if one on the page was deleted, the (bounded)
+        current page is reloaded so it fills back up.
         """
-        now = datetime.now()
+        on_page = [email_id for email_id in email_ids if email_id in self.email_items]
+        found = {email.id: email for email in self.emails.get_many(on_page)}
+
+        if len(found) < len(on_page):
+            self.load_scheduled_emails()
+            return
 
-        # Convert last_sent
-        last_sent_dt = None
-        if last_sent:
+        for email_id, email in found.items():
+            self.email_list.item(self.email_items[email_id], values=self.format_email_row(email))
+
+    def format_email_row(self, email):
+        """Build the Treeview column values for one email."""
+        # Convert last_sent to a display string
+        if email.last_sent:
             try:
-                last_sent_dt = datetime.fromisoformat(last_sent)
+                last_sent_dt = datetime.fromisoformat(email.last_sent)
+                last_sent_str = last_sent_dt.strftime("%Y-%m-%d %H:%M")
             except ValueError:
-                pass
+                last_sent_str = "Invalid"
+        else:
+            last_sent_str = ""
 
-        # For "Interval" mode
-        if mode == "Interval":
-            if interval_minutes and interval_minutes > 0:
-                if not last_sent_dt:
-                    return "Now"
-                else:
-                    next_time = last_sent_dt + timedelta(minutes=interval_minutes)
-                    return next_time.strftime("%Y-%m-%d %H:%M")
-            else:
-                return "N/A"
-
-        # For "Time" mode
-        if not schedule_time:
-            return "N/A"
+        # Build freq_or_int column
+        if email.mode == "Interval":
+            freq_or_int = f"Every {format_interval(email.interval_seconds)}" if email.interval_seconds else "N/A"
+        elif email.frequency == "Custom":
+            freq_or_int = email.recurrence
+        else:
+            freq_or_int = email.frequency
+
+        # The scheduler keeps next_due_at up to date; just display it
+        next_send_str = self.format_next_send(email)
+
+        display_time = email.schedule_time if email.schedule_time else ""
+
+        return (
+            email.id,
+            email.subject,
+            email.recipients,
+            email.mode,
+            freq_or_int,
+            display_time,
+            last_sent_str,
+            next_send_str
+        )
 
-        try:
-            sched_hour, sched_min = map(int, schedule_time.split(":"))
-        except:
-            return "N/A"  # invalid format
-
-        scheduled_today = now.replace(hour=sched_hour, minute=sched_min, second=0, microsecond=0)
-
-        if frequency == "Once":
-            if not last_sent_dt:
-                # Not sent yet, so either today if not passed, otherwise "No future"
-                if now <= scheduled_today:
-                    return scheduled_today.strftime("%Y-%m-%d %H:%M")
-                else:
-                    return "No future"
-            else:
-                return "No future"
-
-        elif frequency == "Daily":
-            if now <= scheduled_today:
-                return scheduled_today.strftime("%Y-%m-%d %H:%M")
-            else:
-                tomorrow = scheduled_today + timedelta(days=1)
-                return tomorrow.strftime("%Y-%m-%d %H:%M")
-
-        elif frequency == "Weekly":
-            if last_sent_dt:
-                next_week = last_sent_dt + timedelta(days=7)
-                return next_week.strftime("%Y-%m-%d %H:%M")
-            else:
-                if now <= scheduled_today:
-                    return scheduled_today.strftime("%Y-%m-%d %H:%M")
-                else:
-                    next_week = now + timedelta(days=7)
-                    return next_week.strftime("%Y-%m-%d %H:%M")
-
-        elif frequency == "Monthly":
-            if last_sent_dt:
-                next_month = last_sent_dt + timedelta(days=30)
-                return next_month.strftime("%Y-%m-%d %H:%M")
-            else:
-                if now <= scheduled_today:
-                    return scheduled_today.strftime("%Y-%m-%d %H:%M")
-                else:
-                    next_month = now + timedelta(days=30)
-                    return next_month.strftime("%Y-%m-%d %H:%M")
-
-        return "N/A"  # fallback
+    def format_next_send(self, email):
+        """The precomputed next_due_at as text, in the email's own time zone if it has one."""
+        if email.next_due_at is None:
+            return "No future"
+        if email.next_due_at <= datetime.now().timestamp():
+            return "Now"
+        if email.mode == "Time" and email.timezone:
+            try:
+                return datetime.fromtimestamp(email.next_due_at, get_zone(email.timezone)).strftime(
+                    f"%Y-%m-%d %H:%M ({email.timezone})"
+                )
+            except ValueError:
+                pass
+        return datetime.fromtimestamp(email.next_due_at).strftime("%Y-%m-%d %H:%M")
 
     # ======================= WINDOW CLOSE HANDLER =========================
     def on_closing(self):
         """Stop the scheduling thread and close the app."""
-        self.stop_scheduling = True
+        self.scheduler.stop()
         self.root.destroy()
 
 # ======================= MAIN =========================
 if __name__ == "__main__":
-    setup_database()
+    database = Database(DB_FILE)
+    database.migrate()
     root = tk.Tk()
-    app = EmailSchedulerGUI(root)
+    app = EmailSchedulerGUI(root, database)
     root.mainloop()
\ No newline at end of file
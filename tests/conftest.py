@@ -0,0 +1,31 @@
+import pytest
+
+from benchmarks.smtp_sink import SMTPSink
+from email_scheduler.core import Scheduler
+from email_scheduler.db import Database, SMTPSettingsRepository
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A migrated scheduler.db in a temporary directory."""
+    database = Database(str(tmp_path / "scheduler.db"))
+    database.migrate()
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def sink():
+    """A local SMTP server keeping every message it receives."""
+    sink = SMTPSink(keep_messages=True).start()
+    yield sink
+    sink.stop()
+
+
+@pytest.fixture
+def scheduler(database, sink):
+    """A Scheduler (not running its loop) with one SMTP profile, pointing at the sink."""
+    SMTPSettingsRepository(database).save("127.0.0.1", sink.port, "sender@example.com", "secret", "NONE")
+    scheduler = Scheduler(database)
+    yield scheduler
+    scheduler.stop()
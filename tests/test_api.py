@@ -0,0 +1,89 @@
+import http.client
+import json
+
+import pytest
+
+from email_scheduler.api import ApiServer
+
+TOKEN = "s3cret"
+EMAIL = {"subject": "Report", "recipients": "a@example.com", "body": "Hi", "mode": "Interval", "interval": "1h"}
+
+
+@pytest.fixture
+def api(scheduler, tmp_path):
+    (tmp_path / "uploads").mkdir()
+    server = ApiServer(scheduler, 0, token=TOKEN, upload_dir=str(tmp_path / "uploads")).start()
+    yield server
+    server.stop()
+
+
+def request(api, method, path, body=None, token=TOKEN):
+    """(status, decoded JSON or None) for one request to the API."""
+    conn = http.client.HTTPConnection("127.0.0.1", api.port, timeout=5)
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    data = None if body is None else json.dumps(body)
+    if data is not None:
+        headers["Content-Type"] = "application/json"
+    conn.request(method, path, data, headers)
+    response = conn.getresponse()
+    payload = response.read()
+    conn.close()
+    return response.status, json.loads(payload) if payload else None
+
+
+def test_requests_need_the_token(api):
+    assert request(api, "GET", "/emails", token=None)[0] == 401
+    assert request(api, "GET", "/emails", token="wrong")[0] == 401
+    assert request(api, "GET", "/emails") == (200, {"emails": [], "next_cursor": None})
+
+
+def test_create_read_update_and_delete(api):
+    status, created = request(api, "POST", "/emails", EMAIL)
+    assert status == 201 and created["interval"] == "3600s" and created["send_count"] == 0
+    path = f"/emails/{created['id']}"
+
+    status, updated = request(api, "PATCH", path, {"subject": "Weekly report", "send_count": 99})
+    assert status == 200 and updated["subject"] == "Weekly report"
+    # Fields left out, and read-only ones, keep their values
+    assert updated["recipients"] == "a@example.com" and updated["send_count"] == 0
+    assert request(api, "GET", path) == (200, updated)
+
+    assert request(api, "DELETE", path) == (204, None)
+    assert request(api, "GET", path)[0] == 404
+
+
+def test_bulk_create_is_all_or_nothing_and_pages(api):
+    status, payload = request(api, "POST", "/emails", [EMAIL, dict(EMAIL, mode="Sometimes")])
+    assert status == 400 and [error["index"] for error in payload["errors"]] == [1]
+    assert request(api, "GET", "/emails")[1]["emails"] == []
+
+    assert request(api, "POST", "/emails", [dict(EMAIL, subject=f"Report {n}") for n in range(3)])[0] == 201
+    status, first = request(api, "GET", "/emails?limit=2")
+    _, second = request(api, "GET", f"/emails?limit=2&cursor={first['next_cursor']}")
+    assert [email["subject"] for email in first["emails"] + second["emails"]] == [
+        "Report 0", "Report 1", "Report 2"
+    ]
+    assert second["next_cursor"] is None
+
+
+def test_attachments_are_limited_to_the_upload_directory(api, tmp_path):
+    (tmp_path / "secret.txt").write_text("keep out")
+    (tmp_path / "uploads" / "report.txt").write_text("figures")
+    status, payload = request(api, "POST", "/emails", dict(EMAIL, attachments=str(tmp_path / "secret.txt")))
+    assert status == 400 and "outside the upload directory" in payload["error"]
+
+    status, created = request(api, "POST", "/emails", dict(EMAIL, attachments=["report.txt"]))
+    assert status == 201 and created["attachments"][0].startswith("sha256:")
+    assert created["attachments"][0].endswith("/report.txt")
+
+
+def test_send_now(api, sink):
+    _, created = request(api, "POST", "/emails", EMAIL)
+    status, sent = request(api, "POST", f"/emails/{created['id']}/send")
+    assert status == 200 and sent["send_count"] == 1 and len(sink.messages) == 1
+
+
+def test_unknown_routes_and_methods(api):
+    assert request(api, "GET", "/nothing")[0] == 404
+    assert request(api, "PUT", "/emails")[0] == 405
+    assert request(api, "GET", "/emails?limit=0")[0] == 400
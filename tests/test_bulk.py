@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from email_scheduler.bulk import export_emails, import_emails, row_to_email
+from email_scheduler.db import AttachmentRepository, EmailRepository
+
+ROW = {"subject": "Report", "recipients": "a@example.com", "body": "Hi", "mode": "Interval", "interval": "2h"}
+
+
+@pytest.fixture
+def store(database):
+    return AttachmentRepository(database)
+
+
+@pytest.mark.parametrize("changes, error", [
+    ({"subject": ""}, "subject is required"),
+    ({"mode": "Sometimes"}, "mode must be one of"),
+    ({"interval": "soon"}, "interval must be"),
+    ({"mode": "Time", "frequency": "Hourly"}, "frequency must be one of"),
+    ({"per_recipient": "maybe"}, "per_recipient must be true or false"),
+    ({"misfire_policy": "retry"}, "misfire_policy must be one of"),
+    ({"month_day": "32"}, "month_day must be"),
+    ({"colour": "blue"}, "Unknown columns: colour"),
+    ({"attachments": "sha256:abc"}, "attachment reference must be"),
+    ({"attachments": "sha256:abc/report.pdf"}, "attachment not in the store"),
+])
+def test_invalid_rows_are_rejected(store, changes, error):
+    with pytest.raises(ValueError, match=error):
+        row_to_email(dict(ROW, **changes), store)
+
+
+def test_paths_are_refused_unless_allowed(store, tmp_path):
+    (tmp_path / "report.txt").write_text("figures")
+    with pytest.raises(ValueError, match="must be references"):
+        row_to_email(dict(ROW, attachments=str(tmp_path / "report.txt")), store, allow_paths=False)
+    with pytest.raises(ValueError, match="outside the upload directory"):
+        row_to_email(dict(ROW, attachments="../report.txt"), store, upload_dir=str(tmp_path / "uploads"))
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_export_and_import_round_trip(database, store, tmp_path, fmt):
+    (tmp_path / "report.txt").write_text("figures")
+    emails = EmailRepository(database)
+    emails.add(row_to_email(dict(ROW, attachments=str(tmp_path / "report.txt"), templated="yes"), store))
+
+    exported = io.StringIO()
+    assert export_emails(emails, exported, fmt) == 1
+    # Exports refer to the stored contents, so the import doesn't need the file
+    (tmp_path / "report.txt").unlink()
+    errors = []
+    assert import_emails(emails, store, io.StringIO(exported.getvalue()), fmt,
+                         on_error=lambda *error: errors.append(error), chunk_size=1) == (1, 0)
+    assert errors == []
+
+    original, copy = (emails.get(email_id) for email_id in (1, 2))
+    assert copy.interval_seconds == 7200 and copy.templated
+    assert copy.attachments == original.attachments and copy.attachments[0].filename == "report.txt"
+
+
+def test_invalid_lines_are_reported_and_skipped(database, store):
+    lines = io.StringIO('{"subject": "Report", "recipients": "a@example.com", "mode": "Interval", "interval": "5"}\n'
+                        'not json\n'
+                        '["a list"]\n'
+                        '{"subject": "", "mode": "Interval", "interval": "5"}\n')
+    errors = []
+    assert import_emails(EmailRepository(database), store, lines, "jsonl",
+                         on_error=lambda *error: errors.append(error)) == (1, 3)
+    assert [line for line, _ in errors] == [2, 3, 4]
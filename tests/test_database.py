@@ -0,0 +1,29 @@
+import threading
+
+import pytest
+
+from email_scheduler.db import Email, EmailRepository
+
+
+def test_connections_are_per_thread_and_in_wal_mode(database):
+    conn = database.connection()
+    assert database.connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(database.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_transaction_rolls_back_on_error(database):
+    emails = EmailRepository(database)
+    with pytest.raises(RuntimeError):
+        with database.transaction() as conn:
+            conn.execute("INSERT INTO emails (subject, recipients, body, mode) VALUES ('x', 'a', '', 'Interval')")
+            raise RuntimeError("abandoned")
+    assert emails.page(limit=10)[0] == []
+
+    emails.add(Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=60))
+    assert len(emails.page(limit=10)[0]) == 1
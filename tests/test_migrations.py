@@ -0,0 +1,98 @@
+import base64
+import sqlite3
+from datetime import datetime, timedelta
+
+from email_scheduler.db import MIGRATIONS, AttachmentRepository, Database, EmailRepository, _migrate_month_day
+
+
+def old_database(path, rows):
+    """A scheduler.db as written before versioned migrations, holding these emails."""
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE smtp_settings (
+            id INTEGER PRIMARY KEY, server TEXT, port INTEGER, email TEXT, password TEXT, encryption TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE emails (
+            id INTEGER PRIMARY KEY, subject TEXT, recipients TEXT, body TEXT, mode TEXT, frequency TEXT,
+            interval_minutes INTEGER, schedule_time TEXT, last_sent TEXT, attachment_path TEXT
+        )
+    """)
+    conn.executemany("""
+        INSERT INTO emails (subject, recipients, body, mode, frequency, interval_minutes, schedule_time,
+                            last_sent, attachment_path)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def upgrade(path):
+    database = Database(path)
+    database.migrate()
+    return database
+
+
+def test_weekly_email_sent_yesterday_is_not_due_after_upgrade(tmp_path):
+    path = str(tmp_path / "scheduler.db")
+    last_sent = (datetime.now() - timedelta(days=1)).replace(second=0, microsecond=0)
+    old_database(path, [("Report", "a@example.com", "Hi", "Time", "Weekly", None,
+                         last_sent.strftime("%H:%M"), last_sent.isoformat(), None)])
+
+    database = upgrade(path)
+    email = EmailRepository(database).get(1)
+    assert email.next_due_at == int((last_sent + timedelta(days=7)).timestamp())
+    assert EmailRepository(database).due_times() == {1: email.next_due_at}
+    assert email.next_due_at > datetime.now().timestamp()
+
+
+def test_upgrade_records_every_migration(tmp_path):
+    path = str(tmp_path / "scheduler.db")
+    old_database(path, [])
+    database = upgrade(path)
+    (version,) = database.connection().execute("PRAGMA user_version").fetchone()
+    assert version == len(MIGRATIONS)
+    # Nothing is applied twice
+    database.migrate()
+
+
+def test_month_day_is_taken_from_the_next_due_date(tmp_path):
+    # Databases from before month_day: Monthly emails ran on their next_due_at's day,
+    # and past the 28th on the last day of every month
+    database = Database(str(tmp_path / "scheduler.db"))
+    version = MIGRATIONS.index(_migrate_month_day)
+    with database.transaction() as conn:
+        for migration in MIGRATIONS[:version]:
+            migration(conn)
+        conn.execute(f"PRAGMA user_version={version}")
+        conn.executemany("""
+            INSERT INTO emails (subject, recipients, body, mode, frequency, schedule_time, next_due_at)
+            VALUES ('Report', 'a@example.com', 'Hi', ?, ?, '09:00', ?)
+        """, [
+            ("Time", "Monthly", int(datetime(2025, 1, 31, 9).timestamp())),
+            ("Time", "Monthly", int(datetime(2025, 1, 29, 9).timestamp())),
+            ("Time", "Monthly", int(datetime(2025, 1, 15, 9).timestamp())),
+            ("Time", "Weekly", int(datetime(2025, 1, 31, 9).timestamp())),
+        ])
+    database.migrate()
+    emails = EmailRepository(database)
+    assert [emails.get(email_id).month_day for email_id in (1, 2, 3, 4)] == [31, 31, 15, None]
+
+
+def test_upgrade_moves_attachments_into_the_store(tmp_path):
+    path = str(tmp_path / "scheduler.db")
+    report = tmp_path / "report.pdf"
+    report.write_bytes(b"%PDF" + bytes(range(256)) * 100)
+    old_database(path, [
+        ("With file", "a@example.com", "Hi", "Interval", None, 60, None, None, str(report)),
+        ("Missing file", "a@example.com", "Hi", "Interval", None, 60, None, None, str(tmp_path / "gone.pdf")),
+    ])
+    database = upgrade(path)
+    emails = EmailRepository(database)
+
+    (attachment,) = emails.get(1).attachments
+    assert attachment.filename == "report.pdf"
+    payload = b"".join(AttachmentRepository(database).read_payload(attachment.digest, chunk_size=100))
+    assert base64.b64decode(payload) == report.read_bytes()
+    assert emails.get(2).attachments == []
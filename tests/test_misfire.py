@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+from email_scheduler.db import Email
+from email_scheduler.misfire import BacklogDrain, plan_runs
+
+NOW = datetime(2025, 6, 2, 12, 0)
+MINUTE = 60
+
+
+def every_minute(missed, policy=None, cap=None):
+    """An every-minute email that last ran `missed` minutes before NOW."""
+    return Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=MINUTE,
+                 next_due_at=int(NOW.timestamp()) - missed * MINUTE, misfire_policy=policy, misfire_cap=cap)
+
+
+def test_runs_within_the_grace_period_are_sent():
+    on_time, missed, skipped, next_due = plan_runs(every_minute(1), NOW)
+    # The run a minute ago is late, not missed
+    assert (len(on_time), missed, skipped) == (2, [], [])
+    assert next_due == datetime.fromtimestamp(NOW.timestamp() + MINUTE)
+
+
+def test_fire_once_sends_only_the_latest_run():
+    on_time, missed, skipped, _ = plan_runs(every_minute(30), NOW)
+    assert on_time == [int(NOW.timestamp())] and missed == []
+    assert len(skipped) == 30
+
+
+def test_skip_sends_nothing_missed():
+    on_time, missed, skipped, _ = plan_runs(every_minute(30, "skip"), NOW)
+    assert len(on_time) == 2 and missed == [] and len(skipped) == 29
+
+
+@pytest.mark.parametrize("cap, sent", [(None, 10), (5, 5), (150, 150), (1000, 299)])
+def test_fire_all_sends_the_latest_missed_runs_up_to_its_cap(cap, sent):
+    on_time, missed, skipped, _ = plan_runs(every_minute(300, "fire_all", cap), NOW)
+    assert len(on_time) == 2 and len(missed) == sent
+    assert missed[-1] == int(NOW.timestamp()) - 2 * MINUTE
+
+
+def test_missed_time_rules_are_found():
+    email = Email("Report", "a@example.com", "Hi", "Time", "Custom", recurrence="0 9 * * *",
+                  next_due_at=int(datetime(2025, 5, 30, 9).timestamp()), misfire_policy="fire_all", misfire_cap=2)
+    on_time, missed, skipped, next_due = plan_runs(email, NOW)
+    assert on_time == [] and missed == [int(datetime(2025, 6, day, 9).timestamp()) for day in (1, 2)]
+    assert next_due.timestamp() == datetime(2025, 6, 3, 9).timestamp()
+
+
+def test_backlog_drain_spreads_sends_over_the_window():
+    drain = BacklogDrain(window=60)
+    drain.plan(1000, backlog=4)
+    assert [drain.slot(1000) for _ in range(4)] == [1000, 1015, 1030, 1045]
+    assert drain.active(1050) and not drain.active(1060)
+    # Without a backlog sends aren't held back
+    idle = BacklogDrain(window=60)
+    idle.plan(1000, backlog=0)
+    assert [idle.slot(1000) for _ in range(3)] == [1000, 1000, 1000]
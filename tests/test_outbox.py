@@ -0,0 +1,101 @@
+from datetime import datetime
+
+import pytest
+
+from email_scheduler.db import Email, EmailRepository, OutboxRepository
+
+NOW = 1_700_000_000
+LEASE = 300
+DOMAIN = "example.com"
+
+
+@pytest.fixture
+def email(database):
+    email = Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=3600)
+    EmailRepository(database).add(email)
+    return email
+
+
+@pytest.fixture
+def outbox(database):
+    return OutboxRepository(database)
+
+
+def queue(database, email_id, count=1):
+    """Put sends of an email in the outbox, as enqueue_due() would."""
+    with database.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO outbox (email_id, state, due_at, next_attempt_at) VALUES (?, 'pending', ?, ?)
+        """, [(email_id, NOW - 60 + n, NOW - 60 + n) for n in range(count)])
+
+
+def test_send_now_is_refused_while_another_entry_is_leased(database, email, outbox):
+    queue(database, email.id, count=2)
+    (entry, _), = outbox.claim_ready("worker-a", NOW, NOW + LEASE, 10, DOMAIN)
+
+    # The email's other entry is not handed to a second worker meanwhile
+    assert outbox.claim_email(email.id, "worker-b", NOW, NOW + LEASE, DOMAIN) is None
+    assert outbox.claim_ready("worker-b", NOW, NOW + LEASE, 10, DOMAIN) == []
+
+    # Once the lease has expired, the entry is taken over rather than duplicated
+    claimed, created = outbox.claim_email(email.id, "worker-b", NOW + LEASE, NOW + 2 * LEASE, DOMAIN)
+    assert (claimed.id, claimed.message_id, created) == (entry.id, entry.message_id, False)
+
+
+def test_claim_ready_takes_one_entry_per_email(database, email, outbox):
+    other = Email("Other", "b@example.com", "Hi", "Interval", interval_seconds=3600)
+    EmailRepository(database).add(other)
+    queue(database, email.id, count=3)
+    queue(database, other.id)
+
+    claimed = outbox.claim_ready("worker-a", NOW, NOW + LEASE, 10, DOMAIN)
+    assert sorted(entry.email_id for entry, _ in claimed) == sorted([email.id, other.id])
+    assert outbox.counts()["in_flight"] == 2
+
+
+def test_send_now_creates_an_entry_when_none_is_queued(email, outbox):
+    entry, created = outbox.claim_email(email.id, "worker-a", NOW, NOW + LEASE, DOMAIN)
+    assert created and entry.state == "in_flight" and entry.message_id
+    assert outbox.claim_email(email.id, "worker-b", NOW, NOW + LEASE, DOMAIN) is None
+
+
+def test_results_after_a_lost_lease_are_not_recorded(database, email, outbox):
+    queue(database, email.id)
+    (entry, _), = outbox.claim_ready("worker-a", NOW, NOW + LEASE, 10, DOMAIN)
+    # worker-a stalls past its lease and worker-b takes the entry over
+    (taken, _), = outbox.claim_ready("worker-b", NOW + LEASE, NOW + 2 * LEASE, 10, DOMAIN)
+    assert taken.id == entry.id
+
+    outbox.record_results("worker-a", [(entry, datetime.fromtimestamp(NOW + LEASE + 1))], [],
+                          next_due={email.id: NOW + 7200})
+    stale = EmailRepository(database).get(email.id)
+    assert (stale.last_sent, stale.send_count, stale.next_due_at) == (None, 0, email.next_due_at)
+    assert outbox.counts()["in_flight"] == 1
+
+    sent_at = datetime.fromtimestamp(NOW + LEASE + 2)
+    outbox.record_results("worker-b", [(taken, sent_at)], [])
+    sent = EmailRepository(database).get(email.id)
+    assert (sent.last_sent, sent.send_count) == (sent_at.isoformat(), 1)
+    assert outbox.counts()["sent"] == 1
+
+
+def test_failures_after_a_lost_lease_are_not_recorded(database, email, outbox):
+    queue(database, email.id)
+    (entry, _), = outbox.claim_ready("worker-a", NOW, NOW + LEASE, 10, DOMAIN)
+    outbox.claim_ready("worker-b", NOW + LEASE, NOW + 2 * LEASE, 10, DOMAIN)
+
+    outbox.record_results("worker-a", [], [(entry, "SMTPServerDisconnected", None)])
+    assert outbox.counts()["in_flight"] == 1
+    assert outbox.counts()["dead"] == 0
+
+
+def test_send_now_records_the_send_and_the_next_due_time(database, scheduler, sink):
+    email = Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=3600)
+    EmailRepository(database).add(email)
+
+    assert scheduler.send_now(email)
+    sent = EmailRepository(database).get(email.id)
+    assert sent.send_count == 1 and len(sink.messages) == 1
+    last_sent = datetime.fromisoformat(sent.last_sent).timestamp()
+    assert sent.next_due_at == pytest.approx(last_sent + 3600, abs=1)
+    assert OutboxRepository(database).counts()["sent"] == 1
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from email_scheduler.db import SMTPSettings
+from email_scheduler.ratelimit import RateLimiter, RateLimitStopped, TokenBucket
+
+# 60 a minute: a burst of 6, then one a second
+SETTINGS = SMTPSettings(1, "smtp.example.com", 587, "me@example.com", "secret", "STARTTLS", max_per_minute=60)
+KEY = (RateLimiter.account_key(SETTINGS), "minute")
+
+
+def tokens(limiter):
+    return limiter.state()[KEY][0]
+
+
+def test_bucket_spaces_reservations_past_the_burst():
+    bucket = TokenBucket(rate=1.0, capacity=2, updated_at=100.0)
+    assert [bucket.reserve(100.0) for _ in range(4)] == [0.0, 0.0, 1.0, 2.0]
+    # Refills continuously, up to capacity
+    bucket.refill(110.0)
+    assert bucket.tokens == 2
+
+
+def test_try_acquire_stops_at_the_burst():
+    limiter = RateLimiter()
+    assert [limiter.try_acquire(SETTINGS) for _ in range(7)] == [True] * 6 + [False]
+
+
+def test_unlimited_settings_never_wait():
+    limiter = RateLimiter()
+    unlimited = SMTPSettings(2, "smtp.example.com", 587, "other@example.com", "secret", "STARTTLS")
+    for _ in range(100):
+        limiter.acquire(unlimited)
+    assert limiter.stats()["throttled"] == 0
+
+
+def test_saved_state_is_restored():
+    limiter = RateLimiter({KEY: (1.0, time.time())})
+    assert limiter.try_acquire(SETTINGS)
+    assert not limiter.try_acquire(SETTINGS)
+
+
+def test_close_wakes_a_waiting_thread_and_refunds_its_token():
+    limiter = RateLimiter({KEY: (0.0, time.time())})
+    errors = []
+
+    def send():
+        try:
+            limiter.acquire(SETTINGS)
+        except RateLimitStopped as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    while not limiter.stats()["waiting"]:
+        time.sleep(0.01)
+    limiter.close()
+    thread.join(5)
+
+    assert len(errors) == 1 and limiter.stats()["waiting"] == 0
+    # The interrupted send didn't use up quota that the next start inherits
+    assert tokens(limiter) == pytest.approx(0.0, abs=0.1)
+
+
+def test_close_wakes_a_waiting_task_and_refunds_its_token():
+    limiter = RateLimiter({KEY: (0.0, time.time())})
+
+    async def main():
+        task = asyncio.ensure_future(limiter.acquire_async(SETTINGS))
+        while not limiter.stats()["waiting"]:
+            await asyncio.sleep(0.01)
+        threading.Thread(target=limiter.close).start()
+        with pytest.raises(RateLimitStopped):
+            await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+    assert limiter.stats()["waiting"] == 0
+    assert tokens(limiter) == pytest.approx(0.0, abs=0.1)
+
+
+def test_a_cancelled_task_gives_its_token_back():
+    limiter = RateLimiter({KEY: (0.0, time.time())})
+
+    async def main():
+        task = asyncio.ensure_future(limiter.acquire_async(SETTINGS))
+        while not limiter.stats()["waiting"]:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert limiter.stats()["waiting"] == 0
+    assert tokens(limiter) == pytest.approx(0.0, abs=0.1)
@@ -0,0 +1,63 @@
+import base64
+from email import message_from_bytes, policy
+
+from email_scheduler.recipients import ATTACHMENT_MARKER, encode_body, header_line, rcpt_batches, split_recipients
+
+
+def test_recipients_are_split_and_batched():
+    addresses = split_recipients(" a@example.com, ,b@example.com,c@example.com ")
+    assert addresses == ["a@example.com", "b@example.com", "c@example.com"]
+    assert list(rcpt_batches(addresses, 2)) == [["a@example.com", "b@example.com"], ["c@example.com"]]
+
+
+def test_header_lines_are_encoded_and_folded():
+    assert header_line("To", "a@example.com") == b"To: a@example.com\r\n"
+    line = header_line("Subject", "Grüße " + "x" * 100)
+    assert line.endswith(b"\r\n") and all(len(part) <= 78 for part in line.split(b"\r\n"))
+    parsed = message_from_bytes(line + b"\r\n", policy=policy.default)
+    assert parsed["Subject"] == "Grüße " + "x" * 100
+
+
+def test_encoded_body_is_base64_with_crlf_lines():
+    text = "Hello\n" * 50
+    encoded = encode_body(text)
+    assert not encoded.endswith(b"\r\n") and b"\r\n" in encoded
+    assert base64.b64decode(encoded).decode("utf-8") == text
+
+
+def test_per_recipient_copies_are_addressed_to_each_recipient(scheduler, sink):
+    scheduler.send_email("Report", "a@example.com, b@example.com", "Hi", per_recipient=True)
+    assert [(recipients, message_from_bytes(data)["To"]) for recipients, data in sink.messages] == [
+        (["a@example.com"], "a@example.com"), (["b@example.com"], "b@example.com")
+    ]
+
+
+def test_long_lists_go_out_in_envelopes_without_spelling_out_the_list(scheduler, sink, monkeypatch):
+    monkeypatch.setattr("email_scheduler.core.RCPT_BATCH_SIZE", 2)
+    scheduler.send_email("Report", "a@example.com, b@example.com, c@example.com", "Hi")
+    assert [recipients for recipients, _ in sink.messages] == [["a@example.com", "b@example.com"],
+                                                               ["c@example.com"]]
+    assert {message_from_bytes(data)["To"] for _, data in sink.messages} == {"undisclosed-recipients:;"}
+
+
+def attachments_received(sink):
+    """(body text, {filename: contents}) of the one message the sink received."""
+    (_, data), = sink.messages
+    message = message_from_bytes(data, policy=policy.default)
+    files = {part.get_filename(): part.get_payload(decode=True) for part in message.iter_attachments()}
+    return message.get_body().get_content(), files
+
+
+def test_text_like_the_attachment_marker_is_sent_as_written(scheduler, sink, tmp_path, monkeypatch):
+    (tmp_path / "a.txt").write_bytes(b"first file")
+    (tmp_path / "b.txt").write_bytes(b"second file")
+    attachments = [scheduler.attachment_store.ingest(str(tmp_path / name)) for name in ("a.txt", "b.txt")]
+    # The first token drawn is already in the body, so another one has to be used
+    tokens = iter(["a" * 32, "b" * 32])
+    monkeypatch.setattr("email_scheduler.recipients.secrets.token_hex", lambda size: next(tokens))
+    body = f"Before\n@@ATTACHMENT@@\n{ATTACHMENT_MARKER.format('a' * 32)}\nAfter\n"
+
+    scheduler.send_email("Report @@ATTACHMENT@@", "a@example.com", body, attachments)
+    text, files = attachments_received(sink)
+    assert text.replace("\r\n", "\n") == body
+    assert files == {"a.txt": b"first file", "b.txt": b"second file"}
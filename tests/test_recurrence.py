@@ -0,0 +1,82 @@
+from datetime import datetime, time
+
+import pytest
+
+from email_scheduler.recurrence import get_zone, latest_occurrences, next_occurrence, parse_rule
+
+BERLIN = get_zone("Europe/Berlin")
+
+
+def at(*args):
+    return datetime(*args, tzinfo=BERLIN)
+
+
+def test_rrule_and_cron_describe_the_same_rule():
+    rrule = parse_rule("RRULE:FREQ=WEEKLY;BYDAY=MO,WE;BYHOUR=9;BYMINUTE=30")
+    cron = parse_rule("30 9 * * 1,3")
+    assert rrule.weekdays == cron.weekdays == frozenset({0, 2})
+    assert rrule.times == cron.times == (time(9, 30),)
+    after = at(2025, 1, 1, 12)   # a Wednesday
+    assert next_occurrence(rrule, after, BERLIN) == next_occurrence(cron, after, BERLIN) == at(2025, 1, 6, 9, 30)
+
+
+@pytest.mark.parametrize("text", [
+    "FREQ=HOURLY",
+    "FREQ=WEEKLY",
+    "FREQ=MONTHLY;BYMONTHDAY=0",
+    "FREQ=DAILY;BYHOUR=24",
+    "FREQ=DAILY;COUNT=3",
+    "FREQ=WEEKLY;BYDAY=1MO",
+    "30 9 * *",
+    "61 9 * * *",
+    "x 9 * * *",
+])
+def test_invalid_rules_are_rejected(text):
+    with pytest.raises(ValueError):
+        parse_rule(text)
+
+
+def test_cron_steps_ranges_and_sunday_as_seven():
+    rule = parse_rule("*/15 8-9 * * 7")
+    assert rule.weekdays == frozenset({6})
+    assert len(rule.times) == 8 and rule.times[1] == time(8, 15)
+
+
+def test_cron_day_of_month_or_weekday():
+    # cron fires when either the day of the month or the weekday matches
+    rule = parse_rule("0 9 1 * 1")
+    assert next_occurrence(rule, at(2025, 1, 2, 12), BERLIN) == at(2025, 1, 6, 9)   # Monday
+    assert next_occurrence(rule, at(2025, 1, 27, 12), BERLIN) == at(2025, 2, 1, 9)  # the 1st
+
+
+def test_last_day_of_month_and_interval():
+    last_day = parse_rule("FREQ=MONTHLY;BYMONTHDAY=-1;BYHOUR=9")
+    assert next_occurrence(last_day, at(2024, 2, 1), BERLIN) == at(2024, 2, 29, 9)
+    fortnightly = parse_rule("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO;BYHOUR=9")
+    first = next_occurrence(fortnightly, at(2025, 1, 1), BERLIN)
+    assert (next_occurrence(fortnightly, first, BERLIN) - first).days == 14
+
+
+def test_local_time_is_kept_across_dst_changes():
+    rule = parse_rule("FREQ=DAILY;BYHOUR=9")
+    # Berlin moves to summer time on 2025-03-30
+    before = next_occurrence(rule, at(2025, 3, 29, 12), BERLIN)
+    assert before == at(2025, 3, 30, 9) and before.utcoffset().seconds == 7200
+
+
+def test_spring_forward_gap_fires_after_the_gap_and_fall_back_fires_once():
+    rule = parse_rule("30 2 * * *")
+    # 02:30 doesn't exist on 2025-03-30 in Berlin
+    skipped = next_occurrence(rule, at(2025, 3, 30, 0), BERLIN)
+    assert skipped.date() == datetime(2025, 3, 30).date() and skipped.hour == 3
+    # 02:30 happens twice on 2025-10-26; the rule fires on the first only
+    first = next_occurrence(rule, at(2025, 10, 26, 0), BERLIN)
+    assert next_occurrence(rule, first, BERLIN).date() == datetime(2025, 10, 27).date()
+
+
+def test_latest_occurrences_counts_the_whole_span():
+    rules = [parse_rule("FREQ=DAILY;BYHOUR=9"), parse_rule("0 9,18 * * *")]
+    latest, count = latest_occurrences(rules, at(2025, 1, 1), at(2025, 4, 1), 3, BERLIN)
+    # 90 days, twice a day; the shared 09:00 counts once
+    assert count == 180
+    assert latest == [at(2025, 3, 30, 18), at(2025, 3, 31, 9), at(2025, 3, 31, 18)]
@@ -0,0 +1,74 @@
+from email_scheduler.db import Email, EmailRepository, OutboxRepository, SendLogRepository
+from email_scheduler.retention import compact
+
+DAY = 86400
+# A day boundary, so rollups fall on whole hours and days
+NOW = 1_700_006_400
+
+
+def log_sends(database, rows):
+    """Append (sent_at, bytes, error) rows to send_log."""
+    with database.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO send_log (email_id, sent_at, latency_ms, bytes, relay_id, error) VALUES (1, ?, 100, ?, 1, ?)
+        """, rows)
+
+
+def queue(database, email_id, state, due_at, lease_expires_at=None):
+    """An outbox entry in the given state, with one attempt."""
+    with database.transaction() as conn:
+        entry_id = conn.execute("""
+            INSERT INTO outbox (email_id, state, due_at, lease_expires_at) VALUES (?, ?, ?, ?)
+        """, (email_id, state, due_at, lease_expires_at)).lastrowid
+        conn.execute("INSERT INTO outbox_attempts (outbox_id, attempted_at) VALUES (?, '2023-11-14T00:00:00')",
+                     (entry_id,))
+    return entry_id
+
+
+def outbox_ids(database):
+    conn = database.connection()
+    assert conn.execute("SELECT COUNT(*) FROM outbox_attempts WHERE outbox_id NOT IN (SELECT id FROM outbox)"
+                        ).fetchone() == (0,)
+    return {row[0] for row in conn.execute("SELECT id FROM outbox")}
+
+
+def test_old_sends_are_rolled_up_without_changing_throughput(database):
+    log_sends(database, [(NOW - 40 * DAY + 60, 1000, None), (NOW - 40 * DAY + 120, 500, "timeout"),
+                         (NOW - 400 * DAY, 2000, None), (NOW - 60, 300, None)])
+    send_log = SendLogRepository(database)
+    before = send_log.throughput(NOW - 500 * DAY, "day")
+
+    assert compact(database, now=NOW) == 3
+    assert [entry.sent_at for entry in send_log.history()] == [NOW - 60]
+    assert send_log.throughput(NOW - 500 * DAY, "day") == before
+    conn = database.connection()
+    assert conn.execute("SELECT hour, sends, failures, bytes FROM send_stats_hourly").fetchall() == [
+        (NOW - 40 * DAY, 1, 1, 1500)
+    ]
+    assert conn.execute("SELECT day, sends FROM send_stats_daily").fetchall() == [(NOW - 400 * DAY, 1)]
+
+
+def test_finished_outbox_entries_are_pruned_after_the_retention_period(database):
+    email = Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=3600)
+    EmailRepository(database).add(email)
+    old = NOW - 40 * DAY
+    for state in ("sent", "dead", "skipped"):
+        queue(database, email.id, state, old)
+    kept = [queue(database, email.id, "sent", NOW - DAY), queue(database, email.id, "failed", old)]
+
+    compact(database, now=NOW)
+    assert outbox_ids(database) == set(kept)
+
+
+def test_entries_of_deleted_emails_are_pruned_unless_being_sent(database):
+    emails = EmailRepository(database)
+    email = Email("Report", "a@example.com", "Hi", "Interval", interval_seconds=3600)
+    emails.add(email)
+    queue(database, email.id, "pending", NOW)
+    queue(database, email.id, "in_flight", NOW, lease_expires_at=NOW - 60)
+    sending = queue(database, email.id, "in_flight", NOW, lease_expires_at=NOW + 60)
+    emails.delete(email.id)
+
+    compact(database, now=NOW)
+    assert outbox_ids(database) == {sending}
+    assert OutboxRepository(database).prune(NOW - DAY, NOW + 120, 10) == 1
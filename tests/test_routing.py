@@ -0,0 +1,70 @@
+import socket
+
+import pytest
+
+from email_scheduler.db import SMTPSettings, SMTPSettingsRepository
+from email_scheduler.routing import FAILURES_BEFORE_COOLDOWN, RelayRouter
+
+
+def profile(profile_id, name):
+    return SMTPSettings(profile_id, "smtp.example.com", 587, f"{name}@example.com", "secret", "STARTTLS", name=name)
+
+
+FAST, SLOW = profile(1, "fast"), profile(2, "slow")
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_relays_are_ordered_by_latency_and_load():
+    router = RelayRouter(lambda: [SLOW, FAST])
+    router.record_success(SLOW, 2.0)
+    router.record_success(FAST, 0.1)
+    assert router.candidates() == [FAST, SLOW]
+    # A busy relay loses its lead
+    for _ in range(30):
+        router.begin(FAST)
+    assert router.candidates() == [SLOW, FAST]
+
+
+def test_a_failing_relay_is_rested_and_recovers():
+    router = RelayRouter(lambda: [FAST, SLOW])
+    for _ in range(FAILURES_BEFORE_COOLDOWN):
+        router.record_failure(FAST)
+    assert router.candidates() == [SLOW, FAST]
+    assert router.stats()["fast"]["resting"]
+    router.record_success(FAST, 0.1)
+    assert not router.stats()["fast"]["resting"]
+
+
+def test_an_assigned_profile_is_used_alone_until_deleted():
+    router = RelayRouter(lambda: [FAST, SLOW])
+    assert router.candidates(2) == [SLOW]
+    assert router.candidates(3) == [FAST, SLOW]
+
+
+def test_a_send_fails_over_from_an_unreachable_relay(database, scheduler, sink):
+    profiles = SMTPSettingsRepository(database)
+    working = profiles.get()
+    profiles.save("127.0.0.1", closed_port(), "sender@example.com", "secret", "NONE", name="down")
+    scheduler.relays.invalidate()
+    # The working relay is made to look slower, so the unreachable one is tried first
+    scheduler.relays.record_success(working, 5.0)
+    assert scheduler.relays.candidates()[0].name == "down"
+
+    scheduler.send_email("Report", "a@example.com", "Hi")
+    assert len(sink.messages) == 1
+    stats = scheduler.relays.stats()
+    assert stats["down"]["consecutive_failures"] == 1 and stats[working.name]["consecutive_failures"] == 0
+
+
+def test_an_assigned_profile_does_not_fail_over(database, scheduler, sink):
+    down = SMTPSettingsRepository(database).save("127.0.0.1", closed_port(), "sender@example.com", "secret",
+                                                 "NONE", name="down")
+    scheduler.relays.invalidate()
+    with pytest.raises(OSError):
+        scheduler.send_email("Report", "a@example.com", "Hi", profile_id=down)
+    assert sink.messages == []
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+from email_scheduler.db import Email
+from email_scheduler.schedule import compute_next_due
+
+
+def next_monthly(last_sent, month_day, timezone=None):
+    due = compute_next_due("Time", "Monthly", None, "09:00", last_sent.isoformat(), last_sent,
+                           timezone=timezone, month_day=month_day)
+    return due.replace(tzinfo=None)
+
+
+@pytest.mark.parametrize("month_day, dates", [
+    (31, [(2025, 1, 31), (2025, 2, 28), (2025, 3, 31), (2025, 4, 30), (2025, 5, 31)]),
+    (31, [(2024, 1, 31), (2024, 2, 29), (2024, 3, 31)]),
+    (30, [(2025, 1, 30), (2025, 2, 28), (2025, 3, 30)]),
+    (15, [(2025, 1, 15), (2025, 2, 15), (2025, 3, 15)]),
+])
+def test_monthly_returns_to_its_day_after_short_months(month_day, dates):
+    for sent, due in zip(dates, dates[1:]):
+        assert next_monthly(datetime(*sent, 9), month_day) == datetime(*due, 9)
+
+
+def test_monthly_month_end_in_a_time_zone():
+    assert next_monthly(datetime(2025, 1, 31, 9), 31, "Europe/Berlin") == datetime(2025, 2, 28, 9)
+
+
+def test_month_day_is_fixed_from_the_first_due_date():
+    email = Email("Report", "a@example.com", "Hi", "Time", "Monthly", schedule_time="09:00",
+                  next_due_at=int(datetime(2025, 1, 31, 9).timestamp()))
+    email.settle_month_day()
+    assert email.month_day == 31
+
+    email.frequency = "Weekly"
+    email.settle_month_day()
+    assert email.month_day is None
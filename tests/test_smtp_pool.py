@@ -0,0 +1,31 @@
+from email_scheduler.smtp_pool import SEND_BUFFER_BYTES, SMTP
+
+
+def send(sink, chunks):
+    """Send chunks through the sink; returns what each socket write held."""
+    smtp = SMTP("127.0.0.1", sink.port)
+    writes = []
+    original = smtp.send
+    smtp.send = lambda data: (writes.append(data), original(data))[1]
+    try:
+        assert smtp.sendmail_chunks("sender@example.com", ["a@example.com"], chunks) == {}
+        assert smtp.data_reply == "OK queued"
+    finally:
+        smtp.quit()
+    return writes
+
+
+def test_lines_starting_with_a_dot_are_stuffed_across_chunks(sink):
+    chunks = [b"Subject: dots\r\n\r\n", b".first\r\n", b"", b"middle\r\n.", b"split\r\n", b"..two\r\n", b"end"]
+    send(sink, chunks)
+    # The sink takes the stuffing off again, and the message ends with the CRLF added before "."
+    assert sink.messages == [(["a@example.com"], b"".join(chunks) + b"\r\n")]
+
+
+def test_small_chunks_are_joined_into_large_writes(sink):
+    line = b"x" * 98 + b"\r\n"
+    writes = send(sink, [line] * 2000)
+    data_writes = [data for data in writes if isinstance(data, bytes) and line in data]
+    assert len(data_writes) == 4
+    assert all(len(data) >= SEND_BUFFER_BYTES for data in data_writes[:-1])
+    assert sink.messages[0][1] == line * 2000
@@ -0,0 +1,55 @@
+import os
+from email import message_from_bytes, policy
+
+from email_scheduler.templates import DataFileCache, Template, TemplateCache, recipient_variables
+
+
+def received(sink):
+    """(To, Subject, body text) of each message the sink received."""
+    messages = [message_from_bytes(data, policy=policy.default) for _, data in sink.messages]
+    return [(message["To"], message["Subject"], message.get_content().strip()) for message in messages]
+
+
+def test_placeholders_fallbacks_and_data_columns():
+    template = Template("Hi {{ recipient_name }}, {{ data.team | no team }}{{ missing|! }}")
+    context = recipient_variables("Ann Lee <ann@example.com>", {"ann@example.com": {"team": "Ops"}})
+    assert template.render(context) == "Hi Ann Lee, Ops!"
+    assert template.per_recipient and not Template("{{ date }}").per_recipient
+
+
+def test_templates_are_compiled_once_and_least_recently_used_dropped():
+    cache = TemplateCache(max_size=2)
+    assert cache.get("No placeholders") is None
+    first = cache.get("{{ a }}")
+    assert cache.get("{{ a }}") is first
+    cache.get("{{ b }}")
+    cache.get("{{ a }}")
+    cache.get("{{ c }}")   # drops {{ b }}, the least recently used
+    assert cache.get("{{ a }}") is first
+    assert len(cache._templates) == 2
+
+
+def test_data_files_are_reloaded_when_they_change(tmp_path):
+    path = tmp_path / "data.csv"
+    path.write_text("email,team\nAnn@example.com,Ops\n")
+    cache = DataFileCache()
+    rows = cache.get(str(path))
+    assert rows["ann@example.com"]["team"] == "Ops" and cache.get(str(path)) is rows
+
+    path.write_text("email,team\nann@example.com,Sales\n")
+    os.utime(path, ns=(0, 0))
+    assert cache.get(str(path))["ann@example.com"]["team"] == "Sales"
+
+
+def test_braces_are_sent_verbatim_unless_templated(scheduler, sink):
+    scheduler.send_email("Use {{ name }}", "a@example.com", "Write {{ recipient }} literally")
+    assert received(sink) == [("a@example.com", "Use {{ name }}", "Write {{ recipient }} literally")]
+
+
+def test_templated_emails_are_rendered_per_recipient(scheduler, sink, tmp_path):
+    data = tmp_path / "data.jsonl"
+    data.write_text('{"email": "b@example.com", "team": "Ops"}\n')
+    scheduler.send_email("For {{ recipient_name }}", "a@example.com, b@example.com",
+                         "Team: {{ data.team | none }}", per_recipient=True, data_file=str(data), templated=True)
+    assert sorted(received(sink)) == [("a@example.com", "For a", "Team: none"),
+                                      ("b@example.com", "For b", "Team: Ops")]